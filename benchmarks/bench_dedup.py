@@ -0,0 +1,108 @@
+"""
+Duplicated url checks against a big url_entries table: the previous COUNT
+over the unindexed url column, the indexed url hash query and the recent
+urls in memory.
+
+    python -m benchmarks.bench_dedup --rows 1000000 --checks 200
+
+The table is generated once in --db and reused by later runs.
+"""
+
+import argparse
+import asyncio
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from telegram import Chat, Message, User
+
+from benchmarks.common import Timings, generate_url_entries, print_summary
+from rejubot.dedup import RecentUrls
+from rejubot.storage import UrlEntry
+from rejubot.telegrambot import is_recent_duplicate
+
+NOW = datetime(2024, 6, 1, tzinfo=timezone.utc)
+CHANNELS = [-1001, -1002, -1003]
+
+
+def sample_messages(rows: int, checks: int) -> list[tuple[Message, str]]:
+    """
+    Half recently posted urls, half new ones
+    """
+    samples = []
+    for idx in range(checks):
+        if idx % 2:
+            row = rows - 1 - random.randrange(min(rows, 1000))
+            url = f"https://site{row % 5000}.example/post/{row}"
+        else:
+            url = f"https://new.example/{idx}"
+        message = Message(
+            message_id=idx,
+            date=NOW,
+            chat=Chat(id=CHANNELS[0], type="group"),
+            text=url,
+            from_user=User(id=1, first_name="Bench", is_bot=False),
+        )
+        samples.append((message, url))
+    return samples
+
+
+async def count_query(message: Message, url: str, session):
+    """
+    The check before the url hash
+    """
+    query = (
+        select(func.count("*"))
+        .where(UrlEntry.url == url)
+        .where(UrlEntry.created_at > message.date - timedelta(days=1))
+    )
+    return (await session.scalars(query)).first() > 0
+
+
+async def main(path: Path, rows: int, checks: int):
+    if not path.exists():
+        print(f"Generating {rows} rows in {path}")
+        generate_url_entries(path, rows, NOW, CHANNELS)
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    session_factory = async_sessionmaker(engine)
+    samples = sample_messages(rows, checks)
+    recent = RecentUrls()
+
+    async with session_factory() as session:
+        start = time.perf_counter()
+        await recent.warm_up(session, NOW)
+        print(
+            f"Warm up: {len(recent.posted)} urls in {time.perf_counter() - start:.3f}s"
+        )
+
+        for name, check in [
+            ("count over url", lambda m, u: count_query(m, u, session)),
+            ("indexed url hash", lambda m, u: is_recent_duplicate(m, u, session)),
+            (
+                "recent urls",
+                lambda m, u: is_recent_duplicate(m, u, session, recent),
+            ),
+        ]:
+            timings = Timings()
+            # The slow one gets less checks
+            for message, url in samples[: 20 if name == "count over url" else None]:
+                with timings.timed():
+                    await check(message, url)
+            print_summary(name, timings)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--checks", type=int, default=200)
+    parser.add_argument(
+        "--db", type=Path, default=Path(tempfile.gettempdir()) / "rejubot-dedup.db"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.db, args.rows, args.checks))
@@ -0,0 +1,81 @@
+"""
+Memory of the NDJSON export against loading all the entries like the html
+pages used to, on a big url_entries table.
+
+    python -m benchmarks.bench_export --rows 1000000
+
+The table is generated once in --db and reused by later runs.
+"""
+
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from benchmarks.common import generate_url_entries
+from rejubot.api import export_lines, json_default, links_query, parse_fields
+from rejubot.storage import UrlEntry
+
+NOW = datetime(2024, 6, 1, tzinfo=timezone.utc)
+CHANNELS = [-1001, -1002, -1003]
+
+
+async def load_all(session_factory, fields):
+    """
+    All the entries as ORM objects, then serialized
+    """
+    async with session_factory() as session:
+        entries = (await session.scalars(select(UrlEntry))).all()
+        for entry in entries:
+            yield (
+                json.dumps(
+                    {name: getattr(entry, name, None) for name in fields},
+                    default=json_default,
+                )
+                + "\n"
+            ).encode()
+
+
+async def measure(name: str, lines):
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = 0
+    async for line in lines:
+        size += len(line)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(
+        f"{name:<12} {elapsed:6.2f}s {size / 2**20:8.1f}MB exported "
+        f"peak memory={peak / 2**20:.1f}MB"
+    )
+
+
+async def main(path: Path, rows: int):
+    if not path.exists():
+        print(f"Generating {rows} rows in {path}")
+        generate_url_entries(path, rows, NOW, CHANNELS)
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    session_factory = async_sessionmaker(engine)
+    fields = parse_fields("id,channel_id,created_at,url,who,message")
+    await measure("load all", load_all(session_factory, fields))
+    await measure("export", export_lines(session_factory, links_query(fields), fields))
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument(
+        "--db", type=Path, default=Path(tempfile.gettempdir()) / "rejubot-export.db"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.db, args.rows))
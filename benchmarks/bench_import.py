@@ -0,0 +1,132 @@
+"""
+Import of a Telegram export: the previous loop, one message at a time with
+a commit each, against the streaming importer scraping concurrently and
+committing in batches, and against the import without scraping.
+
+    python -m benchmarks.bench_import --messages 500 --delay 0.05
+
+Every url is answered by the local stand-in server after --delay seconds.
+"""
+
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from benchmarks.common import StandInResolver, stand_in_server
+from rejubot.importer import import_export, iter_link_messages, to_message
+from rejubot.scraper import Scraper
+from rejubot.settings import ScraperSettings
+from rejubot.storage import Base
+from rejubot.telegrambot import process_urls
+
+START = int(datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp())
+HOSTS = ["www.elmundo.es", "github.com", "example.org", "news.ycombinator.com"]
+
+
+def write_export(path: Path, messages: int, port: int, delay: float):
+    def link(idx: int) -> dict:
+        host = HOSTS[idx % len(HOSTS)]
+        return {"type": "link", "text": f"http://{host}:{port}/{idx}?delay={delay}"}
+
+    def message(idx: int) -> dict:
+        links = [link(idx * 2), link(idx * 2 + 1)] if idx % 3 else []
+        return {
+            "id": idx,
+            "type": "message",
+            "date_unixtime": str(START + idx * 60),
+            "from": "Bench",
+            "text": ["hey ", *links],
+            "text_entities": [{"type": "plain", "text": "hey "}, *links],
+        }
+
+    with open(path, "w") as file:
+        json.dump(
+            dict(name="bench", messages=[message(idx) for idx in range(messages)]),
+            file,
+        )
+
+
+async def create_session_factory(path: Path) -> async_sessionmaker:
+    path.unlink(missing_ok=True)
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    return async_sessionmaker(engine, expire_on_commit=False)
+
+
+async def message_at_a_time(export: Path, session_factory, scraper):
+    """
+    What admin.import_urls did before, without the json.load and sort
+    """
+    async with session_factory() as session:
+        for _, msg in iter_link_messages(export):
+            message = to_message(msg, 1, "bench")
+            urls = [
+                entity["text"]
+                for entity in msg["text_entities"]
+                if entity["type"] == "link"
+            ]
+            for url in urls:
+                await process_urls(message, [url], session, scraper)
+            await session.commit()
+
+
+async def run(name: str, export: Path, db: Path, import_coro):
+    session_factory = await create_session_factory(db)
+    tracemalloc.start()
+    start = time.perf_counter()
+    await import_coro(session_factory)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    links = sum(len(msg["text_entities"]) - 1 for _, msg in iter_link_messages(export))
+    print(
+        f"{name:<25} {elapsed:7.2f}s {links / elapsed:8.1f} links/s "
+        f"peak={peak / 1024 / 1024:6.1f}MB"
+    )
+
+
+async def main(messages: int, delay: float, concurrency: int):
+    settings = ScraperSettings(max_concurrency=concurrency)
+    with tempfile.TemporaryDirectory() as tmp:
+        export, db = Path(tmp) / "result.json", Path(tmp) / "bench.db"
+        async with stand_in_server() as port:
+            write_export(export, messages, port, delay)
+            async with Scraper(settings, StandInResolver()) as scraper:
+                await run(
+                    "message at a time",
+                    export,
+                    db,
+                    lambda factory: message_at_a_time(export, factory, scraper),
+                )
+            async with Scraper(settings, StandInResolver()) as scraper:
+                await run(
+                    f"streaming, {concurrency} scrapes",
+                    export,
+                    db,
+                    lambda factory: import_export(
+                        export, 1, "bench", factory, scraper, concurrency
+                    ),
+                )
+            await run(
+                "streaming, no scraping",
+                export,
+                db,
+                lambda factory: import_export(export, 1, "bench", factory, None),
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--delay", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=16)
+    args = parser.parse_args()
+    asyncio.run(main(args.messages, args.delay, args.concurrency))
@@ -0,0 +1,92 @@
+"""
+Latency of the /links pages at different depths of a big url_entries
+table: the previous 7 days query over date(created_at), the keyset pages
+over (created_at, id) of all the channels and of one, and the link_days
+version check that answers cached pages and 304s.
+
+    python -m benchmarks.bench_links_page --rows 1000000
+
+The table is generated once in --db and reused by later runs.
+"""
+
+import argparse
+import asyncio
+import tempfile
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from pathlib import Path
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import joinedload
+
+from benchmarks.common import Timings, generate_url_entries, print_summary
+from rejubot.pagination import Cursor, page_query
+from rejubot.storage import UrlEntry
+from rejubot.webcache import links_version
+
+NOW = datetime(2024, 6, 1, tzinfo=timezone.utc)
+CHANNELS = [-1001, -1002, -1003]
+DEPTHS = [0, 30, 180, 600]
+
+
+async def date_page(session, partial_after):
+    """
+    The page before the keyset pagination
+    """
+    query = select(func.date(UrlEntry.created_at))
+    if partial_after:
+        query = query.where(func.date(UrlEntry.created_at) < partial_after)
+    query = query.distinct().order_by(func.date(UrlEntry.created_at).desc()).limit(7)
+    days = (await session.scalars(query)).all()
+    query = (
+        select(UrlEntry)
+        .where(func.date(UrlEntry.created_at).between(days[-1], days[0]))
+        .order_by(UrlEntry.created_at.desc())
+    ).options(joinedload(UrlEntry.video))
+    return (await session.scalars(query)).all()
+
+
+async def keyset_page(session, cursor, page_size, channel_id=None):
+    return (await session.scalars(page_query(cursor, page_size, channel_id))).all()
+
+
+async def main(path: Path, rows: int, repeat: int, page_size: int):
+    if not path.exists():
+        print(f"Generating {rows} rows in {path}")
+        generate_url_entries(path, rows, NOW, CHANNELS)
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    session_factory = async_sessionmaker(engine)
+    async with session_factory() as session:
+        for depth in DEPTHS:
+            day = (NOW - timedelta(days=depth)).date()
+            partial_after = day.isoformat() if depth else None
+            cursor = Cursor.before_day(day) if depth else None
+            for name, page in [
+                ("date()", partial(date_page, session, partial_after)),
+                ("keyset", partial(keyset_page, session, cursor, page_size)),
+                (
+                    "channel keyset",
+                    partial(keyset_page, session, cursor, page_size, CHANNELS[0]),
+                ),
+                ("version check", partial(links_version, session, day)),
+            ]:
+                timings = Timings()
+                for _ in range(repeat):
+                    with timings.timed():
+                        await page()
+                print_summary(f"{name} {depth} days back", timings)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument(
+        "--db", type=Path, default=Path(tempfile.gettempdir()) / "rejubot-links.db"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.db, args.rows, args.repeat, args.page_size))
@@ -0,0 +1,75 @@
+"""
+Micro-benchmark of the Open Graph extraction: the single pass meta tag
+parser against the BeautifulSoup tree with one search per tag it replaced.
+
+    python -m benchmarks.bench_opengraph --rounds 50
+"""
+
+import argparse
+import time
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+from rejubot.opengraph import parse_og_metadata
+
+HTML_FIXTURES = Path(__file__).parent.parent / "tests" / "fixtures" / "html"
+URL = "https://example.com/page"
+
+
+def beautifulsoup_og_metadata(html: str, url: str):
+    soup = BeautifulSoup(html, "html.parser")
+    gets = lambda prop: (m := soup.find("meta", property=prop)) and m.get("content")
+    gets_name = lambda n: (
+        (m := soup.find("meta", attrs=dict(name=n))) and m.get("content")
+    )
+    if url.startswith("https://vxtwitter.com"):
+        values = [gets_name("twitter:title"), gets_name("twitter:image")]
+    else:
+        values = [gets("og:site_name"), gets("og:title"), gets("og:image")]
+    for prop in [
+        "og:video",
+        "og:video:type",
+        "og:video:width",
+        "og:video:height",
+        "og:description",
+    ]:
+        values.append(gets(prop))
+    return values
+
+
+def news_page(articles: int) -> str:
+    """
+    A heavy page: metadata in the head, a lot of markup after it
+    """
+    head = (HTML_FIXTURES / "blog.html").read_text().split("<body>")[0]
+    article = "<article><h2>Headline</h2><p>" + "Lorem ipsum dolor. " * 30
+    article += '</p><a href="/more">More</a></article>'
+    return head + "<body>" + article * articles + "</body></html>"
+
+
+def measure(name: str, function, documents: dict[str, str], rounds: int):
+    for doc_name, html in documents.items():
+        start = time.perf_counter()
+        for _ in range(rounds):
+            function(html, URL)
+        elapsed = (time.perf_counter() - start) / rounds
+        print(f"{name:<15} {doc_name:<25} {elapsed * 1000:9.3f}ms/doc")
+
+
+def main(rounds: int):
+    documents = {path.name: path.read_text() for path in HTML_FIXTURES.glob("*.html")}
+    documents["news (300KB)"] = news_page(1000)
+    documents["news (3MB)"] = news_page(10000)
+    for name, function in [
+        ("beautifulsoup", beautifulsoup_og_metadata),
+        ("single pass", parse_og_metadata),
+    ]:
+        measure(name, function, documents, rounds)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+    main(args.rounds)
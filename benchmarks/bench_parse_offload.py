@@ -0,0 +1,90 @@
+"""
+Event loop lag during a burst of link scrapes, parsing the html in the
+event loop, in a thread pool and in a process pool.
+
+    python -m benchmarks.bench_parse_offload --links 40 --workers 4
+
+The pages have a 1MB head full of markup, the worst case for the parser.
+"""
+
+import argparse
+import asyncio
+import time
+
+from aiohttp import web
+
+from benchmarks.common import stand_in_server
+from rejubot.monitoring import LoopLagMonitor
+from rejubot.scraper import Scraper, scrape_og_metadata
+from rejubot.settings import ScraperSettings
+
+HEAVY_HEAD = (
+    "<html><head>"
+    + '<link rel="preload" href="/asset.js" as="script">' * 20_000
+    + '<meta property="og:title" content="Heavy head">'
+    + "</head><body></body></html>"
+)
+
+
+def create_app() -> web.Application:
+    async def page(request):
+        return web.Response(text=HEAVY_HEAD, content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", page)
+    return app
+
+
+async def burst(settings: ScraperSettings, port: int, links: int):
+    monitor = LoopLagMonitor(interval=0.005, warning=float("inf"))
+    async with Scraper(settings) as scraper:
+        # Warm up the pool, spawning processes is not part of the burst
+        await scrape_og_metadata(f"http://127.0.0.1:{port}/warmup", scraper)
+        await monitor.start()
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                scrape_og_metadata(f"http://127.0.0.1:{port}/{idx}", scraper)
+                for idx in range(links)
+            )
+        )
+        elapsed = time.perf_counter() - start
+        await monitor.stop()
+    return elapsed, monitor.summary()
+
+
+async def main(links: int, workers: int):
+    max_html_bytes = len(HEAVY_HEAD)
+    async with stand_in_server(create_app()) as port:
+        for name, settings in [
+            ("event loop", ScraperSettings(max_html_bytes=max_html_bytes)),
+            (
+                f"{workers} threads",
+                ScraperSettings(
+                    max_html_bytes=max_html_bytes,
+                    parse_workers=workers,
+                    parse_executor="thread",
+                ),
+            ),
+            (
+                f"{workers} processes",
+                ScraperSettings(
+                    max_html_bytes=max_html_bytes,
+                    parse_workers=workers,
+                    parse_executor="process",
+                ),
+            ),
+        ]:
+            elapsed, lag = await burst(settings, port, links)
+            print(
+                f"{name:<15} total={elapsed:6.2f}s lag p95={lag['p95'] * 1000:8.1f}ms "
+                f"max={lag['max'] * 1000:8.1f}ms samples={lag['samples']}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--links", type=int, default=40)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+    asyncio.run(main(args.links, args.workers))
@@ -0,0 +1,82 @@
+"""
+Per url latency of a fresh ClientSession per scrape against the shared,
+pooled Scraper, for urls repeating the same few hosts.
+
+    python -m benchmarks.bench_pooled_client --urls 200 --dns-delay 0.02
+"""
+
+import argparse
+import asyncio
+
+import aiohttp
+
+from benchmarks.common import StandInResolver, Timings, print_summary, stand_in_server
+from rejubot.scraper import HEADERS, Scraper, scrape_og_metadata
+from rejubot.settings import ScraperSettings
+
+HOSTS = ["youtube.com", "vxtwitter.com", "www.elmundo.es", "github.com"]
+
+
+def build_urls(port: int, count: int) -> list[str]:
+    return [
+        f"http://{HOSTS[idx % len(HOSTS)]}:{port}/watch?v={idx}" for idx in range(count)
+    ]
+
+
+async def session_per_url(urls: list[str], dns_delay: float) -> Timings:
+    """
+    What the bot did before: a brand new session, connector and DNS lookup
+    for every url.
+    """
+    timings = Timings()
+    for url in urls:
+        with timings.timed():
+            connector = aiohttp.TCPConnector(resolver=StandInResolver(dns_delay))
+            async with aiohttp.ClientSession(
+                connector=connector, timeout=aiohttp.ClientTimeout(20)
+            ) as session:
+                async with session.get(url, headers=HEADERS) as response:
+                    await response.read()
+    return timings
+
+
+async def shared_scraper(urls: list[str], dns_delay: float) -> Timings:
+    timings = Timings()
+    async with Scraper(ScraperSettings(), StandInResolver(dns_delay)) as scraper:
+        for url in urls:
+            with timings.timed():
+                async with scraper.session.get(url) as response:
+                    await response.read()
+    return timings
+
+
+async def shared_scraper_full(urls: list[str], dns_delay: float) -> Timings:
+    """
+    The same, including the parsing done by scrape_og_metadata
+    """
+    timings = Timings()
+    async with Scraper(ScraperSettings(), StandInResolver(dns_delay)) as scraper:
+        for url in urls:
+            with timings.timed():
+                await scrape_og_metadata(url, scraper)
+    return timings
+
+
+async def main(count: int, dns_delay: float):
+    async with stand_in_server() as port:
+        urls = build_urls(port, count)
+        print_summary("session per url", await session_per_url(urls, dns_delay))
+        print_summary("shared scraper", await shared_scraper(urls, dns_delay))
+        print_summary(
+            "shared scraper + parsing", await shared_scraper_full(urls, dns_delay)
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--urls", type=int, default=200)
+    parser.add_argument(
+        "--dns-delay", type=float, default=0.02, help="Simulated DNS lookup, seconds"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.urls, args.dns_delay))
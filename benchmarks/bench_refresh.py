@@ -0,0 +1,96 @@
+"""
+Refresh of already scraped urls: downloading every page again against
+revalidating the cached pages with their ETag, when most of them didn't
+change.
+
+    python -m benchmarks.bench_refresh --urls 300 --changed 0.1 --delay 0.02
+
+Bytes sent are counted by the stand-in server. Pages have a 50KB head of
+inline scripts, like most news sites.
+"""
+
+import argparse
+import asyncio
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from aiohttp import web
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from benchmarks.common import stand_in_server
+from rejubot.cache import MetadataCache
+from rejubot.scraper import Scraper, scrape_og_metadata
+from rejubot.settings import CacheSettings, ScraperSettings
+from rejubot.storage import Base
+
+HEAD = """<html><head><title>News</title>
+<meta property="og:title" content="News {path} v{version}">
+<meta property="og:image" content="http://news.example/image.png">
+{scripts}
+</head><body><p>Article</p></body></html>"""
+SCRIPTS = "<script>var a=1;</script>" * 2000
+
+
+def create_app(versions: dict[str, int], sent: Counter, delay: float):
+    async def page(request: web.Request) -> web.Response:
+        await asyncio.sleep(delay)
+        version = versions.get(request.path, 0)
+        etag = f'"{version}"'
+        if request.headers.get("If-None-Match") == etag:
+            sent["not_modified"] += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        body = HEAD.format(path=request.path, version=version, scripts=SCRIPTS)
+        sent["bytes"] += len(body)
+        sent["pages"] += 1
+        return web.Response(text=body, content_type="text/html", headers={"ETag": etag})
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", page)
+    return app
+
+
+async def refresh(name: str, urls: list[str], scraper: Scraper, sent: Counter):
+    sent.clear()
+    start = time.perf_counter()
+    await asyncio.gather(*(scrape_og_metadata(url, scraper, True) for url in urls))
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name:<15} {elapsed:6.2f}s pages={sent['pages']:<5} "
+        f"not modified={sent['not_modified']:<5} sent={sent['bytes'] / 2**20:6.1f}MB"
+    )
+
+
+async def main(count: int, changed: float, delay: float):
+    versions, sent = {}, Counter()
+    settings = ScraperSettings()
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{Path(tmp) / 'bench.db'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        cache = MetadataCache(CacheSettings(), async_sessionmaker(engine))
+
+        async with stand_in_server(create_app(versions, sent, delay)) as port:
+            urls = [f"http://127.0.0.1:{port}/news/{idx}" for idx in range(count)]
+            async with Scraper(settings, cache=cache) as scraper:
+                await refresh("first scrape", urls, scraper, sent)
+            for idx in range(int(count * changed)):
+                versions[f"/news/{idx}"] = 1
+
+            async with Scraper(settings) as scraper:
+                await refresh("full download", urls, scraper, sent)
+            async with Scraper(settings, cache=cache) as scraper:
+                await refresh("revalidation", urls, scraper, sent)
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--urls", type=int, default=300)
+    parser.add_argument(
+        "--changed", type=float, default=0.1, help="Part of the pages that changed"
+    )
+    parser.add_argument("--delay", type=float, default=0.02)
+    args = parser.parse_args()
+    asyncio.run(main(args.urls, args.changed, args.delay))
@@ -0,0 +1,73 @@
+"""
+Full text search against the LIKE scans it replaces, on a big url_entries
+table, for rare and common words.
+
+    python -m benchmarks.bench_search --rows 1000000
+
+The table is generated once in --db and reused by later runs.
+"""
+
+import argparse
+import asyncio
+import tempfile
+from datetime import datetime, timezone
+from functools import partial
+from pathlib import Path
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from benchmarks.common import Timings, generate_url_entries, print_summary
+from rejubot.search import search
+from rejubot.storage import UrlEntry
+
+NOW = datetime(2024, 6, 1, tzinfo=timezone.utc)
+CHANNELS = [-1001, -1002, -1003]
+QUERIES = ["word4321", "word2 word4321", "word0", "word12"]
+
+
+async def like_search(session, text: str):
+    query = (
+        select(UrlEntry)
+        .where(UrlEntry.og_title.like(f"%{text}%"))
+        .order_by(UrlEntry.created_at.desc())
+        .limit(20)
+    )
+    return (await session.scalars(query)).all()
+
+
+async def fts_search(session, text: str, sort: str):
+    return await search(session, text, sort=sort)
+
+
+async def main(path: Path, rows: int, repeat: int):
+    if not path.exists():
+        print(f"Generating {rows} rows in {path}")
+        generate_url_entries(path, rows, NOW, CHANNELS)
+
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    session_factory = async_sessionmaker(engine)
+    async with session_factory() as session:
+        for text in QUERIES:
+            for name, search in [
+                ("like", partial(like_search, session, text.split()[-1])),
+                ("fts rank", partial(fts_search, session, text, "rank")),
+                ("fts recent", partial(fts_search, session, text, "recent")),
+            ]:
+                timings = Timings()
+                for _ in range(repeat):
+                    with timings.timed():
+                        await search()
+                print_summary(f"{name} {text}", timings)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--db", type=Path, default=Path(tempfile.gettempdir()) / "rejubot-search.db"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.db, args.rows, args.repeat))
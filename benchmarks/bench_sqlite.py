@@ -0,0 +1,147 @@
+"""
+Concurrent reads and writes on the same SQLite file, like the web and the
+bot do: readers loading /links pages and a slow NDJSON export, and a writer
+committing a message at a time.
+
+    python -m benchmarks.bench_sqlite --rows 200000 --seconds 10
+
+Runs twice over copies of the same database: with the default engine and
+rollback journal, and with the [database] settings (WAL, pragmas, read only
+pool for the readers and the single connection writer).
+"""
+
+import argparse
+import asyncio
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+
+from benchmarks.common import Timings, generate_url_entries, print_summary
+from rejubot.pagination import page_query
+from rejubot.settings import DatabaseSettings
+from rejubot.storage import UrlEntry, create_engine
+
+NOW = datetime(2024, 6, 1, tzinfo=timezone.utc)
+CHANNELS = [-1001, -1002, -1003]
+
+
+async def write(engine: AsyncEngine, deadline: float, timings: Timings, errors: list):
+    session_factory = async_sessionmaker(engine)
+    idx = 0
+    while time.monotonic() < deadline:
+        idx += 1
+        try:
+            with timings.timed():
+                async with session_factory() as session:
+                    session.add(
+                        UrlEntry(
+                            channel_id=CHANNELS[0],
+                            message_id=idx,
+                            created_at=datetime.now(timezone.utc),
+                            who="bench",
+                            who_id=1,
+                            url=f"https://new.example/{idx}",
+                            message=f"New message {idx}",
+                            og_title=f"New title {idx}",
+                        )
+                    )
+                    await session.commit()
+        except OperationalError as error:
+            errors.append(error)
+        await asyncio.sleep(0.005)
+
+
+async def read_pages(
+    engine: AsyncEngine, deadline: float, timings: Timings, errors: list
+):
+    session_factory = async_sessionmaker(engine)
+    while time.monotonic() < deadline:
+        try:
+            with timings.timed():
+                async with session_factory() as session:
+                    (await session.scalars(page_query(None, 100))).all()
+        except OperationalError as error:
+            errors.append(error)
+        await asyncio.sleep(0.01)
+
+
+async def read_export(
+    engine: AsyncEngine, deadline: float, timings: Timings, errors: list
+):
+    """
+    Streams the whole table slowly, keeping a read transaction open
+    """
+    session_factory = async_sessionmaker(engine)
+    while time.monotonic() < deadline:
+        try:
+            with timings.timed():
+                async with session_factory() as session:
+                    rows = await session.stream_scalars(
+                        select(UrlEntry.url).execution_options(yield_per=1000)
+                    )
+                    async for partition in rows.partitions():
+                        await asyncio.sleep(0.002)
+                        if time.monotonic() > deadline:
+                            break
+        except OperationalError as error:
+            errors.append(error)
+
+
+async def run(name: str, path: Path, seconds: float, readers: int, tuned: bool):
+    settings = DatabaseSettings()
+    url = f"sqlite+aiosqlite:///{path}"
+    if tuned:
+        writer = create_engine(url, settings, writer=True)
+        reader = create_engine(url, settings, read_only=True)
+    else:
+        writer = reader = create_async_engine(url)
+
+    writes, pages, exports = Timings(), Timings(), Timings()
+    write_errors, read_errors = [], []
+    deadline = time.monotonic() + seconds
+    await asyncio.gather(
+        write(writer, deadline, writes, write_errors),
+        read_export(reader, deadline, exports, read_errors),
+        *(read_pages(reader, deadline, pages, read_errors) for _ in range(readers)),
+    )
+    await writer.dispose()
+    await reader.dispose()
+
+    print(f"{name}: {len(writes.values) / seconds:.1f} commits/s")
+    print_summary("  commit", writes)
+    print(f"  {'commit max':<28} {max(writes.values) * 1000:8.2f}ms")
+    print_summary("  links page", pages)
+    print(f"  {'links page max':<28} {max(pages.values) * 1000:8.2f}ms")
+    print(f"  {len(exports.values)} exports finished")
+    for kind, errors in [("writing", write_errors), ("reading", read_errors)]:
+        if errors:
+            print(f"  {len(errors)} errors {kind}: {errors[0].orig}")
+
+
+def main(rows: int, seconds: float, readers: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        base = Path(tmp) / "base.db"
+        print(f"Generating {rows} rows")
+        generate_url_entries(base, rows, NOW, CHANNELS)
+        for name, tuned in [("default", False), ("tuned", True)]:
+            path = Path(tmp) / f"{name}.db"
+            shutil.copy(base, path)
+            # Both start from the rollback journal of a new database
+            sqlite3.connect(path).execute("PRAGMA journal_mode = delete").close()
+            asyncio.run(run(name, path, seconds, readers, tuned))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--readers", type=int, default=4)
+    args = parser.parse_args()
+    main(args.rows, args.seconds, args.readers)
@@ -0,0 +1,111 @@
+"""
+Buffered fetch (read the whole body, then parse) against the streaming
+fetch that stops after </head>, for heavy local fixtures.
+
+    python -m benchmarks.bench_streaming_fetch --rounds 5
+
+Bytes sent are counted by the stand-in server, so they include what ended
+in the socket buffers before the client closed the connection.
+"""
+
+import argparse
+import asyncio
+import tracemalloc
+
+from aiohttp import web
+
+from benchmarks.common import Timings, print_summary, stand_in_server
+from rejubot.scraper import (
+    Scraper,
+    fetch_og_metadata,
+    scrape_og_metadata_html,
+)
+from rejubot.settings import ScraperSettings
+
+HEAD = """<html><head><title>News</title>
+<meta property="og:site_name" content="News">
+<meta property="og:title" content="Heavy news page">
+<meta property="og:description" content="With a lot of markup after the head">
+<meta property="og:image" content="http://news.example/image.png">
+{scripts}
+</head>"""
+ARTICLE = (
+    "<article><h2>Headline</h2><p>"
+    + "Lorem ipsum dolor sit amet. " * 40
+    + "</p></article>"
+)
+
+FIXTURES = {
+    # A 5MB news page with 50KB of inline scripts in the head
+    "/news": ("text/html", HEAD.format(scripts="<script>var a=1;</script>" * 2000), 5),
+    # A big download served as html, without any head
+    "/mislabelled": ("text/html; charset=utf-8", "<html>", 40),
+    "/image.jpg": ("image/jpeg", "", 20),
+    "/video.mp4": ("video/mp4", "", 40),
+}
+
+
+def create_app(sent: dict[str, int]) -> web.Application:
+    async def fixture(request: web.Request) -> web.StreamResponse:
+        content_type, head, megabytes = FIXTURES[request.path]
+        response = web.StreamResponse(headers={"Content-Type": content_type})
+        await response.prepare(request)
+        chunk = (ARTICLE * (64 * 1024 // len(ARTICLE))).encode()
+        body = head.encode()
+        try:
+            await response.write(body)
+            sent[request.path] += len(body)
+            while sent[request.path] < megabytes * 1024 * 1024:
+                await response.write(chunk)
+                sent[request.path] += len(chunk)
+            await response.write_eof()
+        except (ConnectionResetError, ConnectionError):
+            pass
+        return response
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", fixture)
+    return app
+
+
+async def buffered(url: str, scraper: Scraper):
+    """
+    The fetch before streaming: the whole body in memory
+    """
+    async with scraper.session.get(url) as response:
+        content_type = response.headers.get("Content-Type")
+        await response.read()
+        if content_type.startswith("text/html"):
+            await scrape_og_metadata_html(await response.text(errors="ignore"), url)
+
+
+async def measure(name: str, fetch, url: str, rounds: int, sent: dict[str, int]):
+    path = url[url.index("/", 8) :]
+    timings = Timings()
+    peak = 0
+    async with Scraper(ScraperSettings(timeout=120)) as scraper:
+        for _ in range(rounds):
+            sent[path] = 0
+            tracemalloc.start()
+            with timings.timed():
+                await fetch(url, scraper)
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+    print_summary(f"{name} {path}", timings)
+    print(f"{'':<30} peak memory={peak / 2**20:.1f}MB sent={sent[path] / 2**20:.1f}MB")
+
+
+async def main(rounds: int):
+    sent = {path: 0 for path in FIXTURES}
+    async with stand_in_server(create_app(sent)) as port:
+        for path in FIXTURES:
+            url = f"http://127.0.0.1:{port}{path}"
+            await measure("buffered", buffered, url, rounds, sent)
+            await measure("streaming", fetch_og_metadata, url, rounds, sent)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.rounds))
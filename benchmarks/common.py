@@ -0,0 +1,176 @@
+"""
+Helpers shared by the benchmarks.
+
+The stand-in server answers for any hostname, so urls like
+``http://youtube.com:<port>/watch`` can be scraped without network by
+pairing it with ``StandInResolver``.
+"""
+
+import asyncio
+import random
+import socket
+import sqlite3
+import statistics
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+from sqlalchemy import create_engine
+
+from rejubot.storage import Base, url_hash
+
+PAGE = """<html><head>
+<meta property="og:site_name" content="{host}">
+<meta property="og:title" content="Title for {path}">
+<meta property="og:description" content="Description for {path}">
+<meta property="og:image" content="http://{host}/image.png">
+</head><body><p>Stand-in page</p></body></html>"""
+
+
+class StandInResolver(AbstractResolver):
+    """
+    Resolves every hostname to localhost, with an optional delay to
+    simulate a real DNS lookup.
+    """
+
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.lookups = 0
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        self.lookups += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return [
+            dict(
+                hostname=host,
+                host="127.0.0.1",
+                port=port,
+                family=socket.AF_INET,
+                proto=0,
+                flags=socket.AI_NUMERICHOST,
+            )
+        ]
+
+    async def close(self):
+        pass
+
+
+async def og_page(request: web.Request) -> web.Response:
+    delay = float(request.query.get("delay", 0))
+    if delay:
+        await asyncio.sleep(delay)
+    body = PAGE.format(host=request.host, path=request.path_qs)
+    return web.Response(text=body, content_type="text/html")
+
+
+def create_stand_in_app() -> web.Application:
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", og_page)
+    return app
+
+
+@asynccontextmanager
+async def stand_in_server(app: web.Application | None = None):
+    """
+    Run the stand-in server on a random local port, yields the port
+    """
+    runner = web.AppRunner(app or create_stand_in_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    try:
+        yield port
+    finally:
+        await runner.cleanup()
+
+
+class Timings:
+    """
+    Collects durations in seconds and summarizes them in milliseconds
+    """
+
+    def __init__(self):
+        self.values: list[float] = []
+
+    def timed(self):
+        timings = self
+
+        class _Timer:
+            def __enter__(self):
+                self.start = time.perf_counter()
+
+            def __exit__(self, *exc_info):
+                timings.values.append(time.perf_counter() - self.start)
+
+        return _Timer()
+
+    def summary(self) -> dict[str, float]:
+        values = sorted(self.values)
+        p95 = values[min(len(values) - 1, int(len(values) * 0.95))]
+        return dict(
+            count=len(values),
+            mean_ms=statistics.fmean(values) * 1000,
+            p50_ms=statistics.median(values) * 1000,
+            p95_ms=p95 * 1000,
+        )
+
+
+def print_summary(name: str, timings: Timings):
+    summary = timings.summary()
+    print(
+        f"{name:<30} n={summary['count']:<5} mean={summary['mean_ms']:8.2f}ms "
+        f"p50={summary['p50_ms']:8.2f}ms p95={summary['p95_ms']:8.2f}ms"
+    )
+
+
+# Zipf like vocabulary for the titles, word0 is the most common
+WORDS = [f"word{idx}" for idx in range(5000) for _ in range(max(1, 50 // (idx + 1)))]
+
+
+def generate_url_entries(path: Path, rows: int, now: datetime, channels: list[int]):
+    """
+    Create the database with url entries spread over the two years before now
+    """
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    engine.dispose()
+
+    insert = (
+        "INSERT INTO url_entries (channel_id, message_id, created_at, created_day, "
+        "url, url_hash, who, who_id, message, message_text, og_title) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    )
+    rng = random.Random(rows)
+    connection = sqlite3.connect(path)
+    start = now - timedelta(days=2 * 365)
+    step = (now - start) / rows
+    batch = []
+    for idx in range(rows):
+        url = f"https://site{idx % 5000}.example/post/{idx}"
+        created_at = start + step * idx
+        batch.append(
+            (
+                channels[idx % len(channels)],
+                idx,
+                created_at.strftime("%Y-%m-%d %H:%M:%S.%f"),
+                created_at.strftime("%Y-%m-%d"),
+                url,
+                url_hash(url),
+                "who",
+                1,
+                "msg",
+                "msg",
+                " ".join(rng.choices(WORDS, k=6)),
+            )
+        )
+        if len(batch) == 50_000:
+            connection.executemany(insert, batch)
+            batch = []
+    connection.executemany(insert, batch)
+    connection.commit()
+    connection.close()
@@ -0,0 +1,312 @@
+"""
+Benchmark suite of the scraper, with results in JSON and regression
+thresholds.
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --baseline results.json --tolerance 0.25
+
+Scenarios:
+
+* parse.<document>: scrape_og_metadata_html over the html fixtures of the
+  tests and generated news pages
+* telegram_urls: get_telegram_urls over synthetic messages
+* scrape.<kind>: scrape_og_metadata against the local server, with
+  latency, large bodies, slow drip responses and redirects
+
+Every scenario reports its throughput (operations/s) and latencies. A
+scenario fails when it is under min_throughput or over max_p95_ms of
+benchmarks/thresholds.json, or, with --baseline, when it is more than
+--tolerance worse than the same scenario in a previous results file. The
+exit status is 1 when any scenario fails.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sys
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+
+from aiohttp import web
+from telegram import Chat, Message, MessageEntity, User
+
+from benchmarks.bench_opengraph import HTML_FIXTURES, news_page
+from benchmarks.common import Timings, stand_in_server
+from rejubot.scraper import Scraper, scrape_og_metadata, scrape_og_metadata_html
+from rejubot.settings import ScraperSettings
+from rejubot.telegrambot import get_telegram_urls
+
+THRESHOLDS = Path(__file__).parent / "thresholds.json"
+URL = "https://example.com/page"
+HEAD = """<html><head><title>{path}</title>
+<meta property="og:site_name" content="Suite">
+<meta property="og:title" content="Title for {path}">
+<meta property="og:description" content="Description for {path}">
+<meta property="og:image" content="http://suite.example/image.png">
+</head>"""
+BODY = "<p>" + "Lorem ipsum dolor sit amet. " * 40 + "</p>"
+
+
+@dataclass
+class Result:
+    count: int
+    throughput: float
+    mean_ms: float
+    p50_ms: float
+    p95_ms: float
+
+    @classmethod
+    def from_timings(cls, timings: Timings, elapsed: float) -> "Result":
+        summary = timings.summary()
+        return cls(
+            count=summary["count"],
+            throughput=summary["count"] / elapsed,
+            mean_ms=summary["mean_ms"],
+            p50_ms=summary["p50_ms"],
+            p95_ms=summary["p95_ms"],
+        )
+
+
+def parse_documents() -> dict[str, str]:
+    documents = {
+        path.stem: path.read_text() for path in sorted(HTML_FIXTURES.glob("*.html"))
+    }
+    documents["news_300kb"] = news_page(1000)
+    documents["news_3mb"] = news_page(10000)
+    return documents
+
+
+async def bench_parse(html: str, rounds: int) -> Result:
+    timings = Timings()
+    start = time.perf_counter()
+    for _ in range(rounds):
+        with timings.timed():
+            await scrape_og_metadata_html(html, URL)
+    return Result.from_timings(timings, time.perf_counter() - start)
+
+
+def telegram_messages(count: int) -> list[Message]:
+    """
+    Chat messages with some text and up to 5 links each
+    """
+    rng = random.Random(count)
+    words = ["look", "this", "lol", "news", "again", "no way", "😀", "ñandú"]
+    messages = []
+    for idx in range(count):
+        text, entities = "", []
+        for link in range(rng.randint(0, 5)):
+            text += " ".join(rng.choices(words, k=rng.randint(1, 10))) + " "
+            url = f"https://site{rng.randint(0, 50)}.example/post/{idx}/{link}"
+            # Offsets are in UTF-16 code units
+            offset = len(text.encode("utf-16-le")) // 2
+            entities.append(MessageEntity(MessageEntity.URL, offset, len(url)))
+            text += url + " "
+        text += " ".join(rng.choices(words, k=rng.randint(1, 10)))
+        messages.append(
+            Message(
+                message_id=idx,
+                date=datetime(2024, 1, 1, tzinfo=timezone.utc),
+                chat=Chat(id=1, type="group"),
+                text=text,
+                entities=entities,
+                from_user=User(id=1, first_name="Bench", is_bot=False),
+            )
+        )
+    return messages
+
+
+def bench_telegram_urls(messages: list[Message]) -> Result:
+    timings = Timings()
+    start = time.perf_counter()
+    for message in messages:
+        with timings.timed():
+            get_telegram_urls(message)
+    return Result.from_timings(timings, time.perf_counter() - start)
+
+
+def create_app() -> web.Application:
+    async def latency(request: web.Request) -> web.Response:
+        await asyncio.sleep(float(request.query.get("delay", 0.05)))
+        body = HEAD.format(path=request.path) + "<body>" + BODY + "</body></html>"
+        return web.Response(text=body, content_type="text/html")
+
+    async def large(request: web.Request) -> web.StreamResponse:
+        """
+        5MB page, the head first
+        """
+        response = web.StreamResponse(headers={"Content-Type": "text/html"})
+        await response.prepare(request)
+        chunk = (BODY * 100).encode()
+        try:
+            await response.write(HEAD.format(path=request.path).encode())
+            for _ in range(5 * 2**20 // len(chunk)):
+                await response.write(chunk)
+            await response.write_eof()
+        except ConnectionError:
+            pass
+        return response
+
+    async def drip(request: web.Request) -> web.StreamResponse:
+        """
+        The head in 256 byte chunks, 10ms apart
+        """
+        response = web.StreamResponse(headers={"Content-Type": "text/html"})
+        await response.prepare(request)
+        page = (HEAD.format(path=request.path) + "<body>" + BODY).encode()
+        try:
+            for pos in range(0, len(page), 256):
+                await response.write(page[pos : pos + 256])
+                await asyncio.sleep(0.01)
+            await response.write_eof()
+        except ConnectionError:
+            pass
+        return response
+
+    async def redirect(request: web.Request) -> web.Response:
+        hops = int(request.match_info["hops"])
+        if hops == 0:
+            return await latency(request)
+        raise web.HTTPFound(f"/redirect/{hops - 1}/{request.match_info['tail']}")
+
+    app = web.Application()
+    app.router.add_get("/latency/{tail:.*}", latency)
+    app.router.add_get("/large/{tail:.*}", large)
+    app.router.add_get("/drip/{tail:.*}", drip)
+    app.router.add_get("/redirect/{hops:\\d+}/{tail:.*}", redirect)
+    return app
+
+
+SCRAPES = {
+    "latency": "/latency/{idx}?delay=0.05",
+    "large": "/large/{idx}",
+    "drip": "/drip/{idx}",
+    "redirect": "/redirect/3/{idx}?delay=0.01",
+}
+
+
+async def bench_scrape(port: int, path: str, count: int, concurrency: int) -> Result:
+    timings = Timings()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def scrape(idx: int):
+        async with semaphore:
+            with timings.timed():
+                metadata = await scrape_og_metadata(
+                    f"http://127.0.0.1:{port}{path.format(idx=idx)}", scraper
+                )
+            assert metadata is not None and metadata.title, path
+
+    async with Scraper(ScraperSettings(timeout=60)) as scraper:
+        start = time.perf_counter()
+        await asyncio.gather(*(scrape(idx) for idx in range(count)))
+        return Result.from_timings(timings, time.perf_counter() - start)
+
+
+async def bench_scrapes(count: int, concurrency: int, only: str) -> dict[str, Result]:
+    results = {}
+    async with stand_in_server(create_app()) as port:
+        for kind, path in SCRAPES.items():
+            if only in f"scrape.{kind}":
+                results[f"scrape.{kind}"] = await bench_scrape(
+                    port, path, count, concurrency
+                )
+    return results
+
+
+def run_suite(quick: bool, only: str) -> dict[str, Result]:
+    rounds = 20 if quick else 200
+    results = {}
+    for name, html in parse_documents().items():
+        if only in f"parse.{name}":
+            doc_rounds = max(3, rounds // 20) if len(html) > 2**20 else rounds
+            results[f"parse.{name}"] = asyncio.run(bench_parse(html, doc_rounds))
+    if only in "telegram_urls":
+        messages = telegram_messages(500 if quick else 5000)
+        results["telegram_urls"] = bench_telegram_urls(messages)
+    results.update(
+        asyncio.run(bench_scrapes(50 if quick else 200, 20, only)),
+    )
+    return results
+
+
+def check(
+    results: dict[str, Result],
+    thresholds: dict[str, dict[str, float]],
+    baseline: dict[str, dict] | None,
+    tolerance: float,
+) -> list[str]:
+    failures = []
+    for name, result in results.items():
+        limits = thresholds.get(name, {})
+        if result.throughput < limits.get("min_throughput", 0):
+            failures.append(
+                f"{name}: {result.throughput:.1f}/s under {limits['min_throughput']}/s"
+            )
+        if result.p95_ms > limits.get("max_p95_ms", float("inf")):
+            failures.append(
+                f"{name}: p95 {result.p95_ms:.2f}ms over {limits['max_p95_ms']}ms"
+            )
+        if baseline is None or name not in baseline:
+            continue
+        before = baseline[name]
+        if result.throughput < before["throughput"] * (1 - tolerance):
+            failures.append(
+                f"{name}: {result.throughput:.1f}/s, was {before['throughput']:.1f}/s"
+            )
+        if result.p95_ms > before["p95_ms"] * (1 + tolerance):
+            failures.append(
+                f"{name}: p95 {result.p95_ms:.2f}ms, was {before['p95_ms']:.2f}ms"
+            )
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--output", type=Path, help="JSON file for the results")
+    parser.add_argument("--thresholds", type=Path, default=THRESHOLDS)
+    parser.add_argument("--baseline", type=Path, help="Results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--quick", action="store_true", help="Fewer rounds")
+    parser.add_argument("--only", default="", help="Scenarios containing this")
+    args = parser.parse_args()
+
+    results = run_suite(args.quick, args.only)
+    thresholds = json.loads(args.thresholds.read_text())
+    baseline = None
+    if args.baseline is not None:
+        baseline = json.loads(args.baseline.read_text())["results"]
+    failures = check(results, thresholds, baseline, args.tolerance)
+
+    for name, result in results.items():
+        print(
+            f"{name:<30} n={result.count:<6} {result.throughput:10.1f}/s "
+            f"p50={result.p50_ms:9.3f}ms p95={result.p95_ms:9.3f}ms"
+        )
+    for failure in failures:
+        print(f"FAILED {failure}")
+
+    if args.output is not None:
+        args.output.write_text(
+            json.dumps(
+                dict(
+                    created_at=datetime.now(timezone.utc).isoformat(),
+                    python=platform.python_version(),
+                    machine=platform.machine(),
+                    results={name: asdict(result) for name, result in results.items()},
+                    failures=failures,
+                ),
+                indent=2,
+            )
+            + "\n"
+        )
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
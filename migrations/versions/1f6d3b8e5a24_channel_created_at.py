@@ -0,0 +1,31 @@
+"""Index for the pages of a channel
+
+Revision ID: 1f6d3b8e5a24
+Revises: e2b9f46a0c17
+Create Date: 2024-03-09 17:21:33.915472+00:00
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "1f6d3b8e5a24"
+down_revision: Union[str, None] = "e2b9f46a0c17"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(
+        "ix_url_entries_channel_created_at",
+        "url_entries",
+        ["channel_id", "created_at"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_url_entries_channel_created_at", table_name="url_entries")
@@ -0,0 +1,62 @@
+"""Scrape jobs for the enrichment workers
+
+Revision ID: 3c5e0f9a2b71
+Revises: 871fe95af18a
+Create Date: 2024-02-03 18:12:40.118394+00:00
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "3c5e0f9a2b71"
+down_revision: Union[str, None] = "871fe95af18a"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "url_entries",
+        sa.Column(
+            "metadata_status",
+            sa.String(length=16),
+            server_default="done",
+            nullable=False,
+        ),
+    )
+    op.create_table(
+        "scrape_jobs",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("url_entry_id", sa.Integer(), nullable=False),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column(
+            "available_at",
+            sa.DateTime(),
+            server_default=sa.text("(CURRENT_TIMESTAMP)"),
+            nullable=False,
+        ),
+        sa.Column("claimed_at", sa.DateTime(), nullable=True),
+        sa.Column("last_error", sa.Text(), nullable=True),
+        sa.ForeignKeyConstraint(
+            ["url_entry_id"], ["url_entries.id"], ondelete="CASCADE"
+        ),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("url_entry_id"),
+    )
+    op.create_index(
+        op.f("ix_scrape_jobs_available_at"),
+        "scrape_jobs",
+        ["available_at"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_scrape_jobs_available_at"), table_name="scrape_jobs")
+    op.drop_table("scrape_jobs")
+    op.drop_column("url_entries", "metadata_status")
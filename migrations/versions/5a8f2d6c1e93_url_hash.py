@@ -0,0 +1,70 @@
+"""Url hash for the duplicated urls check
+
+Revision ID: 5a8f2d6c1e93
+Revises: 9d41b7c2e6f0
+Create Date: 2024-02-17 09:48:21.730554+00:00
+
+"""
+
+import hashlib
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "5a8f2d6c1e93"
+down_revision: Union[str, None] = "9d41b7c2e6f0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 10_000
+
+
+def url_hash(url: str) -> int:
+    # Same as rejubot.storage.url_hash when this migration was written
+    digest = hashlib.blake2b(url.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def upgrade() -> None:
+    op.add_column("url_entries", sa.Column("url_hash", sa.BigInteger(), nullable=True))
+
+    # Backfill in batches, by id
+    connection = op.get_bind()
+    url_entries = sa.table(
+        "url_entries", sa.column("id"), sa.column("url"), sa.column("url_hash")
+    )
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(url_entries.c.id, url_entries.c.url)
+            .where(url_entries.c.id > last_id)
+            .order_by(url_entries.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        connection.execute(
+            url_entries.update()
+            .where(url_entries.c.id == sa.bindparam("entry_id"))
+            .values(url_hash=sa.bindparam("hash")),
+            [dict(entry_id=id, hash=url_hash(url)) for id, url in rows],
+        )
+        last_id = rows[-1].id
+
+    with op.batch_alter_table("url_entries") as batch_op:
+        batch_op.alter_column("url_hash", existing_type=sa.BigInteger(), nullable=False)
+    op.create_index(
+        "ix_url_entries_channel_url_hash",
+        "url_entries",
+        ["channel_id", "url_hash", "created_at"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index("ix_url_entries_channel_url_hash", table_name="url_entries")
+    with op.batch_alter_table("url_entries") as batch_op:
+        batch_op.drop_column("url_hash")
@@ -0,0 +1,119 @@
+"""Full text search of the url entries
+
+Revision ID: 8b3e5c0f7d42
+Revises: 1f6d3b8e5a24
+Create Date: 2024-03-16 09:05:41.227859+00:00
+
+"""
+
+import html
+import re
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "8b3e5c0f7d42"
+down_revision: Union[str, None] = "1f6d3b8e5a24"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 10_000
+HTML_TAG = re.compile(r"<[^>]+>")
+
+
+def html_to_text(message):
+    # Same as rejubot.storage.html_to_text when this migration was written
+    if message is None:
+        return None
+    return html.unescape(HTML_TAG.sub("", message))
+
+
+# Same as rejubot.storage.URL_ENTRIES_FTS when this migration was written
+URL_ENTRIES_FTS_COLUMNS = "og_title, og_description, og_site, message_text, who"
+URL_ENTRIES_FTS = f"""
+    CREATE VIRTUAL TABLE url_entries_fts USING fts5(
+        {URL_ENTRIES_FTS_COLUMNS},
+        content='url_entries', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+"""
+URL_ENTRIES_FTS_RANK = """
+    INSERT INTO url_entries_fts (url_entries_fts, rank)
+    VALUES ('rank', 'bm25(10.0, 4.0, 2.0, 2.0, 1.0)')
+"""
+URL_ENTRIES_FTS_TRIGGERS = [
+    f"""
+    CREATE TRIGGER url_entries_fts_insert AFTER INSERT ON url_entries BEGIN
+    INSERT INTO url_entries_fts (rowid, {URL_ENTRIES_FTS_COLUMNS})
+    VALUES (NEW.id, NEW.og_title, NEW.og_description, NEW.og_site,
+            NEW.message_text, NEW.who);
+    END
+    """,
+    f"""
+    CREATE TRIGGER url_entries_fts_delete AFTER DELETE ON url_entries BEGIN
+    INSERT INTO url_entries_fts (url_entries_fts, rowid, {URL_ENTRIES_FTS_COLUMNS})
+    VALUES ('delete', OLD.id, OLD.og_title, OLD.og_description, OLD.og_site,
+            OLD.message_text, OLD.who);
+    END
+    """,
+    f"""
+    CREATE TRIGGER url_entries_fts_update
+    AFTER UPDATE OF {URL_ENTRIES_FTS_COLUMNS} ON url_entries BEGIN
+    INSERT INTO url_entries_fts (url_entries_fts, rowid, {URL_ENTRIES_FTS_COLUMNS})
+    VALUES ('delete', OLD.id, OLD.og_title, OLD.og_description, OLD.og_site,
+            OLD.message_text, OLD.who);
+    INSERT INTO url_entries_fts (rowid, {URL_ENTRIES_FTS_COLUMNS})
+    VALUES (NEW.id, NEW.og_title, NEW.og_description, NEW.og_site,
+            NEW.message_text, NEW.who);
+    END
+    """,
+]
+
+
+def upgrade() -> None:
+    op.add_column("url_entries", sa.Column("message_text", sa.Text(), nullable=True))
+
+    # Backfill in batches, by id
+    connection = op.get_bind()
+    url_entries = sa.table(
+        "url_entries", sa.column("id"), sa.column("message"), sa.column("message_text")
+    )
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(url_entries.c.id, url_entries.c.message)
+            .where(url_entries.c.id > last_id)
+            .order_by(url_entries.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        connection.execute(
+            url_entries.update()
+            .where(url_entries.c.id == sa.bindparam("entry_id"))
+            .values(message_text=sa.bindparam("text")),
+            [dict(entry_id=id, text=html_to_text(message)) for id, message in rows],
+        )
+        last_id = rows[-1].id
+
+    op.execute(URL_ENTRIES_FTS)
+    op.execute(URL_ENTRIES_FTS_RANK)
+    # Index everything from the content table at once
+    op.execute("INSERT INTO url_entries_fts (url_entries_fts) VALUES ('rebuild')")
+    for trigger in URL_ENTRIES_FTS_TRIGGERS:
+        op.execute(trigger)
+
+
+def downgrade() -> None:
+    for name in (
+        "url_entries_fts_insert",
+        "url_entries_fts_delete",
+        "url_entries_fts_update",
+    ):
+        op.execute(f"DROP TRIGGER {name}")
+    op.execute("DROP TABLE url_entries_fts")
+    # Not in batch mode, recreating url_entries would drop the link_days triggers
+    op.drop_column("url_entries", "message_text")
@@ -0,0 +1,41 @@
+"""Metadata cache
+
+Revision ID: 9d41b7c2e6f0
+Revises: 3c5e0f9a2b71
+Create Date: 2024-02-10 11:35:07.402113+00:00
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "9d41b7c2e6f0"
+down_revision: Union[str, None] = "3c5e0f9a2b71"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "metadata_cache",
+        sa.Column("url", sa.Text(), nullable=False),
+        sa.Column("metadata_json", sa.Text(), nullable=True),
+        sa.Column("content_type", sa.String(length=255), nullable=True),
+        sa.Column("expires_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("url"),
+    )
+    op.create_index(
+        op.f("ix_metadata_cache_expires_at"),
+        "metadata_cache",
+        ["expires_at"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_metadata_cache_expires_at"), table_name="metadata_cache")
+    op.drop_table("metadata_cache")
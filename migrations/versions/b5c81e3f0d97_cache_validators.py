@@ -0,0 +1,34 @@
+"""ETag, Last-Modified and final url of the cached pages
+
+Revision ID: b5c81e3f0d97
+Revises: 4d7a2c9e1b60
+Create Date: 2024-03-30 09:47:15.802664+00:00
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "b5c81e3f0d97"
+down_revision: Union[str, None] = "4d7a2c9e1b60"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column("metadata_cache", sa.Column("etag", sa.Text(), nullable=True))
+    op.add_column(
+        "metadata_cache",
+        sa.Column("last_modified", sa.String(length=64), nullable=True),
+    )
+    op.add_column("metadata_cache", sa.Column("final_url", sa.Text(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("metadata_cache", "final_url")
+    op.drop_column("metadata_cache", "last_modified")
+    op.drop_column("metadata_cache", "etag")
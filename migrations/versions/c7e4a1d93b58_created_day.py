@@ -0,0 +1,56 @@
+"""Stored day of the url entries
+
+Revision ID: c7e4a1d93b58
+Revises: 5a8f2d6c1e93
+Create Date: 2024-02-24 10:12:05.118342+00:00
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c7e4a1d93b58"
+down_revision: Union[str, None] = "5a8f2d6c1e93"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 10_000
+
+
+def upgrade() -> None:
+    op.add_column("url_entries", sa.Column("created_day", sa.Date(), nullable=True))
+
+    # Backfill in batches, by id. created_at is stored in UTC
+    connection = op.get_bind()
+    url_entries = sa.table(
+        "url_entries",
+        sa.column("id"),
+        sa.column("created_at"),
+        sa.column("created_day"),
+    )
+    last_id = 0
+    max_id = connection.scalar(sa.select(sa.func.max(url_entries.c.id))) or 0
+    while last_id < max_id:
+        connection.execute(
+            url_entries.update()
+            .where(url_entries.c.id > last_id)
+            .where(url_entries.c.id <= last_id + BATCH_SIZE)
+            .values(created_day=sa.func.date(url_entries.c.created_at))
+        )
+        last_id += BATCH_SIZE
+
+    with op.batch_alter_table("url_entries") as batch_op:
+        batch_op.alter_column("created_day", existing_type=sa.Date(), nullable=False)
+    op.create_index(
+        op.f("ix_url_entries_created_day"), "url_entries", ["created_day"], unique=False
+    )
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_url_entries_created_day"), table_name="url_entries")
+    with op.batch_alter_table("url_entries") as batch_op:
+        batch_op.drop_column("created_day")
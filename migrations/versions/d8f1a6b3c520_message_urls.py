@@ -0,0 +1,92 @@
+"""Ledger of the urls processed in each message, for the edits
+
+Revision ID: d8f1a6b3c520
+Revises: b5c81e3f0d97
+Create Date: 2024-04-13 11:26:38.517209+00:00
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from rejubot.storage import url_hash
+
+
+# revision identifiers, used by Alembic.
+revision: str = "d8f1a6b3c520"
+down_revision: Union[str, None] = "b5c81e3f0d97"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+BATCH_SIZE = 10_000
+
+
+def upgrade() -> None:
+    op.create_table(
+        "message_urls",
+        sa.Column("channel_id", sa.BigInteger(), nullable=False),
+        sa.Column("message_id", sa.BigInteger(), nullable=False),
+        sa.Column("url_hash", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("channel_id", "message_id", "url_hash"),
+    )
+
+    # The stored entries are the urls processed so far. Their url_hash may be
+    # from older canonicalization rules (the url_hash migration hashed the raw
+    # urls), and the edits compare the ledger with url_hash() as it is now: the
+    # entries are rehashed with the current rules, not a frozen copy of them.
+    connection = op.get_bind()
+    url_entries = sa.table(
+        "url_entries",
+        sa.column("id"),
+        sa.column("channel_id"),
+        sa.column("message_id"),
+        sa.column("url"),
+        sa.column("url_hash"),
+    )
+    message_urls = sa.table(
+        "message_urls",
+        sa.column("channel_id"),
+        sa.column("message_id"),
+        sa.column("url_hash"),
+    )
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(url_entries)
+            .where(url_entries.c.id > last_id)
+            .order_by(url_entries.c.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        hashes = {row.id: url_hash(row.url) for row in rows}
+        changed = [
+            dict(entry_id=row.id, hash=hashes[row.id])
+            for row in rows
+            if hashes[row.id] != row.url_hash
+        ]
+        if changed:
+            connection.execute(
+                url_entries.update()
+                .where(url_entries.c.id == sa.bindparam("entry_id"))
+                .values(url_hash=sa.bindparam("hash")),
+                changed,
+            )
+        connection.execute(
+            message_urls.insert().prefix_with("OR IGNORE"),
+            [
+                dict(
+                    channel_id=row.channel_id,
+                    message_id=row.message_id,
+                    url_hash=hashes[row.id],
+                )
+                for row in rows
+            ],
+        )
+        last_id = rows[-1].id
+
+
+def downgrade() -> None:
+    op.drop_table("message_urls")
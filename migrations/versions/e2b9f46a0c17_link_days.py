@@ -0,0 +1,82 @@
+"""Entries and version of each channel day, kept by triggers
+
+Revision ID: e2b9f46a0c17
+Revises: c7e4a1d93b58
+Create Date: 2024-03-02 11:40:52.604117+00:00
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e2b9f46a0c17"
+down_revision: Union[str, None] = "c7e4a1d93b58"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Same as rejubot.storage.LINK_DAYS_TRIGGERS when this migration was written
+LINK_DAY_UPSERT = """
+    INSERT INTO link_days (channel_id, day, entries, version, updated_at)
+    VALUES (NEW.channel_id, NEW.created_day, 1, 1, CURRENT_TIMESTAMP)
+    ON CONFLICT (channel_id, day) DO UPDATE SET
+        entries = entries + 1, version = version + 1, updated_at = CURRENT_TIMESTAMP;
+"""
+LINK_DAY_REMOVE = """
+    UPDATE link_days
+    SET entries = entries - 1, version = version + 1, updated_at = CURRENT_TIMESTAMP
+    WHERE channel_id = OLD.channel_id AND day = OLD.created_day;
+"""
+LINK_DAYS_TRIGGERS = [
+    f"""
+    CREATE TRIGGER link_days_insert AFTER INSERT ON url_entries BEGIN
+    {LINK_DAY_UPSERT}
+    END
+    """,
+    f"""
+    CREATE TRIGGER link_days_update AFTER UPDATE ON url_entries BEGIN
+    {LINK_DAY_REMOVE}
+    {LINK_DAY_UPSERT}
+    END
+    """,
+    f"""
+    CREATE TRIGGER link_days_delete AFTER DELETE ON url_entries BEGIN
+    {LINK_DAY_REMOVE}
+    END
+    """,
+]
+
+
+def upgrade() -> None:
+    op.create_table(
+        "link_days",
+        sa.Column("channel_id", sa.BigInteger(), nullable=False),
+        sa.Column("day", sa.Date(), nullable=False),
+        sa.Column("entries", sa.Integer(), nullable=False),
+        sa.Column("version", sa.Integer(), nullable=False),
+        sa.Column(
+            "updated_at",
+            sa.DateTime(),
+            server_default=sa.text("(CURRENT_TIMESTAMP)"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("channel_id", "day"),
+    )
+    op.create_index(op.f("ix_link_days_day"), "link_days", ["day"], unique=False)
+    op.execute(
+        "INSERT INTO link_days (channel_id, day, entries, version, updated_at) "
+        "SELECT channel_id, created_day, count(*), 1, CURRENT_TIMESTAMP "
+        "FROM url_entries GROUP BY channel_id, created_day"
+    )
+    for trigger in LINK_DAYS_TRIGGERS:
+        op.execute(trigger)
+
+
+def downgrade() -> None:
+    for name in ("link_days_insert", "link_days_update", "link_days_delete"):
+        op.execute(f"DROP TRIGGER {name}")
+    op.drop_index(op.f("ix_link_days_day"), table_name="link_days")
+    op.drop_table("link_days")
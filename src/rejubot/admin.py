@@ -1,105 +1,116 @@
-import json
 import logging
-import operator
 import os
-import re
-from datetime import datetime
-from random import randint
+from pathlib import Path
 
 import fire
-import pytz
 import tabulate
-from sqlalchemy import select
-from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
-from telegram import Chat, Message, User
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker
 
+from rejubot.cache import MetadataCache
+from rejubot.canonical import hit_rates
+from rejubot.dedup import DEDUP_WINDOW
+from rejubot.importer import export_date_range, import_export, iter_export_links
+from rejubot.repair import repair_entries, repair_query
+from rejubot.replay import replay
+from rejubot.scraper import Scraper, create_scraper, scrape_og_metadata
 from rejubot.settings import load_settings
-from rejubot.storage import UrlEntry
-from rejubot.telegrambot import (
-    assign_metadata,
-    create_entry,
-    process_url,
-    scrape_og_metadata,
+from rejubot.storage import (
+    HostStatus,
+    MessageUrl,
+    UrlEntry,
+    create_engine,
+    delete_entries,
+    url_hash,
 )
 
 logger = logging.getLogger(__name__)
 
+# The ledger row of the old hash moves to the new one, or goes away when the
+# message already has the new one
+LEDGER_ROW = (
+    (MessageUrl.channel_id == bindparam("channel"))
+    & (MessageUrl.message_id == bindparam("message"))
+    & (MessageUrl.url_hash == bindparam("old_hash"))
+)
+REHASH_LEDGER = (
+    MessageUrl.__table__.update()
+    .prefix_with("OR IGNORE")
+    .where(LEDGER_ROW)
+    .values(url_hash=bindparam("new_hash"))
+)
+DELETE_LEDGER = MessageUrl.__table__.delete().where(LEDGER_ROW)
 
-def render_message(entries: list) -> str:
-    """
-    Render a message from the Telegram API text element as a string.
 
-    It will detect the MessageEntityType, and for each type it will render the text.
+async def import_urls(
+    channel_name: str,
+    import_file: str,
+    delete: bool = False,
+    no_scrape: bool = False,
+    concurrency: int | None = None,
+    batch_size: int = 1000,
+    checkpoint: str | None = None,
+):
     """
-    result = []
-    for entry in entries:
-        if isinstance(entry, str):
-            result.append(entry)
-        else:
-            result.append(entry["text"])
-    return "".join(result)
-
+    Import the links of a Telegram Desktop export (result.json) into a channel.
 
-async def import_urls(channel_name: str, import_file: str, delete: bool = False):
-    """
-    Generate a month of urls for a channel, some days might not have any urls, others might have up to 20.
+    An interrupted import continues where it stopped, the progress is kept in
+    <import_file>.checkpoint. With --no_scrape the entries are stored right
+    away and the enrichment workers of the bot scrape them later.
     """
 
     settings = load_settings()
-    engine = create_async_engine(settings.db_url)
+    engine = create_engine(settings.db_url, settings.database)
     async_session = async_sessionmaker(engine, expire_on_commit=False)
 
     # Check that channel_name is in channels
     if (channel_id := settings.telegram_channels.get(channel_name)) is None:
         raise ValueError(f"Channel {channel_name} not found")
-    imported_msgs = json.load(open(import_file))
-    assert len(imported_msgs) > 0
-    # Sort ascending by date_unixtime
-    imported_msgs.sort(key=operator.itemgetter("date_unixtime"))
-
-    # Convert the date to a datetime object with the right timezone
-    timezone = pytz.timezone("Europe/Madrid")
-    for msg in imported_msgs:
-        dt_in_tz = datetime.fromisoformat(msg["date"])
-        msg["date"] = timezone.localize(dt_in_tz).astimezone(pytz.utc)
+    import_path = Path(import_file)
+    checkpoint_path = Path(checkpoint or f"{import_file}.checkpoint")
 
-    # Delete the range of dates included in the imported messages
-    if delete:
+    # Delete the range of dates included in the imported messages, unless it
+    # is a resumed import and some of them are already the new ones
+    if delete and not checkpoint_path.exists():
+        date_range = export_date_range(import_path)
+        if date_range is None:
+            raise ValueError(f"No links found in {import_file}")
         async with async_session() as session:
-            first_date = imported_msgs[0]["date"]
-            last_date = imported_msgs[-1]["date"]
+            first_date, last_date = date_range
             logger.info("Deleting entries between %s and %s", first_date, last_date)
-            res = await session.execute(
-                UrlEntry.__table__.delete()
-                .where(UrlEntry.channel_id == channel_id)
-                .where(UrlEntry.created_at.between(first_date, last_date))
+            deleted = await delete_entries(
+                session,
+                UrlEntry.channel_id == channel_id,
+                UrlEntry.created_at.between(first_date, last_date),
             )
-            logger.info("Deleted %d entries", res.rowcount)
+            logger.info("Deleted %d entries", len(deleted))
             await session.commit()
 
-    # Process each imported message
-    async with async_session() as session:
-        for msg in imported_msgs:
-            message = Message(
-                message_id=msg["id"],
-                date=msg["date"],
-                chat=Chat(id=channel_id, type="channel", title=channel_name),
-                text=render_message(msg["text"]),
-                from_user=User(
-                    first_name=msg["from"] or "", id=randint(1, 1000000), is_bot=False
-                ),
-            )
-            for entity in msg["text_entities"]:
-                if entity["type"] != "link":
-                    continue
-                url = entity["text"]
-
-                if not url.startswith("http"):
-                    continue
+    if no_scrape:
+        await import_export(
+            import_path,
+            channel_id,
+            channel_name,
+            async_session,
+            None,
+            batch_size=batch_size,
+            checkpoint=checkpoint_path,
+        )
+        return
 
-                await process_url(message, url, session)
-            # Save each url and continue
-            await session.commit()
+    scraper = create_scraper(settings, async_session)
+    async with scraper:
+        await import_export(
+            import_path,
+            channel_id,
+            channel_name,
+            async_session,
+            scraper,
+            concurrency=concurrency or settings.scraper.max_concurrency,
+            batch_size=batch_size,
+            checkpoint=checkpoint_path,
+        )
+    log_cache_stats(scraper)
 
 
 async def clear_urls(channel_name: str):
@@ -107,7 +118,7 @@ async def clear_urls(channel_name: str):
     Deletes all the urls in a channel
     """
     settings = load_settings()
-    engine = create_async_engine(settings.db_url)
+    engine = create_engine(settings.db_url, settings.database)
     async_session = async_sessionmaker(engine, expire_on_commit=False)
 
     # Check that channel_name is in channels
@@ -116,10 +127,8 @@ async def clear_urls(channel_name: str):
 
     # Delete the range of dates included in the imported messages
     async with async_session() as session:
-        res = await session.execute(
-            UrlEntry.__table__.delete().where(UrlEntry.channel_id == channel_id)
-        )
-        logger.info("Deleted %d entries", res.rowcount)
+        deleted = await delete_entries(session, UrlEntry.channel_id == channel_id)
+        logger.info("Deleted %d entries", len(deleted))
         await session.commit()
 
 
@@ -127,7 +136,9 @@ async def scrape_test(url: str):
     """
     Scrape the Open Graph metadata from a url
     """
-    result = await scrape_og_metadata(url)
+    settings = load_settings()
+    async with Scraper(settings.scraper) as scraper:
+        result = await scrape_og_metadata(url, scraper)
     table = []
     for key, value in result.__dict__.items():
         if isinstance(value, str) and len(value) > 60:
@@ -136,34 +147,248 @@ async def scrape_test(url: str):
     print(tabulate.tabulate(table, tablefmt="simple_grid"))
 
 
-async def repair_metadata(regex_filter: str = None):
+async def repair_metadata(
+    regex_filter: str = None,
+    use_cache: bool = True,
+    missing_title: bool = False,
+    older_than_days: float | None = None,
+    concurrency: int | None = None,
+    batch_size: int = 500,
+    resume_from: int | None = None,
+    dry_run: bool = False,
+    refresh: bool = False,
+):
     """
-    Repair the metadata of the urls
+    Repair the metadata of the urls, newest first
+
+    Use --use_cache=False to scrape again urls cached with old metadata.
+    --refresh asks the sites if the cached pages changed (ETag and
+    Last-Modified), and only downloads and parses the ones that did.
+    --missing_title and --older_than_days=N only repair those entries.
+    Every batch logs the --resume_from id to continue from there, and
+    --dry_run logs the changes without writing them.
     """
     logger.info(f"Repairing metadata for {regex_filter}")
     settings = load_settings()
-    engine = create_async_engine(settings.db_url)
+    engine = create_engine(settings.db_url, settings.database)
+    async_session = async_sessionmaker(engine, expire_on_commit=False)
+    query = repair_query(regex_filter, missing_title, older_than_days)
+
+    scraper = create_scraper(settings, async_session, use_cache)
+    async with scraper:
+        stats = await repair_entries(
+            async_session,
+            scraper,
+            query,
+            concurrency=concurrency or settings.scraper.max_concurrency,
+            batch_size=batch_size,
+            resume_from=resume_from,
+            dry_run=dry_run,
+            refresh=refresh,
+        )
+    logger.info("Repair finished: %s", stats.summary())
+    log_cache_stats(scraper)
+
+
+async def rehash_urls(batch_size: int = 1000):
+    """
+    Recalculate the hash of the stored urls, needed after changing the
+    canonicalization rules so the duplicates are found again.
+    """
+    settings = load_settings()
+    engine = create_engine(settings.db_url, settings.database)
     async_session = async_sessionmaker(engine, expire_on_commit=False)
-    regex = re.compile(regex_filter) if regex_filter else None
+    await rehash_entries(async_session, batch_size)
+
 
+async def rehash_entries(async_session: async_sessionmaker, batch_size: int = 1000):
+    """
+    Recalculate the hash of the stored urls, and the ledger of their messages
+    with them, so the edits still know them. Returns how many changed.
+    """
+    last_id, changed = 0, 0
     async with async_session() as session:
-        query = select(UrlEntry)
-        if regex_filter:
-            query = query.where(UrlEntry.url.regexp_match(regex_filter))
+        while True:
+            rows = (
+                await session.execute(
+                    select(
+                        UrlEntry.id,
+                        UrlEntry.channel_id,
+                        UrlEntry.message_id,
+                        UrlEntry.url,
+                        UrlEntry.url_hash,
+                    )
+                    .where(UrlEntry.id > last_id)
+                    .order_by(UrlEntry.id)
+                    .limit(batch_size)
+                )
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            updates = []
+            for row in rows:
+                hashed = url_hash(row.url)
+                if hashed != row.url_hash:
+                    updates.append(
+                        dict(
+                            id=row.id,
+                            new_hash=hashed,
+                            channel=row.channel_id,
+                            message=row.message_id,
+                            old_hash=row.url_hash,
+                        )
+                    )
+            if updates:
+                await session.execute(
+                    update(UrlEntry),
+                    [dict(id=row["id"], url_hash=row["new_hash"]) for row in updates],
+                )
+                await session.execute(REHASH_LEDGER, updates)
+                await session.execute(DELETE_LEDGER, updates)
+                await session.commit()
+            changed += len(updates)
+            logger.info("Rehashed up to id %d, %d changed", last_id, changed)
+    return changed
 
-        urls: list[UrlEntry] = (
-            await session.scalars(query.order_by(UrlEntry.created_at.desc()))
-        ).all()
 
-        for idx, url in enumerate(urls):
-            logger.info(
-                f"Updating metadata {idx}/{len(urls)} {url.created_at.date()} {url.url}"
+def canonical_report(import_file: str):
+    """
+    Hit rates of the url canonicalization over a Telegram export: links that
+    would be skipped as duplicates or served from the cache, with and without
+    canonical urls. The export is read as a stream, like by the import.
+    """
+    stats = hit_rates(iter_export_links(Path(import_file)), DEDUP_WINDOW)
+    total = stats.get("links", 0) or 1
+    table = [
+        [
+            name,
+            stats.get(f"{name}_distinct", 0),
+            stats.get(f"{name}_fetches", 0),
+            stats.get(f"{name}_duplicates", 0),
+            stats.get(f"{name}_cache_hits", 0),
+            f"{1 - stats.get(f'{name}_fetches', 0) / total:.1%}",
+        ]
+        for name in ("raw", "canonical")
+    ]
+    print(f"{stats.get('links', 0)} links")
+    print(
+        tabulate.tabulate(
+            table,
+            headers=[
+                "urls",
+                "distinct",
+                "fetches",
+                "duplicates",
+                "cache hits",
+                "saved",
+            ],
+        )
+    )
+
+
+async def purge_cache():
+    """
+    Delete the expired entries of the metadata cache
+    """
+    settings = load_settings()
+    engine = create_engine(settings.db_url, settings.database)
+    cache = MetadataCache(settings.cache, async_sessionmaker(engine))
+    deleted = await cache.purge()
+    logger.info("Deleted %d expired entries, %d left", deleted, await cache.count())
+
+
+async def host_status(all_hosts: bool = False):
+    """
+    State of the hosts saved by the scrapers, the ones with failures first.
+
+    Only hosts with failures or an open circuit unless --all_hosts.
+    """
+    settings = load_settings()
+    engine = create_engine(settings.db_url, settings.database)
+    async with async_sessionmaker(engine)() as session:
+        query = select(HostStatus).order_by(
+            HostStatus.state != "closed",
+            HostStatus.consecutive_failures,
+            HostStatus.failures,
+        )
+        if not all_hosts:
+            query = query.where(
+                (HostStatus.state != "closed") | (HostStatus.failures > 0)
             )
-            metadata = await scrape_og_metadata(url.url)
-            if metadata is None:
-                continue
-            assign_metadata(url, metadata)
-            await session.commit()
+        rows = (await session.scalars(query)).all()
+    table = [
+        [
+            row.host,
+            row.state,
+            row.requests,
+            row.failures,
+            row.consecutive_failures,
+            row.rejected,
+            row.open_until,
+            row.updated_at,
+            (row.last_error or "")[:60],
+        ]
+        for row in reversed(rows)
+    ]
+    print(
+        tabulate.tabulate(
+            table,
+            headers=[
+                "host",
+                "state",
+                "requests",
+                "failures",
+                "in a row",
+                "rejected",
+                "open until",
+                "updated",
+                "last error",
+            ],
+        )
+    )
+
+
+async def replay_updates(
+    import_file: str | None = None,
+    messages: int = 1000,
+    rate: float = 50,
+    links: int = 3,
+    hosts: int = 50,
+    repeated: float = 0.1,
+    delay: float = 0.05,
+    verbose: bool = False,
+):
+    """
+    Load test the bot: feed it link messages at --rate per second (0 is as
+    fast as it takes them) and report throughput, latencies and database growth.
+
+    Runs with the settings of the bot, but without Telegram or network: the
+    urls are scraped from a local stand-in server answering after --delay
+    seconds, and the entries go to a scratch database. The messages are the
+    link messages of a Telegram Desktop export, or synthetic ones with up to
+    --links urls over --hosts sites, a --repeated part of them already posted.
+    The logs of the bot are hidden unless --verbose.
+    """
+    settings = load_settings()
+    if not verbose:
+        logging.getLogger("rejubot").setLevel(logging.WARNING)
+    stats = await replay(
+        settings,
+        import_file=Path(import_file) if import_file else None,
+        count=messages,
+        rate=rate,
+        links=links,
+        hosts=hosts,
+        repeated=repeated,
+        delay=delay,
+    )
+    print(tabulate.tabulate(stats.summary(), tablefmt="plain"))
+
+
+def log_cache_stats(scraper: Scraper):
+    if scraper.cache is not None:
+        logger.info("Metadata cache: %s", scraper.cache.stats())
 
 
 def main():
@@ -177,5 +402,10 @@ def main():
             import_urls=import_urls,
             scrape_test=scrape_test,
             repair_metadata=repair_metadata,
+            purge_cache=purge_cache,
+            rehash_urls=rehash_urls,
+            canonical_report=canonical_report,
+            host_status=host_status,
+            replay_updates=replay_updates,
         )
     )
@@ -0,0 +1,118 @@
+"""
+Link entries for the JSON API and the NDJSON export.
+
+Only the requested fields are selected, as plain rows, so neither the pages
+nor the export build ORM objects. The export streams the rows from a server
+side cursor, its memory doesn't depend on how many there are.
+"""
+
+import json
+from collections.abc import AsyncIterator
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import Row, Select, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from rejubot.pagination import Cursor
+from rejubot.storage import UrlEntry, VideoEntry
+
+FIELDS = {
+    "id": UrlEntry.id,
+    "channel_id": UrlEntry.channel_id,
+    "message_id": UrlEntry.message_id,
+    "created_at": UrlEntry.created_at,
+    "who": UrlEntry.who,
+    "who_id": UrlEntry.who_id,
+    "url": UrlEntry.url,
+    "message": UrlEntry.message,
+    "og_site": UrlEntry.og_site,
+    "og_title": UrlEntry.og_title,
+    "og_image": UrlEntry.og_image,
+    "og_description": UrlEntry.og_description,
+    "metadata_status": UrlEntry.metadata_status,
+    "video_url": VideoEntry.url,
+    "video_type": VideoEntry.content_type,
+    "video_width": VideoEntry.width,
+    "video_height": VideoEntry.height,
+}
+VIDEO_FIELDS = {"video_url", "video_type", "video_width", "video_height"}
+EXPORT_BATCH_SIZE = 1000
+
+
+def parse_fields(fields: str | None) -> list[str]:
+    """
+    Comma separated field names, all of them when there are none.
+    Raises ValueError for unknown fields.
+    """
+    if not fields:
+        return list(FIELDS)
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    if unknown := [name for name in names if name not in FIELDS]:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return names
+
+
+def links_query(
+    fields: list[str],
+    channel_id: int | None = None,
+    from_date: date | None = None,
+    to_date: date | None = None,
+) -> Select:
+    """
+    Rows with the fields, plus the cursor columns, in created_at and id order
+    """
+    query = select(
+        UrlEntry.id.label("cursor_id"),
+        UrlEntry.created_at.label("cursor_created_at"),
+        *(FIELDS[name].label(name) for name in fields),
+    )
+    if VIDEO_FIELDS.intersection(fields):
+        query = query.outerjoin(VideoEntry, UrlEntry.video_id == VideoEntry.id)
+    if channel_id is not None:
+        query = query.where(UrlEntry.channel_id == channel_id)
+    # Bounds on created_at, not its day, to use the indexes
+    if from_date is not None:
+        query = query.where(
+            UrlEntry.created_at >= datetime.combine(from_date, time.min)
+        )
+    if to_date is not None:
+        query = query.where(
+            UrlEntry.created_at
+            < datetime.combine(to_date + timedelta(days=1), time.min)
+        )
+    return query
+
+
+def row_cursor(row: Row) -> Cursor:
+    return Cursor(row.cursor_created_at, row.cursor_id)
+
+
+def row_to_dict(row: Row, fields: list[str]) -> dict:
+    mapping = row._mapping
+    return {name: mapping[name] for name in fields}
+
+
+def json_default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+async def export_lines(
+    session_factory: async_sessionmaker, query: Select, fields: list[str]
+) -> AsyncIterator[bytes]:
+    """
+    NDJSON lines of the rows, oldest first. Opens its own session, it runs
+    while the response is sent.
+    """
+    query = query.order_by(UrlEntry.created_at, UrlEntry.id).execution_options(
+        yield_per=EXPORT_BATCH_SIZE
+    )
+    async with session_factory() as session:
+        result = await session.stream(query)
+        async for rows in result.partitions():
+            yield b"".join(
+                json.dumps(row_to_dict(row, fields), default=json_default).encode()
+                + b"\n"
+                for row in rows
+            )
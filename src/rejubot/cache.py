@@ -0,0 +1,202 @@
+"""
+Cache of scraped metadata by canonical url.
+
+A small LRU in memory in front of the metadata_cache table, so the bot and
+the admin commands share what was scraped. Urls that returned nothing are
+cached too (negative entries), with their own, shorter, TTL.
+
+The ETag, Last-Modified and final url of the page are kept with the
+metadata. Once the entry expires they are used to ask the site if the page
+changed, and a 304 reuses the stored metadata without downloading it again.
+"""
+
+import json
+import logging
+import time
+from collections import Counter, OrderedDict
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, func, or_, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from rejubot.canonical import canonical_url
+from rejubot.opengraph import UrlMetadata
+from rejubot.settings import CacheSettings
+from rejubot.storage import MetadataCacheEntry
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Validators:
+    """
+    What the site told about the page to ask later if it changed
+    """
+
+    etag: str | None = None
+    last_modified: str | None = None
+    # Url after following the redirects
+    final_url: str | None = None
+
+    def __bool__(self):
+        return bool(self.etag or self.last_modified)
+
+
+@dataclass
+class StalePage:
+    """
+    Cached page, expired or not, that can be revalidated
+    """
+
+    metadata: UrlMetadata | None
+    content_type: str | None
+    validators: Validators
+
+
+class MetadataCache:
+    def __init__(self, settings: CacheSettings, session_factory: async_sessionmaker):
+        self.settings = settings
+        self.session_factory = session_factory
+        # Key -> (expiration timestamp, metadata)
+        self.memory: OrderedDict[str, tuple[float, UrlMetadata | None]] = OrderedDict()
+        self.counters = Counter()
+
+    def ttl(self, metadata: UrlMetadata | None, content_type: str | None) -> float:
+        if metadata is None:
+            return self.settings.ttl_negative
+        if content_type and content_type.startswith("image/"):
+            return self.settings.ttl_image
+        if content_type and content_type.startswith("video/"):
+            return self.settings.ttl_video
+        return self.settings.ttl_html
+
+    async def get(self, url: str) -> tuple[bool, UrlMetadata | None]:
+        """
+        Returns if the url was found, and its metadata (None for negative entries)
+        """
+        key = canonical_url(url)
+        now = time.time()
+
+        if (cached := self.memory.get(key)) is not None:
+            expires_at, metadata = cached
+            if expires_at > now:
+                self.memory.move_to_end(key)
+                self.count_hit("memory", metadata)
+                return True, metadata
+            del self.memory[key]
+
+        async with self.session_factory() as session:
+            entry = await session.scalar(
+                select(MetadataCacheEntry)
+                .where(MetadataCacheEntry.url == key)
+                .where(MetadataCacheEntry.expires_at > datetime.now(timezone.utc))
+            )
+        if entry is None:
+            self.counters["misses"] += 1
+            return False, None
+
+        metadata = entry_metadata(entry)
+        expires_at = entry.expires_at.replace(tzinfo=timezone.utc).timestamp()
+        self.remember(key, expires_at, metadata)
+        self.count_hit("db", metadata)
+        return True, metadata
+
+    async def stale(self, url: str) -> StalePage | None:
+        """
+        The stored page of the url, even if expired, when it has validators
+        """
+        async with self.session_factory() as session:
+            entry = await session.get(MetadataCacheEntry, canonical_url(url))
+        if entry is None or not (entry.etag or entry.last_modified):
+            return None
+        return StalePage(
+            entry_metadata(entry),
+            entry.content_type,
+            Validators(entry.etag, entry.last_modified, entry.final_url),
+        )
+
+    async def put(
+        self,
+        url: str,
+        metadata: UrlMetadata | None,
+        content_type: str | None,
+        validators: Validators = Validators(),
+    ):
+        key = canonical_url(url)
+        expires_at = time.time() + self.ttl(metadata, content_type)
+        self.remember(key, expires_at, metadata)
+
+        async with self.session_factory() as session:
+            await session.merge(
+                MetadataCacheEntry(
+                    url=key,
+                    metadata_json=json.dumps(asdict(metadata)) if metadata else None,
+                    content_type=content_type,
+                    expires_at=datetime.fromtimestamp(expires_at, timezone.utc),
+                    etag=validators.etag,
+                    last_modified=validators.last_modified,
+                    final_url=validators.final_url,
+                )
+            )
+            await session.commit()
+
+    async def purge(self) -> int:
+        """
+        Delete the expired entries from the database. The ones with validators
+        are kept for keep_validated seconds more to revalidate them.
+        """
+        now = datetime.now(timezone.utc)
+        validated = or_(
+            MetadataCacheEntry.etag.is_not(None),
+            MetadataCacheEntry.last_modified.is_not(None),
+        )
+        async with self.session_factory() as session:
+            res = await session.execute(
+                delete(MetadataCacheEntry)
+                .where(MetadataCacheEntry.expires_at <= now)
+                .where(
+                    ~validated
+                    | (
+                        MetadataCacheEntry.expires_at
+                        <= now - timedelta(seconds=self.settings.keep_validated)
+                    )
+                )
+            )
+            await session.commit()
+        return res.rowcount
+
+    async def count(self) -> int:
+        async with self.session_factory() as session:
+            return await session.scalar(select(func.count(MetadataCacheEntry.url)))
+
+    def remember(self, key: str, expires_at: float, metadata: UrlMetadata | None):
+        self.memory[key] = (expires_at, metadata)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.settings.memory_entries:
+            self.memory.popitem(last=False)
+
+    def count_hit(self, tier: str, metadata: UrlMetadata | None):
+        self.counters["hits"] += 1
+        self.counters[f"{tier}_hits"] += 1
+        if metadata is None:
+            self.counters["negative_hits"] += 1
+
+    def stats(self) -> dict[str, int]:
+        """
+        Hit and miss counters since the cache was created
+        """
+        return dict(
+            hits=self.counters["hits"],
+            memory_hits=self.counters["memory_hits"],
+            db_hits=self.counters["db_hits"],
+            negative_hits=self.counters["negative_hits"],
+            misses=self.counters["misses"],
+            memory_entries=len(self.memory),
+        )
+
+
+def entry_metadata(entry: MetadataCacheEntry) -> UrlMetadata | None:
+    if entry.metadata_json is None:
+        return None
+    return UrlMetadata(**json.loads(entry.metadata_json))
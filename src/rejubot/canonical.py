@@ -0,0 +1,208 @@
+"""
+Url canonicalization.
+
+The same link is shared in many shapes: with tracking parameters, from the
+mobile site, with a short domain... canonical_url gives one key for all of
+them, used to find duplicates and as cache key. fetch_url cleans the url the
+same way but keeps its path, and points to the frontend that is better to
+scrape (vxtwitter, ddinstagram).
+
+The original url is what is stored and displayed.
+"""
+
+from collections import Counter
+from collections.abc import Callable, Iterable
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from urllib.parse import (
+    SplitResult,
+    parse_qsl,
+    unquote_plus,
+    urlencode,
+    urlsplit,
+    urlunsplit,
+)
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+TRACKING_PARAMS = {
+    "dclid",
+    "fbclid",
+    "gbraid",
+    "gclid",
+    "igsh",
+    "igshid",
+    "mc_cid",
+    "mc_eid",
+    "mkt_tok",
+    "msclkid",
+    "ref_src",
+    "ref_url",
+    "wbraid",
+    "yclid",
+    "_hsenc",
+    "_hsmi",
+}
+TRACKING_PREFIXES = ("utm_",)
+
+
+@dataclass(frozen=True)
+class HostRule:
+    # Host all the aliases are turned into
+    host: str
+    # Host to download the url from, when it isn't the canonical one
+    fetch_host: str | None = None
+    # Only these query parameters matter, None keeps all but tracking ones
+    keep_params: frozenset[str] | None = None
+    # Turns the url into the canonical form of the site
+    rewrite: Callable[[SplitResult], SplitResult] | None = None
+
+
+def youtu_be(parts: SplitResult) -> SplitResult:
+    """
+    https://youtu.be/<id>?t=10 -> https://www.youtube.com/watch?v=<id>&t=10
+    """
+    video_id = parts.path.strip("/")
+    if not video_id:
+        return parts
+    query = urlencode([("v", video_id), *parse_qsl(parts.query)])
+    return parts._replace(path="/watch", query=query)
+
+
+YOUTUBE = HostRule(
+    "www.youtube.com",
+    keep_params=frozenset({"v", "t", "list", "index", "search_query"}),
+)
+TWITTER = HostRule("twitter.com", fetch_host="vxtwitter.com", keep_params=frozenset())
+INSTAGRAM = HostRule(
+    "www.instagram.com", fetch_host="www.ddinstagram.com", keep_params=frozenset()
+)
+REDDIT = HostRule("www.reddit.com", keep_params=frozenset())
+TIKTOK = HostRule("www.tiktok.com", keep_params=frozenset())
+
+# Hostname -> rule
+HOST_RULES: dict[str, HostRule] = {
+    "youtube.com": YOUTUBE,
+    "www.youtube.com": YOUTUBE,
+    "m.youtube.com": YOUTUBE,
+    "youtu.be": HostRule(
+        "www.youtube.com", keep_params=YOUTUBE.keep_params, rewrite=youtu_be
+    ),
+    "twitter.com": TWITTER,
+    "www.twitter.com": TWITTER,
+    "mobile.twitter.com": TWITTER,
+    "x.com": TWITTER,
+    "www.x.com": TWITTER,
+    "mobile.x.com": TWITTER,
+    "vxtwitter.com": TWITTER,
+    "fxtwitter.com": TWITTER,
+    "fixupx.com": TWITTER,
+    "instagram.com": INSTAGRAM,
+    "www.instagram.com": INSTAGRAM,
+    "ddinstagram.com": INSTAGRAM,
+    "www.ddinstagram.com": INSTAGRAM,
+    "reddit.com": REDDIT,
+    "www.reddit.com": REDDIT,
+    "old.reddit.com": REDDIT,
+    "m.reddit.com": REDDIT,
+    "tiktok.com": TIKTOK,
+    "www.tiktok.com": TIKTOK,
+    "m.tiktok.com": TIKTOK,
+}
+
+
+def is_tracking(param: str, rule: HostRule | None) -> bool:
+    if rule is not None and rule.keep_params is not None:
+        return param not in rule.keep_params
+    return param in TRACKING_PARAMS or param.startswith(TRACKING_PREFIXES)
+
+
+def clean_url(url: str, for_fetch: bool) -> str:
+    if not url.lower().startswith("http"):
+        url = f"http://{url}"
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        # Not something we can clean, use it as it is
+        return url
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower().rstrip(".")
+
+    rule = HOST_RULES.get(host)
+    if rule is not None:
+        if rule.rewrite is not None:
+            parts = rule.rewrite(parts)
+        host = rule.fetch_host if for_fetch and rule.fetch_host else rule.host
+        scheme = "https"
+    elif not for_fetch:
+        # For the key http and https, and www or not, are the same page
+        scheme = "https"
+        host = host.removeprefix("www.")
+
+    netloc = host
+    if port and port != DEFAULT_PORTS.get(scheme):
+        netloc += f":{port}"
+
+    path = parts.path or "/"
+    if for_fetch:
+        # The kept parameters as they were written, re-encoded the server
+        # could read them differently
+        query = "&".join(
+            piece
+            for piece in parts.query.split("&")
+            if not is_tracking(unquote_plus(piece.partition("=")[0]), rule)
+        )
+    else:
+        params = sorted(
+            (key, value)
+            for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if not is_tracking(key, rule)
+        )
+        query = urlencode(params)
+        if path != "/":
+            path = path.rstrip("/")
+
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+
+def canonical_url(url: str) -> str:
+    """
+    Key of the url to find duplicates and cache it
+    """
+    return clean_url(url, for_fetch=False)
+
+
+def fetch_url(url: str) -> str:
+    """
+    Url to download, without tracking and from the preferred frontend
+    """
+    return clean_url(url, for_fetch=True)
+
+
+def hit_rates(links: Iterable[tuple[datetime, str]], window: timedelta) -> dict:
+    """
+    Compare how many of the links, ordered by date, are duplicated in the
+    window or already scraped using the raw urls and the canonical ones.
+    """
+    raw_seen: dict[str, datetime] = {}
+    canonical_seen: dict[str, datetime] = {}
+    stats = Counter()
+    for date, url in links:
+        stats["links"] += 1
+        for name, key, seen in (
+            ("raw", url, raw_seen),
+            ("canonical", canonical_url(url), canonical_seen),
+        ):
+            last = seen.get(key)
+            if last is None:
+                stats[f"{name}_fetches"] += 1
+            elif date - last < window:
+                # Skipped by the bot, not stored
+                stats[f"{name}_duplicates"] += 1
+                continue
+            else:
+                stats[f"{name}_cache_hits"] += 1
+            seen[key] = date
+    stats["raw_distinct"] = len(raw_seen)
+    stats["canonical_distinct"] = len(canonical_seen)
+    return dict(stats)
@@ -0,0 +1,84 @@
+"""
+Duplicated urls in a channel are ignored for a while after being posted.
+"""
+
+import logging
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from rejubot.storage import UrlEntry
+
+logger = logging.getLogger(__name__)
+DEDUP_WINDOW = timedelta(days=1)
+
+
+def as_utc(value: datetime) -> datetime:
+    """
+    Dates from the database are naive UTC
+    """
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value
+
+
+class RecentUrls:
+    """
+    Urls posted in the dedup window, by channel and url hash.
+
+    Once warmed up from the database it knows every url of the window, as long
+    as this process is the only one storing urls, and answers the duplicate
+    checks without a query. Before that only duplicates can be trusted.
+    """
+
+    def __init__(self, window: timedelta = DEDUP_WINDOW):
+        self.window = window
+        self.posted: dict[tuple[int, int], datetime] = {}
+        self.complete = False
+
+    async def warm_up(self, session: AsyncSession, now: datetime | None = None):
+        now = now or datetime.now(timezone.utc)
+        rows = await session.execute(
+            select(UrlEntry.channel_id, UrlEntry.url_hash, UrlEntry.created_at)
+            .where(UrlEntry.created_at > now - self.window)
+            .order_by(UrlEntry.created_at)
+        )
+        for channel_id, url_hash, created_at in rows:
+            self.add(channel_id, url_hash, created_at)
+        self.complete = True
+        logger.info("Loaded %d recent urls", len(self.posted))
+
+    def add(self, channel_id: int, url_hash: int, posted_at: datetime):
+        key = (channel_id, url_hash)
+        posted_at = as_utc(posted_at)
+        # Keep the dict in posting order so expire can stop at the first recent one
+        if (previous := self.posted.pop(key, None)) is not None:
+            posted_at = max(previous, posted_at)
+        self.posted[key] = posted_at
+        self.expire(posted_at)
+
+    def discard(self, channel_id: int, url_hash: int):
+        """
+        Forget an url added but not stored after all
+        """
+        self.posted.pop((channel_id, url_hash), None)
+
+    def is_duplicate(self, channel_id: int, url_hash: int, at: datetime) -> bool | None:
+        """
+        True or False when known, None when the database has to be checked
+        """
+        posted_at = self.posted.get((channel_id, url_hash))
+        if posted_at is not None and posted_at > as_utc(at) - self.window:
+            return True
+        if self.complete:
+            return False
+        return None
+
+    def expire(self, now: datetime):
+        oldest = now - self.window
+        while self.posted:
+            key, posted_at = next(iter(self.posted.items()))
+            if posted_at > oldest:
+                break
+            del self.posted[key]
@@ -0,0 +1,220 @@
+"""
+Background scraping of the metadata of stored urls.
+
+The bot stores the url entries right away as pending, with a ScrapeJob each.
+A pool of workers running in the same event loop claims the jobs, scrapes
+the urls and fills the metadata.
+
+A claimed job is hidden for the visibility timeout. If the worker dies
+before finishing it, the job becomes available again, and on start all the
+jobs claimed by a previous process are released.
+"""
+
+import asyncio
+import logging
+from collections.abc import Iterable
+from datetime import datetime, timedelta, timezone
+
+import aiohttp
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from rejubot.metrics import DB_COMMITS
+from rejubot.scraper import Scraper, UrlMetadata, fetch_og_metadata
+from rejubot.settings import EnrichmentSettings
+from rejubot.storage import MetadataStatus, ScrapeJob, UrlEntry, VideoEntry
+
+logger = logging.getLogger(__name__)
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def assign_metadata(entry: UrlEntry, metadata: UrlMetadata) -> UrlEntry:
+    entry.og_description = metadata.description
+    entry.og_image = metadata.image
+    entry.og_site = metadata.site
+    entry.og_title = metadata.title
+    if metadata.video_url:
+        entry.video = VideoEntry(
+            content_type=metadata.video_type,
+            width=metadata.video_width,
+            height=metadata.video_height,
+            url=metadata.video_url,
+        )
+
+    return entry
+
+
+def enqueue(session: AsyncSession, entries: Iterable[UrlEntry]):
+    """
+    Mark the entries as pending and add a scrape job for each one
+    """
+    now = utcnow()
+    for entry in entries:
+        entry.metadata_status = MetadataStatus.PENDING
+        session.add(ScrapeJob(entry=entry, available_at=now))
+
+
+class EnrichmentWorkers:
+    """
+    Pool of async workers processing the scrape jobs
+    """
+
+    def __init__(
+        self,
+        settings: EnrichmentSettings,
+        session_factory: async_sessionmaker,
+        scraper: Scraper,
+    ):
+        self.settings = settings
+        self.session_factory = session_factory
+        self.scraper = scraper
+        self.wakeup = asyncio.Event()
+        self.tasks: list[asyncio.Task] = []
+        self.stopping = False
+
+    async def start(self):
+        await self.recover()
+        self.stopping = False
+        self.tasks = [
+            asyncio.create_task(self.run(), name=f"enrichment-{idx}")
+            for idx in range(self.settings.workers)
+        ]
+
+    async def stop(self):
+        # The cancel alone isn't enough: in python 3.11 asyncio.wait_for, used
+        # by the connection pool, can swallow it and the worker goes on
+        self.stopping = True
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def notify(self):
+        """
+        Wake up the workers, there are new jobs
+        """
+        self.wakeup.set()
+
+    async def recover(self):
+        """
+        Release the jobs claimed by a previous process that didn't finish them
+        """
+        async with self.session_factory() as session:
+            res = await session.execute(
+                update(ScrapeJob)
+                .where(ScrapeJob.claimed_at.is_not(None))
+                .values(claimed_at=None, available_at=utcnow())
+            )
+            await session.commit()
+        if res.rowcount:
+            logger.info("Released %d unfinished scrape jobs", res.rowcount)
+
+    async def run(self):
+        while not self.stopping:
+            try:
+                job = await self.claim()
+                if job is not None:
+                    await self.process(job)
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Error in the enrichment worker")
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(
+                    self.wakeup.wait(), timeout=self.settings.poll_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    async def claim(self) -> ScrapeJob | None:
+        """
+        Claim the next available job, hiding it for the visibility timeout
+        """
+        async with self.session_factory() as session:
+            while True:
+                now = utcnow()
+                job = await session.scalar(
+                    select(ScrapeJob)
+                    .where(ScrapeJob.available_at <= now)
+                    .order_by(ScrapeJob.available_at)
+                    .limit(1)
+                )
+                if job is None:
+                    return None
+                # Only one of the workers (or processes) wins the update
+                res = await session.execute(
+                    update(ScrapeJob)
+                    .where(ScrapeJob.id == job.id)
+                    .where(ScrapeJob.attempts == job.attempts)
+                    .values(
+                        claimed_at=now,
+                        available_at=now
+                        + timedelta(seconds=self.settings.visibility_timeout),
+                        attempts=ScrapeJob.attempts + 1,
+                    )
+                    .execution_options(synchronize_session=False)
+                )
+                await session.commit()
+                if res.rowcount == 1:
+                    await session.refresh(job)
+                    return job
+
+    async def process(self, job: ScrapeJob):
+        async with self.session_factory() as session:
+            url = await session.scalar(
+                select(UrlEntry.url).where(UrlEntry.id == job.url_entry_id)
+            )
+        if url is None:
+            # The entry was deleted meanwhile
+            await self.finish(job, None, MetadataStatus.DONE)
+            return
+
+        logger.info("Scraping %s (attempt %d)", url, job.attempts)
+        try:
+            metadata = await fetch_og_metadata(url, self.scraper)
+            await self.finish(job, metadata, MetadataStatus.DONE)
+        except Exception as error:
+            # Not only the network errors: a page the parser fails on, or
+            # metadata that can't be stored, would be claimed again forever
+            if not isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError)):
+                logger.exception("Error processing %s", url)
+            await self.retry(job, url, error)
+
+    async def retry(self, job: ScrapeJob, url: str, error: Exception):
+        if job.attempts >= self.settings.max_attempts:
+            logger.warning("Giving up scraping %s: %r", url, error)
+            await self.finish(job, None, MetadataStatus.FAILED)
+            return
+
+        backoff = self.settings.retry_backoff * 2 ** (job.attempts - 1)
+        logger.info("Error scraping %s: %r, retrying in %ds", url, error, backoff)
+        async with self.session_factory() as session:
+            await session.execute(
+                update(ScrapeJob)
+                .where(ScrapeJob.id == job.id)
+                .values(
+                    claimed_at=None,
+                    available_at=utcnow() + timedelta(seconds=backoff),
+                    last_error=repr(error),
+                )
+            )
+            await session.commit()
+
+    async def finish(
+        self, job: ScrapeJob, metadata: UrlMetadata | None, status: MetadataStatus
+    ):
+        async with self.session_factory() as session:
+            entry = await session.get(UrlEntry, job.url_entry_id)
+            if entry is not None:
+                if metadata is not None:
+                    assign_metadata(entry, metadata)
+                entry.metadata_status = status
+            await session.execute(delete(ScrapeJob).where(ScrapeJob.id == job.id))
+            with DB_COMMITS.time():
+                await session.commit()
@@ -0,0 +1,306 @@
+"""
+Scheduling of the scrapes by host.
+
+Each host gets a token bucket limiting its request rate, a cap on the
+requests running at the same time, and a circuit breaker. After repeated
+timeouts, connection errors or 429/5xx responses the circuit opens and the
+scrapes of the host fail right away, without waiting for the timeout, until
+the cooldown ends. Then one request tries the host again and closes the
+circuit when it works.
+
+The states are saved in the host_status table so the admin host_status
+command shows them.
+"""
+
+import asyncio
+import logging
+import time
+from collections.abc import AsyncIterator, Callable
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from enum import StrEnum
+from urllib.parse import urlsplit
+
+import aiohttp
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from rejubot.settings import HostSettings
+from rejubot.storage import HostStatus
+
+logger = logging.getLogger(__name__)
+
+
+class HostUnavailable(aiohttp.ClientError):
+    """
+    The circuit of the host is open, it wasn't requested
+    """
+
+
+class CircuitState(StrEnum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class TokenBucket:
+    def __init__(
+        self, rate: float, burst: int, clock: Callable[[], float] = time.monotonic
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self) -> float:
+        """
+        Take a token, returns 0 or the seconds to wait for the next one
+        """
+        self.refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    async def take(self):
+        while wait := self.try_take():
+            await asyncio.sleep(wait)
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        failure_threshold: int,
+        cooldown: float,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.state = CircuitState.CLOSED
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def allow(self) -> bool:
+        """
+        If a request can be made. After the cooldown a single one is let
+        through to try the host again.
+        """
+        if self.state == CircuitState.CLOSED:
+            return True
+        if self.state == CircuitState.OPEN and self.clock() >= self.open_until:
+            self.state = CircuitState.HALF_OPEN
+            return True
+        return False
+
+    def release(self):
+        """
+        The request let through didn't finish, let the next one try
+        """
+        if self.state == CircuitState.HALF_OPEN:
+            self.state = CircuitState.OPEN
+
+    def success(self):
+        self.state = CircuitState.CLOSED
+        self.consecutive_failures = 0
+
+    def failure(self, retry_after: float | None = None):
+        self.consecutive_failures += 1
+        if (
+            self.state == CircuitState.HALF_OPEN
+            or self.consecutive_failures >= self.failure_threshold
+            or retry_after is not None
+        ):
+            self.state = CircuitState.OPEN
+            self.open_until = self.clock() + max(self.cooldown, retry_after or 0)
+
+
+def retry_after(error: Exception) -> float | None:
+    """
+    Seconds asked by a 429 response before trying again
+    """
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+def is_host_failure(error: BaseException) -> bool:
+    """
+    Errors telling the host is down or asking us to slow down, a 404 or a
+    page without metadata isn't one.
+    """
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError))
+
+
+class Host:
+    def __init__(self, name: str, settings: HostSettings, clock: Callable[[], float]):
+        self.name = name
+        self.bucket = TokenBucket(settings.rate, settings.burst, clock)
+        self.semaphore = asyncio.Semaphore(settings.max_concurrency)
+        self.breaker = CircuitBreaker(
+            settings.failure_threshold, settings.cooldown, clock
+        )
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+        self.last_error: str | None = None
+        # Requests waiting or running, and when the last one finished
+        self.active = 0
+        self.used = clock()
+
+    def check(self):
+        if not self.breaker.allow():
+            self.rejected += 1
+            raise HostUnavailable(f"Circuit of {self.name} is open")
+
+
+class HostScheduler:
+    def __init__(
+        self,
+        settings: HostSettings,
+        session_factory: async_sessionmaker | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.settings = settings
+        self.session_factory = session_factory
+        self.clock = clock
+        self.hosts: dict[str, Host] = {}
+        self.changed: set[str] = set()
+        self.task: asyncio.Task | None = None
+        self.stopping = False
+
+    def host(self, url: str) -> Host:
+        name = urlsplit(url).hostname or ""
+        if (host := self.hosts.get(name)) is None:
+            host = self.hosts[name] = Host(name, self.settings, self.clock)
+        return host
+
+    @asynccontextmanager
+    async def slot(self, url: str) -> AsyncIterator[None]:
+        """
+        Wait for the turn of the url in its host, and record how it went.
+        Raises HostUnavailable when the circuit is open.
+        """
+        host = self.host(url)
+        host.check()
+        host.active += 1
+        try:
+            async with host.semaphore:
+                await host.bucket.take()
+                # It could have been opened while waiting
+                if host.breaker.state == CircuitState.OPEN:
+                    host.check()
+                host.requests += 1
+                self.changed.add(host.name)
+                try:
+                    yield
+                except Exception as error:
+                    if is_host_failure(error):
+                        self.failure(host, error)
+                    else:
+                        host.breaker.success()
+                    raise
+                except BaseException:
+                    # Cancelled, the host wasn't tried
+                    host.breaker.release()
+                    raise
+                host.breaker.success()
+        finally:
+            host.active -= 1
+            host.used = self.clock()
+
+    def failure(self, host: Host, error: BaseException):
+        was_open = host.breaker.state == CircuitState.OPEN
+        host.failures += 1
+        host.last_error = repr(error)
+        host.breaker.failure(retry_after(error))
+        if host.breaker.state == CircuitState.OPEN and not was_open:
+            logger.warning(
+                "Circuit of %s open for %.0fs after %r",
+                host.name,
+                host.breaker.open_until - self.clock(),
+                error,
+            )
+
+    def snapshot(self, names: set[str] | None = None) -> list[HostStatus]:
+        now, wall_now = self.clock(), datetime.now(timezone.utc)
+        rows = []
+        for name in sorted(self.hosts if names is None else names):
+            host = self.hosts[name]
+            open_until = None
+            if host.breaker.state != CircuitState.CLOSED:
+                open_until = wall_now + timedelta(
+                    seconds=max(0, host.breaker.open_until - now)
+                )
+            rows.append(
+                HostStatus(
+                    host=name,
+                    state=str(host.breaker.state),
+                    requests=host.requests,
+                    failures=host.failures,
+                    rejected=host.rejected,
+                    consecutive_failures=host.breaker.consecutive_failures,
+                    open_until=open_until,
+                    last_error=host.last_error,
+                    updated_at=wall_now,
+                )
+            )
+        return rows
+
+    def evict(self):
+        """
+        Forget the hosts idle for settings.idle_after with their circuit
+        closed, only their counts are lost and those are saved. Otherwise
+        every host ever linked stays in memory.
+        """
+        now = self.clock()
+        for name, host in list(self.hosts.items()):
+            if (
+                host.active == 0
+                and host.breaker.state == CircuitState.CLOSED
+                and name not in self.changed
+                and now - host.used >= self.settings.idle_after
+            ):
+                del self.hosts[name]
+
+    async def save(self):
+        """
+        Save the hosts used since the last save, and forget the idle ones
+        """
+        names, self.changed = self.changed, set()
+        if self.session_factory is not None and names:
+            async with self.session_factory() as session:
+                for row in self.snapshot(names):
+                    await session.merge(row)
+                await session.commit()
+        self.evict()
+
+    async def run(self):
+        # Like the enrichment workers, in case the pool swallows the cancel
+        while not self.stopping:
+            await asyncio.sleep(self.settings.save_interval)
+            try:
+                await self.save()
+            except Exception:
+                logger.exception("Error saving the host states")
+
+    async def start(self):
+        self.stopping = False
+        self.task = asyncio.create_task(self.run(), name="host-status")
+
+    async def stop(self):
+        self.stopping = True
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.save()
@@ -0,0 +1,347 @@
+"""
+Import of the links in a Telegram Desktop export.
+
+The export is parsed as a stream, one message at a time, so it doesn't need
+to fit in memory. The urls are deduplicated in file order, scraped
+concurrently while the next messages are read, and stored in large
+transactions. After each commit the position in the file is saved in a
+checkpoint, an interrupted import started again continues from there.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from collections import deque
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from random import randint
+from typing import TextIO
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from telegram import Chat, Message, User
+
+from rejubot.dedup import RecentUrls
+from rejubot.enrichment import enqueue
+from rejubot.scraper import Scraper, UrlMetadata, scrape_og_metadata
+from rejubot.telegrambot import create_entry, filter_new_urls
+
+logger = logging.getLogger(__name__)
+CHUNK_SIZE = 64 * 1024
+# Start of the messages in a full export, {"name": ..., "messages": [...]}
+MESSAGES_KEY = re.compile(r'"messages"\s*:\s*\[')
+FROM_USER_ID = re.compile(r"user(\d+)")
+# Messages going back more than this are out of order. The duplicates are
+# only looked for in the past, newest first every older share of an url
+# would be dropped.
+OUT_OF_ORDER = timedelta(minutes=1)
+
+
+def iter_json_array(file: TextIO, chunk_size: int = CHUNK_SIZE) -> Iterator:
+    """
+    Yield the items of the messages array of an export, reading it by chunks.
+
+    Works with the full export, where the array is under "messages", and with
+    an export already filtered into an array.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+
+    def read() -> bool:
+        nonlocal buffer
+        chunk = file.read(chunk_size)
+        buffer += chunk
+        return bool(chunk)
+
+    # Find the opening bracket of the array
+    while True:
+        start = buffer.lstrip()
+        if start.startswith("["):
+            pos = len(buffer) - len(start) + 1
+            break
+        if start.startswith("{") and (found := MESSAGES_KEY.search(buffer)):
+            pos = found.end()
+            break
+        if not read():
+            raise ValueError("No messages array found in the export")
+
+    while True:
+        # Skip the separators between items
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos == len(buffer):
+            buffer, pos = "", 0
+            if not read():
+                raise ValueError("Unexpected end of the export")
+            continue
+        if buffer[pos] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # The item continues in the next chunk
+            buffer, pos = buffer[pos:], 0
+            if not read():
+                raise
+            continue
+        yield item
+        pos = end
+
+
+def message_links(msg: dict) -> list[str]:
+    return [
+        entity["text"]
+        for entity in msg.get("text_entities", [])
+        if entity["type"] == "link" and entity["text"].startswith("http")
+    ]
+
+
+def message_date(msg: dict) -> datetime:
+    """
+    Date of an exported message in UTC. The "date" field is in the timezone of
+    the client that exported it, "date_unixtime" isn't ambiguous.
+    """
+    return datetime.fromtimestamp(int(msg["date_unixtime"]), timezone.utc)
+
+
+def render_message(entries: list | str) -> str:
+    """
+    Render a message from the Telegram API text element as a string.
+
+    It will detect the MessageEntityType, and for each type it will render the text.
+    """
+    if isinstance(entries, str):
+        return entries
+    result = []
+    for entry in entries:
+        if isinstance(entry, str):
+            result.append(entry)
+        else:
+            result.append(entry["text"])
+    return "".join(result)
+
+
+def to_message(msg: dict, channel_id: int, channel_name: str) -> Message:
+    from_id = FROM_USER_ID.fullmatch(msg.get("from_id") or "")
+    return Message(
+        message_id=msg["id"],
+        date=message_date(msg),
+        chat=Chat(id=channel_id, type="channel", title=channel_name),
+        text=render_message(msg["text"]),
+        from_user=User(
+            first_name=msg.get("from") or "",
+            id=int(from_id.group(1)) if from_id else randint(1, 1000000),
+            is_bot=False,
+        ),
+    )
+
+
+def iter_link_messages(import_file: Path) -> Iterator[tuple[int, dict]]:
+    """
+    Messages with links of the export, with their position in the file
+    """
+    with open(import_file, encoding="utf-8") as file:
+        for position, msg in enumerate(iter_json_array(file)):
+            if msg.get("type", "message") == "message" and message_links(msg):
+                yield position, msg
+
+
+def check_order(msg: dict, date: datetime, latest: datetime | None) -> datetime:
+    """
+    Latest date seen with the message, raising ValueError when the message
+    goes back more than OUT_OF_ORDER from it
+    """
+    if latest is not None and date < latest - OUT_OF_ORDER:
+        raise ValueError(
+            f"Message {msg['id']} of {date} comes after one "
+            f"of {latest}, the export has to be oldest first"
+        )
+    return max(latest or date, date)
+
+
+def iter_export_links(import_file: Path) -> Iterator[tuple[datetime, str]]:
+    """
+    Date and url of the links of the export, which has to be oldest first like
+    for the import
+    """
+    latest = None
+    for _, msg in iter_link_messages(import_file):
+        date = message_date(msg)
+        latest = check_order(msg, date, latest)
+        for url in message_links(msg):
+            yield date, url
+
+
+def export_date_range(import_file: Path) -> tuple[datetime, datetime] | None:
+    dates = [None, None]
+    for _, msg in iter_link_messages(import_file):
+        date = message_date(msg)
+        if dates[0] is None or date < dates[0]:
+            dates[0] = date
+        if dates[1] is None or date > dates[1]:
+            dates[1] = date
+    return None if dates[0] is None else (dates[0], dates[1])
+
+
+def read_checkpoint(checkpoint: Path) -> int:
+    """
+    Position of the first message not imported yet
+    """
+    try:
+        return json.loads(checkpoint.read_text())["position"]
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(checkpoint: Path, position: int, progress: "ImportProgress"):
+    tmp = checkpoint.with_name(checkpoint.name + ".tmp")
+    tmp.write_text(json.dumps(dict(position=position, entries=progress.entries)) + "\n")
+    # A crash while writing keeps the previous checkpoint
+    os.replace(tmp, checkpoint)
+
+
+@dataclass
+class ImportProgress:
+    messages: int = 0
+    links: int = 0
+    entries: int = 0
+    started: float = field(default_factory=time.monotonic)
+
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (
+            f"{self.messages} messages ({self.messages / elapsed:.1f}/s), "
+            f"{self.links} links ({self.links / elapsed:.1f}/s), "
+            f"{self.entries} entries stored in {elapsed:.0f}s"
+        )
+
+
+@dataclass
+class PendingMessage:
+    position: int
+    message: Message
+    urls: list[str]
+    scrapes: list[asyncio.Task]
+
+    def done(self) -> bool:
+        return all(task.done() for task in self.scrapes)
+
+
+async def import_export(
+    import_file: Path,
+    channel_id: int,
+    channel_name: str,
+    session_factory: async_sessionmaker,
+    scraper: Scraper | None,
+    concurrency: int = 5,
+    batch_size: int = 1000,
+    checkpoint: Path | None = None,
+    report_interval: float = 10,
+) -> ImportProgress:
+    """
+    Import the links of the export into the channel.
+
+    Without a scraper the entries are stored as pending and queued for the
+    enrichment workers. Up to concurrency scrapes run at the same time, and
+    the entries are committed every batch_size links.
+
+    The messages must be oldest first, like Telegram Desktop exports them,
+    otherwise it stops with a ValueError.
+    """
+    start = read_checkpoint(checkpoint) if checkpoint is not None else 0
+    if start:
+        logger.info("Resuming the import from message %d", start)
+
+    progress = ImportProgress()
+    semaphore = asyncio.Semaphore(concurrency)
+    window: deque[PendingMessage] = deque()
+    recent = RecentUrls()
+    uncommitted = 0
+    last_report = time.monotonic()
+    latest: datetime | None = None
+
+    async def scrape(url: str) -> UrlMetadata | None:
+        async with semaphore:
+            try:
+                return await scrape_og_metadata(url, scraper)
+            except Exception:
+                logger.exception("Error scraping %s", url)
+                return None
+
+    async def store_finished(session: AsyncSession):
+        """
+        Add the entries of the messages whose scrapes finished, in file order
+        """
+        nonlocal uncommitted, last_report
+        while window and window[0].done():
+            pending = window.popleft()
+            results = [task.result() for task in pending.scrapes]
+            entries = [
+                create_entry(pending.message, url, metadata)
+                for url, metadata in zip(
+                    pending.urls, results or [None] * len(pending.urls)
+                )
+            ]
+            session.add_all(entries)
+            if scraper is None:
+                enqueue(session, entries)
+            progress.entries += len(entries)
+            uncommitted += len(entries)
+            if uncommitted >= batch_size:
+                await commit(session, pending.position + 1)
+            if time.monotonic() - last_report >= report_interval:
+                last_report = time.monotonic()
+                logger.info("Imported %s", progress.summary())
+
+    async def commit(session: AsyncSession, position: int | None = None):
+        nonlocal uncommitted
+        await session.commit()
+        # The committed entries aren't needed any more
+        session.expunge_all()
+        uncommitted = 0
+        if checkpoint is not None and position is not None:
+            write_checkpoint(checkpoint, position, progress)
+
+    async with session_factory() as session:
+        try:
+            for position, msg in iter_link_messages(import_file):
+                if position < start:
+                    continue
+                message = to_message(msg, channel_id, channel_name)
+                latest = check_order(msg, message.date, latest)
+                links = message_links(msg)
+                progress.messages += 1
+                progress.links += len(links)
+                # In file order, the recent urls know the ones not stored yet,
+                # flushing them before every duplicate query would undo the batch
+                with session.no_autoflush:
+                    urls = await filter_new_urls(message, links, session, recent)
+                scrapes = []
+                if scraper is not None:
+                    scrapes = [asyncio.create_task(scrape(url)) for url in urls]
+                window.append(PendingMessage(position, message, urls, scrapes))
+
+                # Keep a bounded number of scrapes waiting
+                while sum(len(p.scrapes) for p in window) > concurrency * 4:
+                    await asyncio.wait(window[0].scrapes)
+                    await store_finished(session)
+                await store_finished(session)
+
+            while window:
+                if window[0].scrapes:
+                    await asyncio.wait(window[0].scrapes)
+                await store_finished(session)
+            await commit(session)
+        finally:
+            for pending in window:
+                for task in pending.scrapes:
+                    task.cancel()
+
+    if checkpoint is not None:
+        checkpoint.unlink(missing_ok=True)
+    logger.info("Import finished: %s", progress.summary())
+    return progress
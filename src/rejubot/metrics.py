@@ -0,0 +1,325 @@
+"""
+Counters and latency histograms of the bot and the web, in the Prometheus
+text format.
+
+Each process (the bot and the web run apart) has its own registry. The web
+serves it at /metrics, and the bot from a small listener when
+monitoring.metrics_port is set. Metrics are only updated from the event
+loop thread, so there are no locks: an update is a dict lookup and, for
+histograms, a bisect over the buckets.
+"""
+
+import logging
+import time
+from bisect import bisect_left
+from collections.abc import Iterator, Sequence
+from contextlib import contextmanager
+from typing import TypeVar
+from urllib.parse import urlsplit
+
+from aiohttp import web
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger(__name__)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds, from a cached lookup to a slow scrape
+BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+)
+# Label values past this many series of a metric are counted as OTHER, so
+# urls from all over the internet don't grow it without end
+MAX_SERIES = 500
+OTHER = "other"
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = ""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        max_series=MAX_SERIES,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.max_series = max_series
+        self.series: dict[tuple[str, ...], object] = {}
+
+    def key(self, values: tuple[str, ...]) -> tuple[str, ...]:
+        if len(values) != len(self.labels):
+            raise ValueError(f"{self.name} has the labels {self.labels}, not {values}")
+        if values not in self.series and len(self.series) >= self.max_series:
+            return (OTHER,) * len(values)
+        return values
+
+    def header(self, name: str | None = None) -> Iterator[str]:
+        name = name or self.name
+        yield f"# HELP {name} {escape(self.documentation)}"
+        yield f"# TYPE {name} {self.kind}"
+
+    def render(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def clear(self):
+        self.series.clear()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1):
+        key = self.key(labels)
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self.series.get(labels, 0)
+
+    def render(self) -> Iterator[str]:
+        # Declared with the name of its samples, or the scrapers see an
+        # untyped metric next to an empty counter
+        yield from self.header(f"{self.name}_total")
+        for values, value in self.series.items():
+            labels = format_labels(self.labels, values)
+            yield f"{self.name}_total{labels} {format_value(value)}"
+
+
+class Series:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self, buckets: int):
+        # The last one is +Inf
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0.0
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = BUCKETS,
+        max_series=MAX_SERIES,
+    ):
+        super().__init__(name, documentation, labels, max_series)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str):
+        key = self.key(labels)
+        if (series := self.series.get(key)) is None:
+            series = self.series[key] = Series(len(self.buckets))
+        series.counts[bisect_left(self.buckets, value)] += 1
+        series.sum += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def count(self, *labels: str) -> int:
+        series = self.series.get(labels)
+        return sum(series.counts) if series else 0
+
+    def render(self) -> Iterator[str]:
+        yield from self.header()
+        for values, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series.counts):
+                cumulative += count
+                labels = format_labels(
+                    self.labels, values, f'le="{format_value(bound)}"'
+                )
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = format_labels(self.labels, values)
+            yield f"{self.name}_sum{labels} {format_value(series.sum)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+M = TypeVar("M", bound=Metric)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Metric] = {}
+
+    def register(self, metric: M) -> M:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        for metric in self.metrics.values():
+            metric.clear()
+
+
+REGISTRY = Registry()
+
+UPDATES = REGISTRY.register(
+    Counter("rejubot_updates", "Telegram updates handled, by kind", ["kind"])
+)
+URLS = REGISTRY.register(
+    Counter(
+        "rejubot_urls",
+        "Urls of the messages: found, and then processed already in an "
+        "earlier version of the message, repeated in the message, skipped by "
+        "hostname, duplicated in the last 24h or new",
+        ["outcome"],
+    )
+)
+BUFFERED = REGISTRY.register(
+    Counter(
+        "rejubot_buffered_entries",
+        "Entries of the write buffer stored, or failed and dropped",
+        ["outcome"],
+    )
+)
+SCRAPES = REGISTRY.register(
+    Histogram(
+        "rejubot_scrape_seconds",
+        "Seconds getting the metadata of an url, by outcome and host",
+        ["outcome", "host"],
+    )
+)
+PARSE = REGISTRY.register(
+    Histogram("rejubot_parse_seconds", "Seconds parsing the metadata of html pages")
+)
+DB_QUERIES = REGISTRY.register(
+    Histogram(
+        "rejubot_db_query_seconds", "Seconds of database statements", ["statement"]
+    )
+)
+DB_COMMITS = REGISTRY.register(
+    Histogram(
+        "rejubot_db_commit_seconds", "Seconds committing sessions, flush included"
+    )
+)
+RENDERS = REGISTRY.register(
+    Histogram(
+        "rejubot_links_render_seconds",
+        "Seconds answering link pages, by template and how it was answered",
+        ["template", "outcome"],
+    )
+)
+LOOP_LAG = REGISTRY.register(
+    Histogram(
+        "rejubot_event_loop_lag_seconds",
+        "Seconds the event loop woke up late from a sleep",
+        buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+    )
+)
+
+
+def url_host(url: str) -> str:
+    try:
+        return urlsplit(url).hostname or OTHER
+    except ValueError:
+        return OTHER
+
+
+STATEMENTS = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH"}
+
+
+def statement_kind(statement: str) -> str:
+    kind = statement.lstrip()[:6].upper()
+    if kind in STATEMENTS or (kind := kind[:4]) in STATEMENTS:
+        return kind.lower()
+    return OTHER
+
+
+def instrument_engine(engine: AsyncEngine):
+    """
+    Time the statements run by the engine in DB_QUERIES
+    """
+
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("metrics_started", []).append(time.perf_counter())
+
+    def after(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["metrics_started"].pop()
+        DB_QUERIES.observe(time.perf_counter() - started, statement_kind(statement))
+
+    def error(context):
+        if started := context.connection.info.get("metrics_started"):
+            started.pop()
+
+    event.listen(engine.sync_engine, "before_cursor_execute", before)
+    event.listen(engine.sync_engine, "after_cursor_execute", after)
+    event.listen(engine.sync_engine, "handle_error", error)
+
+
+class MetricsServer:
+    """
+    Listener serving the registry at /metrics, for processes without a web app
+    """
+
+    def __init__(self, host: str, port: int, registry: Registry = REGISTRY):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.runner: web.AppRunner | None = None
+
+    async def metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            body=self.registry.render().encode(), headers={"Content-Type": CONTENT_TYPE}
+        )
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/metrics", self.metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        logger.info("Metrics at http://%s:%d/metrics", self.host, self.port)
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
@@ -0,0 +1,59 @@
+import asyncio
+import logging
+import statistics
+from collections import deque
+
+from rejubot.metrics import LOOP_LAG
+
+logger = logging.getLogger(__name__)
+
+
+class LoopLagMonitor:
+    """
+    Measures how late the event loop wakes up from a sleep.
+
+    Anything blocking the loop (parsing, slow sync code) shows up as lag, and
+    while it lasts no update, request or timer is handled.
+    """
+
+    def __init__(self, interval: float = 0.5, warning: float = 0.5, samples=1000):
+        self.interval = interval
+        self.warning = warning
+        self.lags: deque[float] = deque(maxlen=samples)
+        self.task: asyncio.Task | None = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self.run(), name="loop-lag-monitor")
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.record(loop.time() - start - self.interval)
+
+    def record(self, lag: float):
+        self.lags.append(lag)
+        LOOP_LAG.observe(max(lag, 0.0))
+        if lag >= self.warning:
+            logger.warning("Event loop blocked for %.3fs", lag)
+
+    def summary(self) -> dict[str, float]:
+        """
+        Lag of the recent samples in seconds
+        """
+        if not self.lags:
+            return dict(samples=0, mean=0.0, p95=0.0, max=0.0)
+        lags = sorted(self.lags)
+        return dict(
+            samples=len(lags),
+            mean=statistics.fmean(lags),
+            p95=lags[min(len(lags) - 1, int(len(lags) * 0.95))],
+            max=lags[-1],
+        )
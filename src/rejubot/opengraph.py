@@ -0,0 +1,118 @@
+"""
+Open Graph metadata extraction.
+
+The meta tags are collected in a single pass of the html tokenizer, without
+building a document tree, and only over the <head> when it has enough
+metadata.
+"""
+
+import re
+from dataclasses import dataclass
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+
+HEAD_END = re.compile(r"</head\s*>|<body[\s>]", re.IGNORECASE)
+
+
+@dataclass
+class UrlMetadata:
+    site: str | None
+    title: str | None
+    description: str | None
+    image: str | None
+    video_url: str | None
+    video_type: str | None
+    video_width: int | None
+    video_height: int | None
+
+
+class MetaTagParser(HTMLParser):
+    """
+    Collects the content of the meta tags by property and by name.
+
+    Like searching the document, the first tag for each property or name wins.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.properties: dict[str, str | None] = {}
+        self.names: dict[str, str | None] = {}
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]):
+        if tag != "meta":
+            return
+        attributes = dict(attrs)
+        content = attributes.get("content")
+        if (property := attributes.get("property")) is not None:
+            self.properties.setdefault(property, content)
+        if (name := attributes.get("name")) is not None:
+            self.names.setdefault(name, content)
+
+    def has_metadata(self) -> bool:
+        return any(
+            key in self.properties or key in self.names
+            for key in ("og:title", "og:description", "twitter:title")
+        )
+
+
+def parse_meta_tags(html: str) -> MetaTagParser:
+    """
+    Parse the head of the document, and the rest of it only when the head
+    doesn't have any metadata.
+    """
+    parser = MetaTagParser()
+    head_end = HEAD_END.search(html)
+    if head_end is None:
+        parser.feed(html)
+    else:
+        parser.feed(html[: head_end.start()])
+        if not parser.has_metadata():
+            parser.feed(html[head_end.start() :])
+    parser.close()
+    return parser
+
+
+def parse_og_metadata(html: str, url: str) -> UrlMetadata | None:
+    parser = parse_meta_tags(html)
+    gets = parser.properties.get
+    gets_name = parser.names.get
+
+    if url.startswith("https://vxtwitter.com"):
+        og_site = "Twitter / X"
+        og_title = gets_name("twitter:title")
+        og_image = gets_name("twitter:image")
+    else:
+        og_site = gets("og:site_name")
+        og_title = gets("og:title")
+        og_image = gets("og:image")
+
+    if og_image == "0" or og_image == "null":
+        og_image = None
+
+    video_url = gets("og:video")
+    video_type = gets("og:video:type")
+    # Some times there is a video link without a type, meaning it is another
+    # website. So it is not a real video.
+    if not video_type:
+        video_url = None
+    # Some sites, like ddinstagram, give urls relative to the page
+    if og_image:
+        og_image = urljoin(url, og_image)
+    if video_url:
+        video_url = urljoin(url, video_url)
+    video_width = gets("og:video:width")
+    video_height = gets("og:video:height")
+
+    og_description = gets("og:description")
+    if og_title is None and og_description is None:
+        return None
+    return UrlMetadata(
+        site=og_site,
+        title=og_title,
+        description=og_description,
+        image=og_image,
+        video_url=video_url,
+        video_type=video_type,
+        video_width=video_width,
+        video_height=video_height,
+    )
@@ -0,0 +1,84 @@
+"""
+Keyset pagination of the url entries, newest first.
+
+A page continues after the last entry of the previous one, ordered by
+(created_at, id), so every page is an index range scan no matter how deep
+it is, instead of an OFFSET or a date() over the whole table.
+"""
+
+from dataclasses import dataclass
+from datetime import date, datetime, time
+
+from sqlalchemy import Select, select, tuple_
+from sqlalchemy.orm import joinedload
+
+from rejubot.storage import UrlEntry
+
+
+@dataclass(frozen=True)
+class Cursor:
+    """
+    Position after which the next page starts
+    """
+
+    created_at: datetime
+    id: int
+
+    def encode(self) -> str:
+        return f"{self.created_at.isoformat()}_{self.id}"
+
+    @classmethod
+    def decode(cls, value: str) -> "Cursor":
+        """
+        Raises ValueError for cursors not made by encode
+        """
+        created_at, _, id = value.rpartition("_")
+        return cls(datetime.fromisoformat(created_at), int(id))
+
+    @classmethod
+    def before_day(cls, day: date) -> "Cursor":
+        """
+        Cursor for the entries older than the day
+        """
+        return cls(datetime.combine(day, time.min), 0)
+
+    @classmethod
+    def after_entry(cls, entry: UrlEntry) -> "Cursor":
+        return cls(entry.created_at, entry.id)
+
+
+def keyset_page(query: Select, cursor: Cursor | None, page_size: int) -> Select:
+    """
+    Newest entries of the query after the cursor
+    """
+    if cursor is not None:
+        query = query.where(
+            tuple_(UrlEntry.created_at, UrlEntry.id) < (cursor.created_at, cursor.id)
+        )
+    return query.order_by(UrlEntry.created_at.desc(), UrlEntry.id.desc()).limit(
+        page_size
+    )
+
+
+def page_query(
+    cursor: Cursor | None, page_size: int, channel_id: int | None = None
+) -> Select:
+    """
+    Page of all the channels, or of one with its (channel_id, created_at) index
+    """
+    query = select(UrlEntry).options(joinedload(UrlEntry.video))
+    if channel_id is not None:
+        query = query.where(UrlEntry.channel_id == channel_id)
+    return keyset_page(query, cursor, page_size)
+
+
+def group_by_day(entries: list[UrlEntry]) -> list[tuple[date, list[UrlEntry]]]:
+    """
+    Split entries, already sorted, by their day
+    """
+    days = []
+    for entry in entries:
+        if not days or days[-1][0] != entry.created_day:
+            days.append((entry.created_day, []))
+        days[-1][1].append(entry)
+    return days
@@ -0,0 +1,118 @@
+"""
+Metadata from the APIs of the sites that have one.
+
+Pages of sites like YouTube are megabytes of html for a handful of meta
+tags. Their oEmbed or JSON endpoints give the same metadata in a few
+hundred bytes. Providers are found by the hostname of the url to fetch (see
+rejubot.canonical.fetch_url), and a url a provider doesn't handle, or that
+its endpoint fails to answer, is scraped from the html as usual.
+"""
+
+import re
+from collections.abc import Callable
+from dataclasses import dataclass
+from urllib.parse import SplitResult, quote, urlsplit, urlunsplit
+
+from rejubot.opengraph import UrlMetadata
+
+TWEET_PATH = re.compile(r"/[^/]+/status/\d+")
+
+
+@dataclass(frozen=True)
+class Provider:
+    name: str
+    # Url of the endpoint for the url, None when the provider doesn't handle it
+    endpoint: Callable[[SplitResult], str | None]
+    # Metadata from the JSON answer of the endpoint and the url
+    parse: Callable[[dict, str], UrlMetadata | None]
+
+
+def oembed_endpoint(
+    base: str, handles: Callable[[str], bool]
+) -> Callable[[SplitResult], str | None]:
+    def endpoint(parts: SplitResult) -> str | None:
+        if not handles(parts.path):
+            return None
+        return f"{base}?format=json&url={quote(urlunsplit(parts), safe='')}"
+
+    return endpoint
+
+
+def parse_oembed(data: dict, url: str) -> UrlMetadata | None:
+    if not data.get("title"):
+        return None
+    return UrlMetadata(
+        site=data.get("provider_name"),
+        title=data["title"],
+        description=data.get("author_name"),
+        image=data.get("thumbnail_url"),
+        video_url=None,
+        video_type=None,
+        video_width=None,
+        video_height=None,
+    )
+
+
+def vxtwitter_endpoint(parts: SplitResult) -> str | None:
+    if not TWEET_PATH.match(parts.path):
+        return None
+    return f"https://api.vxtwitter.com{parts.path}"
+
+
+def parse_vxtwitter(data: dict, url: str) -> UrlMetadata | None:
+    if not data.get("user_screen_name"):
+        return None
+    media = data.get("media_extended") or []
+    videos = [item for item in media if item.get("type") in ("video", "gif")]
+    images = [item for item in media if item.get("type") == "image"]
+    image = images[0]["url"] if images else None
+    video = videos[0] if videos else {}
+    if image is None and video:
+        image = video.get("thumbnail_url")
+    size = video.get("size") or {}
+    return UrlMetadata(
+        site="Twitter / X",
+        title=f"{data.get('user_name')} (@{data['user_screen_name']})",
+        description=data.get("text"),
+        image=image,
+        video_url=video.get("url"),
+        video_type="video/mp4" if video else None,
+        video_width=size.get("width"),
+        video_height=size.get("height"),
+    )
+
+
+YOUTUBE = Provider(
+    "youtube",
+    oembed_endpoint(
+        "https://www.youtube.com/oembed",
+        lambda path: path == "/watch" or path.startswith("/shorts/"),
+    ),
+    parse_oembed,
+)
+TIKTOK = Provider(
+    "tiktok",
+    oembed_endpoint("https://www.tiktok.com/oembed", lambda path: "/video/" in path),
+    parse_oembed,
+)
+VXTWITTER = Provider("vxtwitter", vxtwitter_endpoint, parse_vxtwitter)
+
+# Hostname of the url to fetch -> provider
+PROVIDERS: dict[str, Provider] = {
+    "www.youtube.com": YOUTUBE,
+    "www.tiktok.com": TIKTOK,
+    "vxtwitter.com": VXTWITTER,
+}
+
+
+def provider_endpoint(
+    url: str, providers: dict[str, Provider]
+) -> tuple[Provider, str] | None:
+    """
+    The provider of the url and its endpoint, if there is one
+    """
+    parts = urlsplit(url)
+    provider = providers.get(parts.hostname or "")
+    if provider is None or (endpoint := provider.endpoint(parts)) is None:
+        return None
+    return provider, endpoint
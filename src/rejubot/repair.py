@@ -0,0 +1,142 @@
+"""
+Scrape again the metadata of stored urls.
+
+The entries are read in chunks, newest first, and the urls of a chunk are
+scraped concurrently. The host scheduler of the scraper keeps a repair from
+hammering a single site. The changes of a chunk are written in one transaction, and the
+id of its last entry is the resume token to continue an interrupted repair.
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import Select, or_, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import selectinload
+
+from rejubot.enrichment import assign_metadata
+from rejubot.scraper import Scraper, UrlMetadata, scrape_og_metadata
+from rejubot.storage import UrlEntry
+
+logger = logging.getLogger(__name__)
+
+
+def repair_query(
+    regex_filter: str | None = None,
+    missing_title: bool = False,
+    older_than_days: float | None = None,
+    now: datetime | None = None,
+) -> Select:
+    query = select(UrlEntry).options(selectinload(UrlEntry.video))
+    if regex_filter:
+        query = query.where(UrlEntry.url.regexp_match(regex_filter))
+    if missing_title:
+        query = query.where(or_(UrlEntry.og_title.is_(None), UrlEntry.og_title == ""))
+    if older_than_days is not None:
+        now = now or datetime.now(timezone.utc)
+        query = query.where(UrlEntry.created_at < now - timedelta(days=older_than_days))
+    return query
+
+
+def metadata_changes(
+    entry: UrlEntry, metadata: UrlMetadata
+) -> dict[str, tuple[str | None, str | None]]:
+    """
+    Fields of the entry that the metadata changes, with the old and new values
+    """
+    values = dict(
+        og_title=(entry.og_title, metadata.title),
+        og_description=(entry.og_description, metadata.description),
+        og_image=(entry.og_image, metadata.image),
+        og_site=(entry.og_site, metadata.site),
+    )
+    # Like assign_metadata, an entry doesn't lose its video
+    if metadata.video_url:
+        old_video = entry.video.url if entry.video is not None else None
+        values["video"] = (old_video, metadata.video_url)
+    return {name: (old, new) for name, (old, new) in values.items() if old != new}
+
+
+@dataclass
+class RepairStats:
+    checked: int = 0
+    changed: int = 0
+    failed: int = 0
+    last_id: int | None = None
+    started: float = field(default_factory=time.monotonic)
+
+    def summary(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return (
+            f"{self.checked} checked ({self.checked / elapsed:.1f}/s), "
+            f"{self.changed} changed, {self.failed} without metadata, "
+            f"resume with --resume_from={self.last_id}"
+        )
+
+
+async def repair_entries(
+    session_factory: async_sessionmaker,
+    scraper: Scraper,
+    query: Select,
+    concurrency: int = 5,
+    batch_size: int = 500,
+    resume_from: int | None = None,
+    dry_run: bool = False,
+    refresh: bool = False,
+) -> RepairStats:
+    """
+    Scrape the entries of the query again, newest first, and store the
+    changed metadata. Starts after the id resume_from when given.
+
+    With dry_run the changes are logged and nothing is written. With refresh
+    the cached pages are revalidated instead of used while they are fresh.
+    """
+    stats = RepairStats(last_id=resume_from)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def scrape(url: str) -> UrlMetadata | None:
+        async with semaphore:
+            try:
+                return await scrape_og_metadata(url, scraper, refresh)
+            except Exception:
+                logger.exception("Error scraping %s", url)
+                return None
+
+    async with session_factory() as session:
+        while True:
+            chunk = query.order_by(UrlEntry.id.desc()).limit(batch_size)
+            if stats.last_id is not None:
+                chunk = chunk.where(UrlEntry.id < stats.last_id)
+            entries = (await session.scalars(chunk)).all()
+            if not entries:
+                break
+
+            results = await asyncio.gather(*(scrape(entry.url) for entry in entries))
+            for entry, metadata in zip(entries, results):
+                stats.checked += 1
+                if metadata is None:
+                    stats.failed += 1
+                    continue
+                changes = metadata_changes(entry, metadata)
+                if not changes:
+                    continue
+                stats.changed += 1
+                for name, (old, new) in changes.items():
+                    logger.info(
+                        "%d %s %s: %r -> %r", entry.id, entry.url, name, old, new
+                    )
+                if not dry_run:
+                    assign_metadata(entry, metadata)
+
+            stats.last_id = entries[-1].id
+            if dry_run:
+                await session.rollback()
+            else:
+                await session.commit()
+            session.expunge_all()
+            logger.info("Repaired %s", stats.summary())
+
+    return stats
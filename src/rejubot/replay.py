@@ -0,0 +1,413 @@
+"""
+Replay of link messages through the bot, without Telegram or the internet.
+
+The Application is the one of create_app, with the Bot API answered
+locally by ReplayRequest. Updates are fed to it at a fixed rate, like
+polling would, and every url is scraped from a local stand-in server: the
+hostnames become <host>.replay.test and resolve to it. The canonical url
+rules of the real sites don't apply to them, and providers are disabled.
+
+The messages are synthetic, or the link messages of a Telegram Desktop
+export. Entries go to a scratch database.
+"""
+
+import asyncio
+import json
+import logging
+import random
+import socket
+import statistics
+import tempfile
+from collections import Counter
+from collections.abc import AsyncIterator, Iterable, Iterator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit
+
+from aiohttp import web
+from aiohttp.abc import AbstractResolver
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from telegram import Chat, Message, MessageEntity, Update, User
+from telegram.ext import Application
+from telegram.request import BaseRequest, RequestData
+
+from rejubot.importer import iter_link_messages
+from rejubot.settings import Settings
+from rejubot.storage import (
+    Base,
+    MetadataStatus,
+    ScrapeJob,
+    UrlEntry,
+    checkpoint_wal,
+    create_engine,
+)
+from rejubot.telegrambot import create_app, start_background, stop_background
+
+logger = logging.getLogger(__name__)
+REPLAY_DOMAIN = "replay.test"
+BOT_USER = dict(id=1, is_bot=True, first_name="Replay", username="replay_bot")
+PAGE = """<html><head>
+<meta property="og:site_name" content="{host}">
+<meta property="og:title" content="Title for {path}">
+<meta property="og:description" content="Description for {path}">
+<meta property="og:image" content="http://{host}/image.png">
+</head><body><p>Stand-in page</p></body></html>"""
+WORDS = ["look", "this", "lol", "news", "again", "no way", "😀", "ñandú"]
+
+# A message as pieces of text, each with whether it is an url
+Pieces = list[tuple[str, bool]]
+
+
+class ReplayRequest(BaseRequest):
+    """
+    Answers the Bot API calls of the bot without network, counting them.
+    Sent messages (the error reports) are accepted and dropped.
+    """
+
+    def __init__(self):
+        self.calls: Counter[str] = Counter()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    async def do_request(
+        self,
+        url: str,
+        method: str,
+        request_data: RequestData | None = None,
+        read_timeout=None,
+        write_timeout=None,
+        connect_timeout=None,
+        pool_timeout=None,
+    ) -> tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        result = True
+        if api_method == "getMe":
+            result = BOT_USER
+        elif api_method == "sendMessage":
+            params = request_data.parameters if request_data else {}
+            result = dict(
+                message_id=self.calls[api_method],
+                date=int(datetime.now(timezone.utc).timestamp()),
+                chat=dict(id=params.get("chat_id", 0), type="private"),
+                text=str(params.get("text", "")),
+            )
+        return 200, json.dumps(dict(ok=True, result=result)).encode()
+
+
+class StandInResolver(AbstractResolver):
+    """
+    Resolves every hostname to localhost, where the stand-in server is
+    """
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        return [
+            dict(
+                hostname=host,
+                host="127.0.0.1",
+                port=port,
+                family=socket.AF_INET,
+                proto=0,
+                flags=socket.AI_NUMERICHOST,
+            )
+        ]
+
+    async def close(self):
+        pass
+
+
+@asynccontextmanager
+async def stand_in_server(delay: float) -> AsyncIterator[int]:
+    """
+    Server answering any url with Open Graph tags after delay seconds, yields
+    its port
+    """
+
+    async def page(request: web.Request) -> web.Response:
+        await asyncio.sleep(delay)
+        body = PAGE.format(host=request.host, path=request.path_qs)
+        return web.Response(text=body, content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", page)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    try:
+        yield site._server.sockets[0].getsockname()[1]
+    finally:
+        await runner.cleanup()
+
+
+def stand_in_url(url: str, port: int) -> str:
+    """
+    The url on the stand-in server, keeping its host apart from the others
+    """
+    parts = urlsplit(url)
+    netloc = f"{parts.hostname}.{REPLAY_DOMAIN}:{port}"
+    return urlunsplit(("http", netloc, parts.path, parts.query, ""))
+
+
+def link_message(
+    pieces: Pieces, message_id: int, chat_id: int, user_id: int = 1
+) -> Message:
+    """
+    Message joining the pieces, with an url entity for each url
+    """
+    text, entities = "", []
+    for piece, is_url in pieces:
+        if is_url:
+            # Offsets are in UTF-16 code units
+            offset = len(text.encode("utf-16-le")) // 2
+            length = len(piece.encode("utf-16-le")) // 2
+            entities.append(MessageEntity(MessageEntity.URL, offset, length))
+        text += piece
+    return Message(
+        message_id=message_id,
+        date=datetime.now(timezone.utc),
+        chat=Chat(id=chat_id, type="supergroup"),
+        text=text,
+        entities=entities,
+        from_user=User(id=user_id, first_name=f"User {user_id}", is_bot=False),
+    )
+
+
+def synthetic_messages(
+    count: int, links: int, hosts: int, repeated: float, port: int, seed: int = 0
+) -> Iterator[Pieces]:
+    """
+    Messages with 1 to links urls over hosts sites. A repeated part of the
+    urls were already posted.
+    """
+    rng = random.Random(seed)
+    posted = []
+    for idx in range(count):
+        pieces = []
+        for link in range(rng.randint(1, links)):
+            text = " ".join(rng.choices(WORDS, k=rng.randint(1, 8)))
+            pieces.append((text + " ", False))
+            if posted and rng.random() < repeated:
+                url = rng.choice(posted)
+            else:
+                host = f"site{rng.randrange(hosts)}.example"
+                url = stand_in_url(f"https://{host}/post/{idx}/{link}", port)
+                posted.append(url)
+            pieces.append((url, True))
+            pieces.append((" ", False))
+        yield pieces
+
+
+def recorded_messages(import_file: Path, port: int) -> Iterator[Pieces]:
+    """
+    The link messages of a Telegram Desktop export, with their urls on the
+    stand-in server
+    """
+    for _, msg in iter_link_messages(import_file):
+        pieces = []
+        for entity in msg.get("text_entities", []):
+            text = entity["text"]
+            if entity["type"] == "link" and text.startswith("http"):
+                pieces.append((stand_in_url(text, port), True))
+            else:
+                pieces.append((text, False))
+        yield pieces
+
+
+def percentile(values: list[float], part: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * part))]
+
+
+@dataclass
+class ReplayStats:
+    messages: int = 0
+    elapsed: float = 0.0
+    # Seconds the enrichment workers needed after the last message
+    drained: float = 0.0
+    # From the moment the update was due to the end of its handling
+    latencies: list[float] = field(default_factory=list)
+    # Only running the handlers
+    handling: list[float] = field(default_factory=list)
+    errors: int = 0
+    entries: int = 0
+    # Entries left without metadata, the drain timed out
+    unscraped: int = 0
+    db_bytes: int = 0
+
+    def summary(self) -> list[tuple[str, str]]:
+        latencies, handling = sorted(self.latencies), sorted(self.handling)
+        rows = [
+            ("messages", f"{self.messages}"),
+            ("elapsed", f"{self.elapsed:.2f}s"),
+            ("throughput", f"{self.messages / max(self.elapsed, 1e-9):.1f} msg/s"),
+        ]
+        if self.drained:
+            rows.append(("scraped after", f"{self.drained:.2f}s"))
+        for name, values in (("latency", latencies), ("handler", handling)):
+            if not values:
+                continue
+            rows.append(
+                (
+                    name,
+                    f"mean={statistics.fmean(values) * 1000:.1f}ms "
+                    f"p50={percentile(values, 0.5) * 1000:.1f}ms "
+                    f"p95={percentile(values, 0.95) * 1000:.1f}ms "
+                    f"p99={percentile(values, 0.99) * 1000:.1f}ms "
+                    f"max={values[-1] * 1000:.1f}ms",
+                )
+            )
+        rows += [
+            ("handler errors", f"{self.errors}"),
+            ("entries stored", f"{self.entries}"),
+            *([("entries unscraped", f"{self.unscraped}")] if self.unscraped else []),
+            ("database growth", f"{self.db_bytes / 2**20:.2f}MB"),
+            (
+                "per entry",
+                f"{self.db_bytes / max(self.entries, 1) / 1024:.1f}KB",
+            ),
+        ]
+        return rows
+
+
+async def feed_updates(
+    app: Application, messages: Iterable[Message], rate: float, stats: ReplayStats
+):
+    """
+    Process an update per message, rate of them per second (0 is as fast as
+    the bot takes them), as many at a time as the application allows.
+
+    The rate doesn't slow down when the bot falls behind, the latency counts
+    from when each update was due so the waiting shows up in it.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(app.concurrent_updates)
+    tasks = []
+
+    async def process(update: Update, due: float):
+        async with semaphore:
+            started = loop.time()
+            await app.process_update(update)
+        finished = loop.time()
+        stats.handling.append(finished - started)
+        stats.latencies.append(finished - due)
+
+    start = loop.time()
+    for idx, message in enumerate(messages):
+        due = start + idx / rate if rate > 0 else loop.time()
+        if (wait := due - loop.time()) > 0:
+            await asyncio.sleep(wait)
+        elif rate <= 0:
+            # Closed loop, the next update once there is room for it
+            async with semaphore:
+                pass
+        tasks.append(asyncio.create_task(process(Update(idx, message=message), due)))
+        stats.messages += 1
+    await asyncio.gather(*tasks)
+    stats.elapsed = loop.time() - start
+
+
+def database_bytes(path: Path) -> int:
+    """
+    Size of the database with its WAL, the -shm index isn't data
+    """
+    wal = path.with_name(path.name + "-wal")
+    return path.stat().st_size + (wal.stat().st_size if wal.exists() else 0)
+
+
+async def wait_scraped(session_factory: async_sessionmaker, timeout: float):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        async with session_factory() as session:
+            if not await session.scalar(select(func.count(ScrapeJob.id))):
+                return
+        await asyncio.sleep(0.1)
+    logger.warning("Scrape jobs left after %ds", timeout)
+
+
+async def replay(
+    settings: Settings,
+    messages: Iterable[Pieces] | None = None,
+    import_file: Path | None = None,
+    count: int = 1000,
+    rate: float = 50,
+    links: int = 3,
+    hosts: int = 50,
+    repeated: float = 0.1,
+    delay: float = 0.05,
+    chat_id: int = -100,
+    drain_timeout: float = 300,
+) -> ReplayStats:
+    """
+    Replay messages through the bot and measure it.
+
+    The messages are the given ones (with urls already on the stand-in
+    server), the link messages of import_file, or count synthetic ones.
+    """
+    stats = ReplayStats()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "replay.db"
+        engine = create_engine(
+            f"sqlite+aiosqlite:///{path}", settings.database, writer=True
+        )
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        session_factory = async_sessionmaker(engine, expire_on_commit=False)
+        settings = settings.model_copy(
+            update=dict(
+                db_url=str(engine.url),
+                scraper=settings.scraper.model_copy(update=dict(providers=False)),
+                monitoring=settings.monitoring.model_copy(
+                    update=dict(metrics_port=None)
+                ),
+            )
+        )
+        request = ReplayRequest()
+        app = create_app(settings, session_factory, request, StandInResolver())
+        async with stand_in_server(delay) as port:
+            if messages is None and import_file is not None:
+                messages = recorded_messages(import_file, port)
+            elif messages is None:
+                messages = synthetic_messages(count, links, hosts, repeated, port)
+            # The empty schema, out of the WAL
+            await checkpoint_wal(engine, "truncate")
+            before = database_bytes(path)
+            async with app:
+                await start_background(app)
+                try:
+                    updates = (
+                        link_message(pieces, idx, chat_id, idx % 20 + 1)
+                        for idx, pieces in enumerate(messages, 1)
+                    )
+                    await feed_updates(app, updates, rate, stats)
+                    if app.bot_data["enrichment"] is not None:
+                        start = asyncio.get_running_loop().time()
+                        # The last entries and their jobs may be in the buffer
+                        if app.bot_data["buffer"] is not None:
+                            await app.bot_data["buffer"].flush()
+                        await wait_scraped(session_factory, drain_timeout)
+                        stats.drained = asyncio.get_running_loop().time() - start
+                finally:
+                    await stop_background(app)
+            stats.errors = request.calls["sendMessage"]
+            async with session_factory() as session:
+                stats.entries = await session.scalar(select(func.count(UrlEntry.id)))
+                stats.unscraped = await session.scalar(
+                    select(func.count(UrlEntry.id)).where(
+                        UrlEntry.metadata_status == MetadataStatus.PENDING
+                    )
+                )
+        await engine.dispose()
+        stats.db_bytes = database_bytes(path) - before
+    return stats
@@ -0,0 +1,369 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import re
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import AbstractAsyncContextManager, nullcontext
+from dataclasses import dataclass
+
+import aiohttp
+from aiohttp.abc import AbstractResolver
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from rejubot.cache import MetadataCache, Validators
+from rejubot.canonical import fetch_url
+from rejubot.hosts import HostScheduler, HostUnavailable
+from rejubot.metrics import PARSE, SCRAPES, url_host
+from rejubot.opengraph import UrlMetadata, parse_og_metadata
+from rejubot.providers import PROVIDERS, Provider, provider_endpoint
+from rejubot.settings import ScraperSettings, Settings
+
+logger = logging.getLogger(__name__)
+HEADERS = {
+    "User-Agent": "facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)"
+}
+
+
+class Scraper:
+    """
+    Long lived HTTP client used for all the scrapes.
+
+    Keeps a single aiohttp session so connections, DNS lookups and TLS
+    handshakes are reused between urls of the same host, and the optional
+    pool where the html is parsed out of the event loop. With a host
+    scheduler the requests wait for their turn in their host, and with
+    providers the urls of known sites are scraped from their APIs.
+    It has to be started inside the running event loop.
+    """
+
+    def __init__(
+        self,
+        settings: ScraperSettings,
+        resolver: AbstractResolver | None = None,
+        cache: MetadataCache | None = None,
+        hosts: HostScheduler | None = None,
+        providers: dict[str, Provider] | None = None,
+    ):
+        self.settings = settings
+        self.resolver = resolver
+        self.cache = cache
+        self.hosts = hosts
+        self.providers = providers or {}
+        self.session: aiohttp.ClientSession | None = None
+        self.executor: Executor | None = None
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.settings.pool_size,
+            limit_per_host=self.settings.pool_size_per_host,
+            keepalive_timeout=self.settings.keepalive_timeout,
+            ttl_dns_cache=self.settings.dns_cache_ttl,
+            resolver=self.resolver,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=self.settings.timeout, connect=self.settings.connect_timeout
+        )
+        self.session = aiohttp.ClientSession(
+            connector=connector, timeout=timeout, headers=HEADERS
+        )
+        self.executor = create_parse_executor(self.settings)
+        if self.hosts is not None:
+            await self.hosts.start()
+
+    async def close(self):
+        if self.hosts is not None:
+            await self.hosts.stop()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+
+    def slot(self, url: str) -> AbstractAsyncContextManager:
+        if self.hosts is None:
+            return nullcontext()
+        return self.hosts.slot(url)
+
+    async def __aenter__(self) -> "Scraper":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+def create_scraper(
+    settings: Settings,
+    session_factory: async_sessionmaker,
+    use_cache: bool = True,
+    resolver: AbstractResolver | None = None,
+) -> Scraper:
+    """
+    Scraper with the metadata cache when it is enabled, and the host scheduler
+    """
+    cache = None
+    if use_cache and settings.cache.enabled:
+        cache = MetadataCache(settings.cache, session_factory)
+    hosts = HostScheduler(settings.hosts, session_factory)
+    providers = PROVIDERS if settings.scraper.providers else None
+    return Scraper(
+        settings.scraper,
+        resolver=resolver,
+        cache=cache,
+        hosts=hosts,
+        providers=providers,
+    )
+
+
+def create_parse_executor(settings: ScraperSettings) -> Executor | None:
+    if settings.parse_workers == 0:
+        return None
+    if settings.parse_executor == "thread":
+        return ThreadPoolExecutor(settings.parse_workers, "parser")
+    # Forking a process with running threads (aiosqlite, the bot) is unsafe
+    return ProcessPoolExecutor(
+        settings.parse_workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+async def scrape_og_metadata_html(
+    html: str, url: str, executor: Executor | None = None
+) -> UrlMetadata | None:
+    """
+    Parse the metadata, in the executor when there is one so the event loop
+    keeps running meanwhile.
+    """
+    with PARSE.time():
+        if executor is None:
+            return parse_og_metadata(html, url)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, parse_og_metadata, html, url)
+
+
+HEAD_END = re.compile(rb"</head\s*>|<body[\s>]", re.IGNORECASE)
+# Longest text HEAD_END can match split between two chunks
+HEAD_END_OVERLAP = 16
+
+
+async def read_html_head(response: aiohttp.ClientResponse, settings: ScraperSettings):
+    """
+    Read the html body in chunks until the end of the <head>, where the meta
+    tags are, or until settings.max_html_bytes.
+
+    Stopping early means the rest of the page is never downloaded, at the
+    cost of closing the connection instead of reusing it.
+    """
+    buffer = bytearray()
+    async for chunk in response.content.iter_chunked(settings.chunk_size):
+        searched = max(0, len(buffer) - HEAD_END_OVERLAP)
+        buffer += chunk
+        if HEAD_END.search(buffer, searched):
+            break
+        if len(buffer) >= settings.max_html_bytes:
+            logger.info("Html of %s is over %d bytes", response.url, len(buffer))
+            break
+    del buffer[settings.max_html_bytes :]
+
+    encoding = response.charset or "utf-8"
+    try:
+        return buffer.decode(encoding, errors="ignore")
+    except LookupError:
+        return buffer.decode("utf-8", errors="ignore")
+
+
+async def read_body(response: aiohttp.ClientResponse, settings: ScraperSettings):
+    """
+    Read the whole body, in chunks as they arrive. A body over
+    settings.max_html_bytes raises ValueError, a part of it is of no use.
+    """
+    buffer = bytearray()
+    async for chunk in response.content.iter_chunked(settings.chunk_size):
+        buffer += chunk
+        if len(buffer) > settings.max_html_bytes:
+            raise ValueError(f"Body of {response.url} is over {len(buffer)} bytes")
+    return bytes(buffer)
+
+
+@dataclass
+class Download:
+    metadata: UrlMetadata | None
+    content_type: str | None
+    validators: Validators = Validators()
+    # The page didn't change since the validators sent, nothing was parsed
+    not_modified: bool = False
+
+
+def conditional_headers(validators: Validators | None) -> dict[str, str]:
+    headers = {}
+    if validators is not None and validators.etag:
+        headers["If-None-Match"] = validators.etag
+    if validators is not None and validators.last_modified:
+        headers["If-Modified-Since"] = validators.last_modified
+    return headers
+
+
+async def download_provider_metadata(
+    url: str, provider: Provider, endpoint: str, scraper: Scraper
+) -> Download | None:
+    """
+    Metadata of the url from the API of its site, None to scrape the html
+    """
+    try:
+        async with scraper.slot(endpoint), scraper.session.get(endpoint) as response:
+            if response.status == 429 or response.status >= 500:
+                response.raise_for_status()
+            if response.status != 200:
+                logger.info("No %s metadata for %s", provider.name, url)
+                return None
+            body = await read_body(response, scraper.settings)
+        metadata = provider.parse(json.loads(body), url)
+    except HostUnavailable:
+        raise
+    except (aiohttp.ClientError, ValueError, KeyError, TypeError) as error:
+        logger.info("Error getting %s metadata for %s: %r", provider.name, url, error)
+        return None
+    if metadata is None:
+        return None
+    # Nothing to revalidate, asking the API again is as cheap
+    return Download(metadata, response.headers.get("Content-Type"))
+
+
+async def download_og_metadata(
+    url: str, scraper: Scraper, validators: Validators | None = None
+) -> Download:
+    """
+    Download the url and extract its metadata, with the content type and
+    the validators of the page.
+
+    Urls of sites with a provider are asked to their API first. With
+    validators the page is only downloaded if it changed since then, from
+    the url it redirected to the last time.
+    """
+    url = fetch_url(url)
+    if (found := provider_endpoint(url, scraper.providers)) is not None:
+        download = await download_provider_metadata(url, *found, scraper)
+        if download is not None:
+            return download
+    if validators and validators.final_url:
+        url = validators.final_url
+    headers = conditional_headers(validators)
+    async with scraper.slot(url), scraper.session.get(url, headers=headers) as response:
+        # The site is down or rate limiting us, the page isn't the real one
+        if response.status == 429 or response.status >= 500:
+            response.raise_for_status()
+        found = Validators(
+            response.headers.get("ETag"),
+            response.headers.get("Last-Modified"),
+            str(response.url),
+        )
+        if response.status == 304:
+            return Download(None, None, found or validators, not_modified=True)
+        content_type = response.headers.get("Content-Type")
+        # Only html bodies are downloaded, images and videos are used as they are
+        if content_type and content_type.startswith("text/html"):
+            html = await read_html_head(response, scraper.settings)
+    if not content_type:
+        logger.warning("No content type for %s", url)
+        return Download(None, None, found)
+    if content_type.startswith("text/html"):
+        # Relative urls of the page are relative to where it redirected to
+        metadata = await scrape_og_metadata_html(
+            html, found.final_url, scraper.executor
+        )
+        return Download(metadata, content_type, found)
+    elif content_type.startswith("image/"):
+        metadata = UrlMetadata(
+            site=None,
+            title=None,
+            description=None,
+            image=url,
+            video_url=None,
+            video_type=None,
+            video_width=None,
+            video_height=None,
+        )
+        return Download(metadata, content_type, found)
+    elif content_type.startswith("video/"):
+        metadata = UrlMetadata(
+            site=None,
+            title=None,
+            description=None,
+            image=None,
+            video_url=url,
+            video_type=content_type,
+            video_width=None,
+            video_height=None,
+        )
+        return Download(metadata, content_type, found)
+    else:
+        logger.warning("Unknown content type %s for %s", content_type, url)
+        return Download(None, content_type, found)
+
+
+async def fetch_og_metadata(
+    url: str, scraper: Scraper, refresh: bool = False
+) -> UrlMetadata | None:
+    """
+    Scrape the metadata of an url, from the cache when the scraper has one.
+
+    When the cached page expired, or with refresh, it is revalidated with
+    its ETag and Last-Modified and only parsed again if it changed.
+
+    Network errors are raised (aiohttp.ClientError and asyncio.TimeoutError)
+    so the caller can tell them apart from urls without metadata. Every
+    call is timed in the scrape metrics, by outcome and host.
+    """
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        outcome, metadata = await fetch_outcome(url, scraper, refresh)
+        return metadata
+    except HostUnavailable:
+        outcome = "unavailable"
+        raise
+    finally:
+        SCRAPES.observe(time.perf_counter() - start, outcome, url_host(url))
+
+
+async def fetch_outcome(
+    url: str, scraper: Scraper, refresh: bool
+) -> tuple[str, UrlMetadata | None]:
+    """
+    fetch_og_metadata, with how the metadata was found for the metrics
+    """
+    stale = None
+    if scraper.cache is not None:
+        if not refresh:
+            found, metadata = await scraper.cache.get(url)
+            if found:
+                return "cached", metadata
+        stale = await scraper.cache.stale(url)
+
+    download = await download_og_metadata(
+        url, scraper, stale.validators if stale else None
+    )
+    metadata, content_type = download.metadata, download.content_type
+    outcome = "scraped" if metadata is not None else "empty"
+    if download.not_modified and stale is not None:
+        logger.info("Not modified %s", url)
+        metadata, content_type = stale.metadata, stale.content_type
+        outcome = "not_modified"
+    if scraper.cache is not None:
+        await scraper.cache.put(url, metadata, content_type, download.validators)
+    return outcome, metadata
+
+
+async def scrape_og_metadata(
+    url: str, scraper: Scraper, refresh: bool = False
+) -> UrlMetadata | None:
+    try:
+        return await fetch_og_metadata(url, scraper, refresh)
+    except HostUnavailable as error:
+        logger.info("Skipping %s: %s", url, error)
+        return None
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        logger.exception("Error scraping %s", url)
+        return None
@@ -0,0 +1,148 @@
+"""
+Full text search of the url entries, over the url_entries_fts table.
+
+Matches are marked with control characters by SQLite, and turned into
+<mark> once the text is html escaped.
+"""
+
+import html
+import re
+from dataclasses import dataclass
+
+from markupsafe import Markup
+from sqlalchemy import Select, column, func, literal_column, select, table
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import joinedload
+
+from rejubot.storage import UrlEntry
+
+FTS = table("url_entries_fts", column("rowid"), column("rank"))
+FTS_TABLE = literal_column("url_entries_fts")
+MARK_START, MARK_END = "\x02", "\x03"
+WORD = re.compile(r"\w+")
+RANK_CANDIDATES = 2000
+
+
+def fts_query(text: str) -> str | None:
+    """
+    MATCH expression for all the words of the text, the last one as a prefix.
+    Words are quoted so nothing in the text is taken as FTS5 syntax.
+    """
+    words = WORD.findall(text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def page_ids_query(
+    match: str,
+    channel_id: int | None = None,
+    sort: str = "rank",
+    page: int = 0,
+    page_size: int = 20,
+    candidates: int = RANK_CANDIDATES,
+) -> Select:
+    """
+    Ids of the page of entries matching, by bm25 rank or newest first, and
+    one more to know if there is a next page.
+
+    Ranking needs to score every match, so only the newest candidates
+    matches are ranked: common words stay fast, and the ranking is of the
+    recent links, the ones people look for.
+    """
+    matches = select(FTS.c.rowid, FTS.c.rank).where(FTS_TABLE.op("MATCH")(match))
+    if channel_id is not None:
+        matches = matches.join(UrlEntry, UrlEntry.id == FTS.c.rowid).where(
+            UrlEntry.channel_id == channel_id
+        )
+    if sort == "recent":
+        query = matches.with_only_columns(FTS.c.rowid).order_by(FTS.c.rowid.desc())
+    else:
+        newest = matches.order_by(FTS.c.rowid.desc()).limit(candidates).subquery()
+        query = select(newest.c.rowid).order_by(newest.c.rank, newest.c.rowid.desc())
+    return query.limit(page_size + 1).offset(page * page_size)
+
+
+def highlights_query(match: str, ids: list[int]) -> Select:
+    """
+    Highlighted title and snippets of the description and message of the
+    ids. Alone, without joins, FTS5 narrows the match to the range of the ids
+    and the rest are filtered before highlighting them.
+    """
+    return (
+        select(
+            FTS.c.rowid,
+            func.highlight(FTS_TABLE, 0, MARK_START, MARK_END).label("title"),
+            func.snippet(FTS_TABLE, 1, MARK_START, MARK_END, "…", 32).label(
+                "description"
+            ),
+            func.snippet(FTS_TABLE, 3, MARK_START, MARK_END, "…", 32).label(
+                "message_text"
+            ),
+        )
+        .where(FTS_TABLE.op("MATCH")(match))
+        .where(FTS.c.rowid.between(min(ids), max(ids)))
+        # Not a constraint on rowid, FTS5 would run the match once per id
+        .where((FTS.c.rowid + 0).in_(ids))
+    )
+
+
+async def search(
+    db: AsyncSession,
+    text: str,
+    channel_id: int | None = None,
+    sort: str = "rank",
+    page: int = 0,
+    page_size: int = 20,
+) -> tuple[list["SearchResult"], bool]:
+    """
+    A page of results, and if there are more
+    """
+    match = fts_query(text)
+    if match is None:
+        return [], False
+    query = page_ids_query(match, channel_id, sort, page, page_size)
+    ids = (await db.scalars(query)).all()
+    more = len(ids) > page_size
+    ids = ids[:page_size]
+    if not ids:
+        return [], more
+
+    highlights = {
+        row.rowid: row for row in await db.execute(highlights_query(match, ids))
+    }
+    entries = await db.scalars(
+        select(UrlEntry).where(UrlEntry.id.in_(ids)).options(joinedload(UrlEntry.video))
+    )
+    by_id = {entry.id: entry for entry in entries.unique()}
+    return [
+        SearchResult.from_row(by_id[id], highlights[id])
+        for id in ids
+        if id in by_id and id in highlights
+    ], more
+
+
+def highlight(text: str | None) -> Markup | None:
+    if text is None:
+        return None
+    escaped = html.escape(text)
+    return Markup(escaped.replace(MARK_START, "<mark>").replace(MARK_END, "</mark>"))
+
+
+@dataclass
+class SearchResult:
+    entry: UrlEntry
+    title: Markup | None
+    description: Markup | None
+    message_text: Markup | None
+
+    @classmethod
+    def from_row(cls, entry: UrlEntry, row) -> "SearchResult":
+        return cls(
+            entry,
+            highlight(row.title),
+            highlight(row.description),
+            highlight(row.message_text),
+        )
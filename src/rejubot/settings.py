@@ -1,16 +1,144 @@
 import os
 import tomllib
+from typing import Literal
 
-from pydantic import FieldValidationInfo, field_validator
+from pydantic import BaseModel, Field, FieldValidationInfo, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
+class DatabaseSettings(BaseModel):
+    # Pragmas of every SQLite connection. With WAL the web reads while the
+    # bot writes, and NORMAL only syncs on checkpoints, safe with WAL.
+    journal_mode: Literal["wal", "delete", "truncate", "persist"] = "wal"
+    synchronous: Literal["off", "normal", "full", "extra"] = "normal"
+    # Milliseconds waiting for a lock before "database is locked"
+    busy_timeout: int = 5000
+    # Bytes of the file read through memory mapping, and of the page cache
+    # of each connection
+    mmap_size: int = 256 * 1024 * 1024
+    cache_size: int = 64 * 1024 * 1024
+    # Bytes the WAL file is truncated to after a checkpoint
+    journal_size_limit: int = 64 * 1024 * 1024
+    # Read only connections of the web
+    read_pool_size: int = 5
+    # Seconds waiting for the single connection of the bot
+    writer_timeout: float = 60
+    # Seconds between WAL checkpoints of the bot, 0 only leaves the automatic
+    # ones. passive never waits for the readers, truncate also empties the file.
+    checkpoint_interval: float = 300
+    checkpoint_mode: Literal["passive", "full", "restart", "truncate"] = "passive"
+
+
+class ScraperSettings(BaseModel):
+    # Seconds for the whole request, and for getting a connection
+    timeout: float = 20
+    connect_timeout: float = 10
+    # Connection pool shared by all the scrapes
+    pool_size: int = 100
+    pool_size_per_host: int = 8
+    keepalive_timeout: float = 30
+    dns_cache_ttl: int = 300
+    # Html pages are read until </head> or this many bytes
+    max_html_bytes: int = 1024 * 1024
+    chunk_size: int = 16 * 1024
+    # Urls of the same message scraped at the same time
+    max_concurrency: int = 5
+    # Use the oEmbed or JSON APIs of known sites instead of their html
+    providers: bool = True
+    # Pool parsing the html out of the event loop, 0 parses in the loop.
+    # Threads only help with a parser that releases the GIL.
+    parse_workers: int = 0
+    parse_executor: Literal["process", "thread"] = "process"
+
+
+class HostSettings(BaseModel):
+    # Requests per second to the same host, with bursts of up to burst
+    rate: float = 2
+    burst: int = 5
+    # Requests to the same host at the same time
+    max_concurrency: int = 4
+    # Consecutive timeouts, connection errors or 429/5xx that open the circuit,
+    # and seconds it stays open failing fast before trying the host again
+    failure_threshold: int = 5
+    cooldown: float = 60
+    # Seconds between saves of the host states for the admin host_status
+    save_interval: float = 30
+    # Seconds without requests before a host with its circuit closed is
+    # forgotten on save, its counts start again with the next request
+    idle_after: float = 600
+
+
+class CacheSettings(BaseModel):
+    enabled: bool = True
+    # Entries kept in memory in front of the database table
+    memory_entries: int = 10_000
+    # Seconds each kind of metadata is kept, negative is for urls without any
+    ttl_html: float = 7 * 24 * 3600
+    ttl_image: float = 30 * 24 * 3600
+    ttl_video: float = 30 * 24 * 3600
+    ttl_negative: float = 3600
+    # Seconds an expired page with ETag or Last-Modified is kept to revalidate it
+    keep_validated: float = 90 * 24 * 3600
+
+
+class MonitoringSettings(BaseModel):
+    # Seconds between event loop lag samples, and lag logged as a warning
+    loop_lag_interval: float = 0.5
+    loop_lag_warning: float = 0.5
+    # Listener of the bot serving /metrics, the web serves its own. Keep it
+    # on localhost, there is no authentication.
+    metrics_host: str = "127.0.0.1"
+    metrics_port: int | None = None
+
+
+class EnrichmentSettings(BaseModel):
+    # Background workers scraping the stored urls. With 0 the urls are
+    # scraped while handling the message instead.
+    workers: int = 4
+    max_attempts: int = 5
+    # Seconds to wait before the first retry, doubled on each attempt
+    retry_backoff: float = 30
+    # Seconds a claimed job is hidden from other workers
+    visibility_timeout: float = 120
+    # Seconds between checks for jobs when nobody notifies new ones
+    poll_interval: float = 30
+
+
+class WriteBufferSettings(BaseModel):
+    # Insert the entries of many messages together, when there are
+    # max_entries or the oldest waited max_delay seconds
+    enabled: bool = False
+    max_entries: int = 200
+    max_delay: float = 1.0
+
+
+class EditSettings(BaseModel):
+    # The entries of an edited message get its new text
+    update_message: bool = True
+    # The entries of the urls removed by an edit are deleted, instead of kept
+    delete_removed: bool = False
+
+
+class WebSettings(BaseModel):
+    # Rendered pages kept in memory, by ETag
+    fragment_cache_entries: int = 1000
+
+
 class Settings(BaseSettings):
     telegram_token: str
     db_url: str
+    database: DatabaseSettings = DatabaseSettings()
     telegram_channels: dict[str, int]
-    telegram_channels_by_id: dict[int, str] = {}
+    telegram_channels_by_id: dict[int, str] = Field({}, validate_default=True)
     error_chat_id: int
+    scraper: ScraperSettings = ScraperSettings()
+    hosts: HostSettings = HostSettings()
+    enrichment: EnrichmentSettings = EnrichmentSettings()
+    write_buffer: WriteBufferSettings = WriteBufferSettings()
+    edits: EditSettings = EditSettings()
+    cache: CacheSettings = CacheSettings()
+    monitoring: MonitoringSettings = MonitoringSettings()
+    web: WebSettings = WebSettings()
     model_config = SettingsConfigDict(env_prefix="REJUBOT_", extra="ignore")
 
     @field_validator("telegram_channels_by_id")
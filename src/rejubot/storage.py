@@ -1,10 +1,34 @@
-from datetime import datetime
+import asyncio
+import hashlib
+import html
+import re
+from collections.abc import Iterable
+from datetime import date, datetime, timezone
+from enum import StrEnum
 from logging import getLogger
 
-from sqlalchemy import BigInteger, ForeignKey, Index, Integer, String, Text
+from sqlalchemy import (
+    DDL,
+    BigInteger,
+    Date,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    Text,
+    delete,
+    event,
+    select,
+    tuple_,
+)
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from sqlalchemy.sql import func
 
+from rejubot.canonical import canonical_url
+from rejubot.settings import DatabaseSettings
+
 logger = getLogger(__name__)
 
 
@@ -22,18 +46,78 @@ class VideoEntry(Base):
     url: Mapped[str] = mapped_column(Text)
 
 
+def url_hash(url: str) -> int:
+    """
+    Compact 64 bit signed hash of the canonical form of an url, to index it
+    """
+    digest = hashlib.blake2b(canonical_url(url).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big", signed=True)
+
+
+def url_hash_default(context) -> int:
+    return url_hash(context.get_current_parameters()["url"])
+
+
+def utc_day(created_at: datetime | None) -> date:
+    """
+    UTC day of an entry, the same date(created_at) gives in SQLite
+    """
+    if created_at is None:
+        return datetime.now(timezone.utc).date()
+    if created_at.tzinfo is not None:
+        created_at = created_at.astimezone(timezone.utc)
+    return created_at.date()
+
+
+def created_day_default(context) -> date:
+    return utc_day(context.get_current_parameters().get("created_at"))
+
+
+HTML_TAG = re.compile(r"<[^>]+>")
+
+
+def html_to_text(message: str | None) -> str | None:
+    """
+    Text of a message stored as Telegram html, to index it
+    """
+    if message is None:
+        return None
+    return html.unescape(HTML_TAG.sub("", message))
+
+
+def message_text_default(context) -> str | None:
+    return html_to_text(context.get_current_parameters().get("message"))
+
+
+class MetadataStatus(StrEnum):
+    # Stored, waiting for the enrichment workers to scrape it
+    PENDING = "pending"
+    DONE = "done"
+    # Gave up after all the retries
+    FAILED = "failed"
+
+
 class UrlEntry(Base):
     __tablename__ = "url_entries"
 
     id: Mapped[int] = mapped_column(primary_key=True)
     # Telegram asks for 64 bit signed integers
-    channel_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    channel_id: Mapped[int] = mapped_column(BigInteger)
     message_id: Mapped[int] = mapped_column(BigInteger, index=True)
     created_at: Mapped[datetime] = mapped_column(server_default=func.now(), index=True)
+    # Stored to group and filter by day with an index, instead of date(created_at)
+    created_day: Mapped[date] = mapped_column(
+        Date, default=created_day_default, index=True
+    )
     who: Mapped[str] = mapped_column(String(255))
     who_id: Mapped[int] = mapped_column(BigInteger)
     url: Mapped[str] = mapped_column(Text)
+    url_hash: Mapped[int] = mapped_column(BigInteger, default=url_hash_default)
     message: Mapped[str] = mapped_column(Text)
+    # Message without the html, for the full text search
+    message_text: Mapped[str | None] = mapped_column(
+        Text, nullable=True, default=message_text_default
+    )
     og_site: Mapped[str | None] = mapped_column(Text, nullable=True)
     og_title: Mapped[str | None] = mapped_column(Text, nullable=True)
     og_image: Mapped[str | None] = mapped_column(Text, nullable=True)
@@ -42,6 +126,344 @@ class UrlEntry(Base):
         ForeignKey("video_entries.id"), nullable=True
     )
     video: Mapped[VideoEntry | None] = relationship(uselist=False, cascade="all")
+    metadata_status: Mapped[str] = mapped_column(
+        String(16), server_default=MetadataStatus.DONE
+    )
 
 
 Index(None, UrlEntry.channel_id, UrlEntry.message_id)
+# Pages of a channel
+Index("ix_url_entries_channel_created_at", UrlEntry.channel_id, UrlEntry.created_at)
+# Duplicated urls in a channel in the last hours
+Index(
+    "ix_url_entries_channel_url_hash",
+    UrlEntry.channel_id,
+    UrlEntry.url_hash,
+    UrlEntry.created_at,
+)
+
+
+class MessageUrl(Base):
+    """
+    Urls of a message already processed, stored or filtered out, so an edit
+    of the message only processes the urls it adds.
+
+    Kept even when the entry is gone or the url was a duplicate: adding the
+    url back in another edit doesn't store it again.
+    """
+
+    __tablename__ = "message_urls"
+
+    channel_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    message_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    url_hash: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+
+
+class LinkDay(Base):
+    """
+    Entries of a channel in a day, kept by the triggers on url_entries.
+
+    version grows with every insert, update or delete of the entries of the
+    day, whoever does it (bot, workers, admin), so the web knows when a
+    rendered page is still valid.
+    """
+
+    __tablename__ = "link_days"
+
+    channel_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    day: Mapped[date] = mapped_column(Date, primary_key=True, index=True)
+    entries: Mapped[int] = mapped_column(Integer, default=0)
+    version: Mapped[int] = mapped_column(Integer, default=0)
+    updated_at: Mapped[datetime] = mapped_column(server_default=func.now())
+
+
+LINK_DAY_UPSERT = """
+    INSERT INTO link_days (channel_id, day, entries, version, updated_at)
+    VALUES (NEW.channel_id, NEW.created_day, 1, 1, CURRENT_TIMESTAMP)
+    ON CONFLICT (channel_id, day) DO UPDATE SET
+        entries = entries + 1, version = version + 1, updated_at = CURRENT_TIMESTAMP;
+"""
+LINK_DAY_REMOVE = """
+    UPDATE link_days
+    SET entries = entries - 1, version = version + 1, updated_at = CURRENT_TIMESTAMP
+    WHERE channel_id = OLD.channel_id AND day = OLD.created_day;
+"""
+LINK_DAYS_TRIGGERS = [
+    f"""
+    CREATE TRIGGER link_days_insert AFTER INSERT ON url_entries BEGIN
+    {LINK_DAY_UPSERT}
+    END
+    """,
+    # Counted again, in case the entry moved to another day
+    f"""
+    CREATE TRIGGER link_days_update AFTER UPDATE ON url_entries BEGIN
+    {LINK_DAY_REMOVE}
+    {LINK_DAY_UPSERT}
+    END
+    """,
+    f"""
+    CREATE TRIGGER link_days_delete AFTER DELETE ON url_entries BEGIN
+    {LINK_DAY_REMOVE}
+    END
+    """,
+]
+for trigger in LINK_DAYS_TRIGGERS:
+    event.listen(UrlEntry.__table__, "after_create", DDL(trigger))
+
+
+# Full text search over the entries, an external content FTS5 table kept by
+# triggers. Title matches weight the most in the bm25 rank.
+URL_ENTRIES_FTS_COLUMNS = "og_title, og_description, og_site, message_text, who"
+URL_ENTRIES_FTS = [
+    f"""
+    CREATE VIRTUAL TABLE url_entries_fts USING fts5(
+        {URL_ENTRIES_FTS_COLUMNS},
+        content='url_entries', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    INSERT INTO url_entries_fts (url_entries_fts, rank)
+    VALUES ('rank', 'bm25(10.0, 4.0, 2.0, 2.0, 1.0)')
+    """,
+    f"""
+    CREATE TRIGGER url_entries_fts_insert AFTER INSERT ON url_entries BEGIN
+    INSERT INTO url_entries_fts (rowid, {URL_ENTRIES_FTS_COLUMNS})
+    VALUES (NEW.id, NEW.og_title, NEW.og_description, NEW.og_site,
+            NEW.message_text, NEW.who);
+    END
+    """,
+    f"""
+    CREATE TRIGGER url_entries_fts_delete AFTER DELETE ON url_entries BEGIN
+    INSERT INTO url_entries_fts (url_entries_fts, rowid, {URL_ENTRIES_FTS_COLUMNS})
+    VALUES ('delete', OLD.id, OLD.og_title, OLD.og_description, OLD.og_site,
+            OLD.message_text, OLD.who);
+    END
+    """,
+    f"""
+    CREATE TRIGGER url_entries_fts_update
+    AFTER UPDATE OF {URL_ENTRIES_FTS_COLUMNS} ON url_entries BEGIN
+    INSERT INTO url_entries_fts (url_entries_fts, rowid, {URL_ENTRIES_FTS_COLUMNS})
+    VALUES ('delete', OLD.id, OLD.og_title, OLD.og_description, OLD.og_site,
+            OLD.message_text, OLD.who);
+    INSERT INTO url_entries_fts (rowid, {URL_ENTRIES_FTS_COLUMNS})
+    VALUES (NEW.id, NEW.og_title, NEW.og_description, NEW.og_site,
+            NEW.message_text, NEW.who);
+    END
+    """,
+]
+for statement in URL_ENTRIES_FTS:
+    event.listen(UrlEntry.__table__, "after_create", DDL(statement))
+
+
+class ScrapeJob(Base):
+    """
+    Pending scrape of the metadata of an url entry
+    """
+
+    __tablename__ = "scrape_jobs"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    url_entry_id: Mapped[int] = mapped_column(
+        ForeignKey("url_entries.id", ondelete="CASCADE"), unique=True
+    )
+    entry: Mapped[UrlEntry] = relationship()
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    # When the job can be claimed by a worker again. Claiming it moves it
+    # forward by the visibility timeout.
+    available_at: Mapped[datetime] = mapped_column(
+        server_default=func.now(), index=True
+    )
+    claimed_at: Mapped[datetime | None] = mapped_column(nullable=True)
+    last_error: Mapped[str | None] = mapped_column(Text, nullable=True)
+
+
+async def delete_entries(session: AsyncSession, *criteria) -> list[tuple[int, int]]:
+    """
+    Delete the entries matching the criteria, with their scrape jobs and the
+    ledger rows of their urls. Returns the (channel_id, url_hash) of each one.
+
+    SQLite doesn't cascade without the foreign_keys pragma, and the ids of the
+    deleted entries are reused: an orphan job would scrape into a new entry.
+    """
+    entries = select(UrlEntry.id).where(*criteria)
+    await session.execute(delete(ScrapeJob).where(ScrapeJob.url_entry_id.in_(entries)))
+    await session.execute(
+        delete(MessageUrl).where(
+            tuple_(
+                MessageUrl.channel_id, MessageUrl.message_id, MessageUrl.url_hash
+            ).in_(
+                select(
+                    UrlEntry.channel_id, UrlEntry.message_id, UrlEntry.url_hash
+                ).where(*criteria)
+            )
+        )
+    )
+    deleted = await session.execute(
+        UrlEntry.__table__.delete()
+        .where(*criteria)
+        .returning(UrlEntry.channel_id, UrlEntry.url_hash)
+    )
+    return [tuple(row) for row in deleted]
+
+
+async def release_message_urls(
+    session: AsyncSession, channel_id: int, message_id: int, urls: Iterable[str]
+):
+    """
+    Delete the ledger rows of urls claimed by a message whose entries weren't
+    stored after all, so an edit or the update delivered again processes them.
+    """
+    await session.execute(
+        delete(MessageUrl)
+        .where(MessageUrl.channel_id == channel_id)
+        .where(MessageUrl.message_id == message_id)
+        .where(MessageUrl.url_hash.in_({url_hash(url) for url in urls}))
+    )
+
+
+class MetadataCacheEntry(Base):
+    """
+    Scraped metadata by normalized url, metadata_json is null for urls
+    without metadata.
+    """
+
+    __tablename__ = "metadata_cache"
+
+    url: Mapped[str] = mapped_column(Text, primary_key=True)
+    metadata_json: Mapped[str | None] = mapped_column(Text, nullable=True)
+    content_type: Mapped[str | None] = mapped_column(String(255), nullable=True)
+    expires_at: Mapped[datetime] = mapped_column(index=True)
+    # Validators of the page to revalidate it, and the url it redirected to
+    etag: Mapped[str | None] = mapped_column(Text, nullable=True)
+    last_modified: Mapped[str | None] = mapped_column(String(64), nullable=True)
+    final_url: Mapped[str | None] = mapped_column(Text, nullable=True)
+
+
+class HostStatus(Base):
+    """
+    Last saved state of the scrapes to a host, written by the scraper
+    """
+
+    __tablename__ = "host_status"
+
+    host: Mapped[str] = mapped_column(String(255), primary_key=True)
+    state: Mapped[str] = mapped_column(String(16))
+    requests: Mapped[int] = mapped_column(Integer, default=0)
+    failures: Mapped[int] = mapped_column(Integer, default=0)
+    rejected: Mapped[int] = mapped_column(Integer, default=0)
+    consecutive_failures: Mapped[int] = mapped_column(Integer, default=0)
+    open_until: Mapped[datetime | None] = mapped_column(nullable=True)
+    last_error: Mapped[str | None] = mapped_column(Text, nullable=True)
+    updated_at: Mapped[datetime] = mapped_column(server_default=func.now())
+
+
+def sqlite_pragmas(settings: DatabaseSettings, read_only: bool) -> list[str]:
+    pragmas = [
+        f"PRAGMA busy_timeout = {settings.busy_timeout}",
+        f"PRAGMA synchronous = {settings.synchronous}",
+        f"PRAGMA mmap_size = {settings.mmap_size}",
+        # Negative is in KiB instead of pages
+        f"PRAGMA cache_size = {-(settings.cache_size // 1024)}",
+        f"PRAGMA journal_size_limit = {settings.journal_size_limit}",
+    ]
+    if read_only:
+        # Changing the journal mode is a write, the writers set it
+        pragmas.append("PRAGMA query_only = 1")
+    else:
+        pragmas.insert(0, f"PRAGMA journal_mode = {settings.journal_mode}")
+    return pragmas
+
+
+def create_engine(
+    db_url: str,
+    settings: DatabaseSettings,
+    read_only: bool = False,
+    writer: bool = False,
+) -> AsyncEngine:
+    """
+    Engine with the pragmas of the settings applied to each SQLite connection.
+
+    read_only is a pool of connections that can't write, for the web. writer
+    is a single connection, so the writes of the bot wait in the pool for
+    their turn instead of retrying on the SQLite lock. Its sessions must not
+    wait for other sessions while they hold it, it would never be released.
+    """
+    url = make_url(db_url)
+    if url.get_backend_name() != "sqlite":
+        return create_async_engine(url)
+    options = {}
+    if url.database not in (None, "", ":memory:"):
+        if writer:
+            options = dict(
+                pool_size=1, max_overflow=0, pool_timeout=settings.writer_timeout
+            )
+        elif read_only:
+            options = dict(pool_size=settings.read_pool_size, max_overflow=0)
+    engine = create_async_engine(url, **options)
+    pragmas = sqlite_pragmas(settings, read_only)
+
+    @event.listens_for(engine.sync_engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    return engine
+
+
+async def checkpoint_wal(engine: AsyncEngine, mode: str = "passive") -> tuple:
+    """
+    Copy the WAL into the database, returns (busy, wal pages, checkpointed)
+    """
+    async with engine.connect() as conn:
+        result = await conn.exec_driver_sql(f"PRAGMA wal_checkpoint({mode.upper()})")
+        return tuple(result.one())
+
+
+class WalCheckpoints:
+    """
+    Checkpoints the WAL every interval.
+
+    SQLite checkpoints on its own after commits, but only when no reader is
+    using the old pages. With the web reading all the time the WAL keeps
+    growing, and every read gets slower looking through it.
+    """
+
+    def __init__(self, engine: AsyncEngine, settings: DatabaseSettings):
+        self.engine = engine
+        self.settings = settings
+        self.task: asyncio.Task | None = None
+        self.stopping = False
+
+    async def start(self):
+        self.stopping = False
+        if (
+            self.settings.checkpoint_interval > 0
+            and self.settings.journal_mode == "wal"
+        ):
+            self.task = asyncio.create_task(self.run(), name="wal-checkpoints")
+
+    async def stop(self):
+        # Like the enrichment workers, in case the pool swallows the cancel
+        self.stopping = True
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    async def run(self):
+        while not self.stopping:
+            await asyncio.sleep(self.settings.checkpoint_interval)
+            try:
+                busy, pages, done = await checkpoint_wal(
+                    self.engine, self.settings.checkpoint_mode
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Error checkpointing the WAL")
+                continue
+            if busy or done < pages:
+                logger.info("WAL checkpoint copied %d of %d pages", done, pages)
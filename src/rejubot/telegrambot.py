@@ -4,146 +4,52 @@ import json
 import logging
 import re
 import traceback
-from dataclasses import dataclass
-from datetime import timedelta
+from collections.abc import Iterable
 
-import aiohttp
 import telegram.ext.filters as filters
 import validators
-from bs4 import BeautifulSoup
-from sqlalchemy import func, select
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from aiohttp.abc import AbstractResolver
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from telegram import Message, Update
 from telegram.constants import ChatMemberStatus, MessageEntityType, ParseMode
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CallbackContext,
     ChatMemberHandler,
     ContextTypes,
     MessageHandler,
 )
+from telegram.request import BaseRequest
 
+from rejubot.dedup import DEDUP_WINDOW, RecentUrls
+from rejubot.enrichment import EnrichmentWorkers, assign_metadata, enqueue
 from rejubot.logging import setup_logging
-from rejubot.settings import Settings, load_settings
-from rejubot.storage import UrlEntry, VideoEntry
+from rejubot.metrics import DB_COMMITS, UPDATES, URLS, MetricsServer, instrument_engine
+from rejubot.monitoring import LoopLagMonitor
+from rejubot.scraper import (
+    Scraper,
+    UrlMetadata,
+    create_scraper,
+    scrape_og_metadata,
+)
+from rejubot.settings import EditSettings, Settings, load_settings
+from rejubot.storage import (
+    MessageUrl,
+    UrlEntry,
+    WalCheckpoints,
+    create_engine,
+    delete_entries,
+    html_to_text,
+    release_message_urls,
+    url_hash,
+)
+from rejubot.writebuffer import EntryBuffer
 
 logger = logging.getLogger(__name__)
 FIND_URLS = re.compile(r"https?://\S+")
-HEADERS = {
-    "User-Agent": "facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)"
-}
-
-
-def get_meta(soup: BeautifulSoup, property: str) -> str | None:
-    meta = soup.find("meta", property=property)
-    if not meta:
-        return None
-    return meta.get("content")
-
-
-def get_meta_name(soup: BeautifulSoup, name: str) -> str | None:
-    meta = soup.find("meta", attrs=dict(name=name))
-    if not meta:
-        return None
-    return meta.get("content")
-
-
-@dataclass
-class UrlMetadata:
-    site: str | None
-    title: str | None
-    description: str | None
-    image: str | None
-    video_url: str | None
-    video_type: str | None
-    video_width: int | None
-    video_height: int | None
-
-
-async def scrape_og_metadata_html(html: str, url: str) -> UrlMetadata | None:
-    soup = BeautifulSoup(html, "html.parser")
-    gets = lambda prop: get_meta(soup, prop)
-    gets_name = lambda prop: get_meta_name(soup, prop)
-
-    if url.startswith("https://vxtwitter.com"):
-        og_site = "Twitter / X"
-        og_title = gets_name("twitter:title")
-        og_image = gets_name("twitter:image")
-    else:
-        og_site = gets("og:site_name")
-        og_title = gets("og:title")
-        og_image = gets("og:image")
-
-    if og_image == "0" or og_image == "null":
-        og_image = None
-
-    video_url = gets("og:video")
-    video_type = gets("og:video:type")
-    # Some times there is a video link without a type, meaning it is another
-    # website. So it is not a real video.
-    if not video_type:
-        video_url = None
-    video_width = gets("og:video:width")
-    video_height = gets("og:video:height")
-
-    og_description = gets("og:description")
-    if og_title is None and og_description is None:
-        return None
-    return UrlMetadata(
-        site=og_site,
-        title=og_title,
-        description=og_description,
-        image=og_image,
-        video_url=video_url,
-        video_type=video_type,
-        video_width=video_width,
-        video_height=video_height,
-    )
-
-
-async def scrape_og_metadata(url: str) -> UrlMetadata | None:
-    if not url.startswith("http"):
-        url = f"http://{url}"
-
-    url = re.sub(r"^https://(x|twitter)\.com", "https://vxtwitter.com", url)
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(20)) as session:
-        try:
-            async with session.get(url, headers=HEADERS) as response:
-                content_type = response.headers.get("Content-Type")
-                await response.read()
-        except (aiohttp.ClientError, asyncio.TimeoutError):
-            logger.exception("Error scraping %s", url)
-            return None
-    if not content_type:
-        logger.warning("No content type for %s", url)
-        return None
-    if content_type.startswith("text/html"):
-        return await scrape_og_metadata_html(await response.text(errors="ignore"), url)
-    elif content_type.startswith("image/"):
-        return UrlMetadata(
-            site=None,
-            title=None,
-            description=None,
-            image=url,
-            video_url=None,
-            video_type=None,
-            video_width=None,
-            video_height=None,
-        )
-    elif content_type.startswith("video/"):
-        return UrlMetadata(
-            site=None,
-            title=None,
-            description=None,
-            image=None,
-            video_url=url,
-            video_type=content_type,
-            video_width=None,
-            video_height=None,
-        )
-    else:
-        logger.warning("Unknown content type %s for %s", content_type, url)
-        return None
 
 
 def get_telegram_urls(message: Message) -> set[str]:
@@ -189,22 +95,6 @@ def create_entry(msg: Message, url: str, metadata: UrlMetadata | None) -> UrlEnt
     return assign_metadata(entry, metadata)
 
 
-def assign_metadata(entry: UrlEntry, metadata: UrlMetadata) -> UrlEntry:
-    entry.og_description = metadata.description
-    entry.og_image = metadata.image
-    entry.og_site = metadata.site
-    entry.og_title = metadata.title
-    if metadata.video_url:
-        entry.video = VideoEntry(
-            content_type=metadata.video_type,
-            width=metadata.video_width,
-            height=metadata.video_height,
-            url=metadata.video_url,
-        )
-
-    return entry
-
-
 IGNORED_HOSTNAMES = {"rejugan.do"}
 
 
@@ -221,47 +111,316 @@ def should_skip_url(url: str) -> bool:
     return skip
 
 
-async def process_url(message: Message, url: str, session: AsyncSession):
+async def is_recent_duplicate(
+    message: Message,
+    url: str,
+    session: AsyncSession,
+    recent: RecentUrls | None = None,
+) -> bool:
     """
-    Process a single url into the database
+    Check if the url, or another spelling of it, was already posted in the
+    channel in the last 24 hours.
+
+    The recent urls in memory answer first, the database when they don't know.
     """
+    hashed = url_hash(url)
+    if recent is not None:
+        duplicate = recent.is_duplicate(message.chat_id, hashed, message.date)
+        if duplicate is not None:
+            return duplicate
 
-    if should_skip_url(url):
-        return None
-    # Check in the database if the url was already posted in the last 24 hours.
     query = (
-        select(func.count("*"))
-        .where(UrlEntry.url == url)
-        .where(UrlEntry.created_at > message.date - timedelta(days=1))
+        select(UrlEntry.id)
+        .where(UrlEntry.channel_id == message.chat_id)
+        .where(UrlEntry.url_hash == hashed)
+        .where(UrlEntry.created_at > message.date - DEDUP_WINDOW)
+        .limit(1)
+    )
+    return (await session.scalar(query)) is not None
+
+
+async def filter_new_urls(
+    message: Message,
+    urls: Iterable[str],
+    session: AsyncSession,
+    recent: RecentUrls | None = None,
+) -> list[str]:
+    """
+    Remove repeated, ignored and recently posted urls, keeping the message order.
+
+    Urls are compared by their canonical form, the first spelling is kept.
+    """
+    new_urls = []
+    seen = set()
+    for url in urls:
+        hashed = url_hash(url)
+        if hashed in seen:
+            URLS.inc("repeated")
+            continue
+        seen.add(hashed)
+        if should_skip_url(url):
+            URLS.inc("skipped")
+            continue
+        if await is_recent_duplicate(message, url, session, recent):
+            logger.info("Url %s already posted in the last 24h, skipping", url)
+            URLS.inc("duplicate")
+            continue
+        URLS.inc("new")
+        new_urls.append(url)
+        if recent is not None:
+            recent.add(message.chat_id, hashed, message.date)
+    return new_urls
+
+
+async def claim_message_urls(
+    message: Message, urls: Iterable[str], session: AsyncSession
+) -> list[str]:
+    """
+    Record the urls of a message in the ledger, returning the ones it didn't
+    have: all of them for a new message, the added ones for an edit.
+
+    Claimed by the unique key, so an update delivered twice, or an edit
+    handled at the same time as the message, doesn't process them again.
+    """
+    hashes = {url: url_hash(url) for url in urls}
+    if not hashes:
+        return []
+    rows = [
+        dict(channel_id=message.chat_id, message_id=message.message_id, url_hash=hashed)
+        for hashed in set(hashes.values())
+    ]
+    claimed = set(
+        await session.scalars(
+            insert(MessageUrl)
+            .values(rows)
+            .on_conflict_do_nothing()
+            .returning(MessageUrl.url_hash)
+        )
+    )
+    return [url for url, hashed in hashes.items() if hashed in claimed]
+
+
+async def apply_edit(
+    message: Message,
+    urls: Iterable[str],
+    session: AsyncSession,
+    settings: EditSettings,
+    recent: RecentUrls | None = None,
+) -> int:
+    """
+    Bring the stored entries of an edited message up to date: the new text,
+    and without the urls the edit removed when deleting them is enabled.
+
+    Returns how many entries were deleted.
+    """
+    if settings.update_message:
+        await session.execute(
+            update(UrlEntry)
+            .where(UrlEntry.channel_id == message.chat_id)
+            .where(UrlEntry.message_id == message.message_id)
+            .where(UrlEntry.message != message.text_html)
+            .values(
+                message=message.text_html,
+                message_text=html_to_text(message.text_html),
+            )
+        )
+    if not settings.delete_removed:
+        return 0
+
+    in_message = (
+        MessageUrl.channel_id == message.chat_id,
+        MessageUrl.message_id == message.message_id,
+    )
+    processed = set(
+        await session.scalars(select(MessageUrl.url_hash).where(*in_message))
+    )
+    removed = processed - {url_hash(url) for url in urls}
+    if not removed:
+        return 0
+    deleted = await delete_entries(
+        session,
+        UrlEntry.channel_id == message.chat_id,
+        UrlEntry.message_id == message.message_id,
+        UrlEntry.url_hash.in_(removed),
     )
-    res = (await session.scalars(query)).first()
-    if res > 0:
-        logger.info("Url %s already posted in the last 24h, skipping", url)
-        return None
+    # The filtered out ones too, adding them back in another edit processes
+    # them again
+    await session.execute(
+        delete(MessageUrl).where(*in_message).where(MessageUrl.url_hash.in_(removed))
+    )
+    if recent is not None:
+        for channel_id, hashed in deleted:
+            recent.discard(channel_id, hashed)
+    logger.info(
+        "Deleted %d entries removed from message %s", len(deleted), message.message_id
+    )
+    return len(deleted)
+
+
+async def release_urls(
+    message: Message,
+    urls: Iterable[str],
+    pending: list[str],
+    session: AsyncSession,
+    recent: RecentUrls | None = None,
+):
+    """
+    Give back the urls claimed by a message when its entries weren't stored,
+    the claim already committed: the update delivered again, or an edit,
+    processes them again.
+    """
+    await session.rollback()
+    await release_message_urls(session, message.chat_id, message.message_id, urls)
+    await session.commit()
+    if recent is not None:
+        for url in pending:
+            recent.discard(message.chat_id, url_hash(url))
+
+
+async def process_urls(
+    message: Message,
+    urls: Iterable[str],
+    session: AsyncSession,
+    scraper: Scraper,
+    recent: RecentUrls | None = None,
+) -> list[UrlEntry]:
+    """
+    Process the urls of a single message into the database
+
+    The new urls are scraped concurrently (bounded by the scraper settings).
+    The entries are added to the session, committing them is up to the caller.
+    """
+    pending = await filter_new_urls(message, urls, session, recent)
+    # Don't hold the connection while scraping: the cache needs one, and an
+    # open read transaction stops the WAL checkpoints
+    await session.commit()
+    try:
+        entries = await scrape_entries(message, pending, scraper)
+    except BaseException:
+        await release_urls(message, urls, pending, session, recent)
+        raise
+    session.add_all(entries)
+    return entries
+
+
+async def scrape_entries(
+    message: Message, pending: list[str], scraper: Scraper
+) -> list[UrlEntry]:
+    """
+    Entries of the new urls of a message, scraped concurrently
+    """
+    semaphore = asyncio.Semaphore(scraper.settings.max_concurrency)
+
+    async def scrape(url: str) -> UrlMetadata | None:
+        async with semaphore:
+            logger.info("Scraping %s", url)
+            return await scrape_og_metadata(url, scraper)
 
-    logger.info("Scraping %s", url)
-    metadata = await scrape_og_metadata(url)
-    entry = create_entry(message, url, metadata)
+    results = await asyncio.gather(
+        *(scrape(url) for url in pending), return_exceptions=True
+    )
 
-    logger.info("Storing entry: %s", url)
-    session.add(entry)
+    entries = []
+    for url, metadata in zip(pending, results):
+        if isinstance(metadata, Exception):
+            logger.error("Error scraping %s", url, exc_info=metadata)
+            metadata = None
+        logger.info("Storing entry: %s", url)
+        entries.append(create_entry(message, url, metadata))
+    return entries
+
+
+async def queue_urls(
+    message: Message,
+    urls: Iterable[str],
+    session: AsyncSession,
+    recent: RecentUrls | None = None,
+) -> list[UrlEntry]:
+    """
+    Store the new urls of a message without metadata, and queue their scraping
+    for the enrichment workers.
+    """
+    entries = [
+        create_entry(message, url, None)
+        for url in await filter_new_urls(message, urls, session, recent)
+    ]
+    for entry in entries:
+        logger.info("Storing pending entry: %s", entry.url)
+    session.add_all(entries)
+    enqueue(session, entries)
+    return entries
+
+
+async def buffer_urls(
+    message: Message,
+    urls: Iterable[str],
+    session: AsyncSession,
+    buffer: EntryBuffer,
+    scraper: Scraper | None,
+    recent: RecentUrls | None = None,
+) -> list[UrlEntry]:
+    """
+    Store the new urls of a message through the write buffer, scraped first
+    with a scraper. Without one the buffer queues them for the enrichment
+    workers.
+    """
+    pending = await filter_new_urls(message, urls, session, recent)
+    await session.commit()
+    if scraper is not None:
+        try:
+            entries = await scrape_entries(message, pending, scraper)
+        except BaseException:
+            await release_urls(message, urls, pending, session, recent)
+            raise
+    else:
+        entries = [create_entry(message, url, None) for url in pending]
+    # From here on the buffer gives them back if they can't be stored
+    await buffer.add(entries)
+    return entries
 
 
 async def handle_message(update: Update, context: CallbackContext):
     message = update.message or update.edited_message
     if message is None:
         return
+    UPDATES.inc("message" if update.message else "edited_message")
 
     urls = get_telegram_urls(message)
     logger.info("Found %s urls", len(urls))
+    URLS.inc("found", amount=len(urls))
 
-    if len(urls) == 0:
+    # An edit may have removed the urls
+    edited = update.edited_message is not None
+    if len(urls) == 0 and not edited:
         return
 
+    enrichment: EnrichmentWorkers | None = context.bot_data["enrichment"]
+    recent: RecentUrls = context.bot_data["recent_urls"]
+    buffer: EntryBuffer | None = context.bot_data["buffer"]
     async with context.bot_data["async_session"]() as session:
-        for url in urls:
-            await process_url(message, url, session)
-        await session.commit()
+        if edited:
+            edits: EditSettings = context.bot_data["edits"]
+            await apply_edit(message, urls, session, edits, recent)
+        claimed = await claim_message_urls(message, urls, session)
+        URLS.inc("processed", amount=len(urls) - len(claimed))
+        urls = claimed
+        if not urls:
+            await session.commit()
+            return
+        if buffer is not None:
+            scraper = context.bot_data["scraper"] if enrichment is None else None
+            await buffer_urls(message, urls, session, buffer, scraper, recent)
+            return
+        if enrichment is None:
+            scraper = context.bot_data["scraper"]
+            await process_urls(message, urls, session, scraper, recent)
+            with DB_COMMITS.time():
+                await session.commit()
+            return
+        await queue_urls(message, urls, session, recent)
+        with DB_COMMITS.time():
+            await session.commit()
+    enrichment.notify()
 
 
 async def handle_membership(update: Update, context: CallbackContext):
@@ -272,7 +431,7 @@ async def handle_membership(update: Update, context: CallbackContext):
         return
     if update.my_chat_member.chat.id in context.bot_data["channels"]:
         logger.info(
-            f"Bot {update.my_chat_member.new_chat_member.status } from allowed channel"
+            f"Bot {update.my_chat_member.new_chat_member.status} from allowed channel"
         )
         return
     if update.my_chat_member.new_chat_member.status == ChatMemberStatus.MEMBER:
@@ -314,8 +473,55 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     )
 
 
-def create_app(settings: Settings, async_session: async_sessionmaker):
-    app = ApplicationBuilder().token(settings.telegram_token).build()
+async def start_background(app: Application):
+    await app.bot_data["loop_lag"].start()
+    await app.bot_data["checkpoints"].start()
+    if app.bot_data["metrics"] is not None:
+        await app.bot_data["metrics"].start()
+    async with app.bot_data["async_session"]() as session:
+        await app.bot_data["recent_urls"].warm_up(session)
+    await app.bot_data["scraper"].start()
+    if app.bot_data["enrichment"] is not None:
+        await app.bot_data["enrichment"].start()
+    if app.bot_data["buffer"] is not None:
+        await app.bot_data["buffer"].start()
+
+
+async def stop_background(app: Application):
+    # The last entries first, they may queue scrapes
+    if app.bot_data["buffer"] is not None:
+        await app.bot_data["buffer"].stop()
+    if app.bot_data["enrichment"] is not None:
+        await app.bot_data["enrichment"].stop()
+    await app.bot_data["scraper"].close()
+    if app.bot_data["scraper"].cache is not None:
+        logger.info("Metadata cache: %s", app.bot_data["scraper"].cache.stats())
+    await app.bot_data["checkpoints"].stop()
+    await app.bot_data["loop_lag"].stop()
+    logger.info("Event loop lag: %s", app.bot_data["loop_lag"].summary())
+    if app.bot_data["metrics"] is not None:
+        await app.bot_data["metrics"].stop()
+
+
+def create_app(
+    settings: Settings,
+    async_session: async_sessionmaker,
+    request: BaseRequest | None = None,
+    resolver: AbstractResolver | None = None,
+):
+    """
+    The bot application. request answers the Bot API calls and resolver the
+    DNS lookups of the scraper, to run it without network (see rejubot.replay).
+    """
+    builder = (
+        ApplicationBuilder()
+        .token(settings.telegram_token)
+        .post_init(start_background)
+        .post_shutdown(stop_background)
+    )
+    if request is not None:
+        builder = builder.request(request)
+    app = builder.build()
     app.add_handler(ChatMemberHandler(handle_membership))
     app.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_message))
     app.add_error_handler(error_handler)
@@ -323,6 +529,35 @@ def create_app(settings: Settings, async_session: async_sessionmaker):
     app.bot_data["channels"] = settings.telegram_channels_by_id
     app.bot_data["error_chat_id"] = settings.error_chat_id
     app.bot_data["async_session"] = async_session
+    app.bot_data["scraper"] = scraper = create_scraper(
+        settings, async_session, resolver=resolver
+    )
+    app.bot_data["recent_urls"] = RecentUrls()
+    app.bot_data["edits"] = settings.edits
+    app.bot_data["loop_lag"] = LoopLagMonitor(
+        settings.monitoring.loop_lag_interval, settings.monitoring.loop_lag_warning
+    )
+    app.bot_data["checkpoints"] = WalCheckpoints(
+        async_session.kw["bind"], settings.database
+    )
+    app.bot_data["metrics"] = None
+    if settings.monitoring.metrics_port is not None:
+        app.bot_data["metrics"] = MetricsServer(
+            settings.monitoring.metrics_host, settings.monitoring.metrics_port
+        )
+    app.bot_data["enrichment"] = None
+    if settings.enrichment.workers > 0:
+        app.bot_data["enrichment"] = EnrichmentWorkers(
+            settings.enrichment, async_session, scraper
+        )
+    app.bot_data["buffer"] = None
+    if settings.write_buffer.enabled:
+        app.bot_data["buffer"] = EntryBuffer(
+            settings.write_buffer,
+            async_session,
+            app.bot_data["recent_urls"],
+            app.bot_data["enrichment"],
+        )
 
     return app
 
@@ -331,7 +566,9 @@ def run():
     setup_logging()
 
     settings = load_settings()
-    engine = create_async_engine(settings.db_url)
+    # Single connection, the writes wait for their turn in the pool
+    engine = create_engine(settings.db_url, settings.database, writer=True)
+    instrument_engine(engine)
     async_session = async_sessionmaker(engine, expire_on_commit=False)
 
     app = create_app(settings, async_session)
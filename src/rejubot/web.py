@@ -1,23 +1,40 @@
 import logging
-import os
+import time
 from contextlib import asynccontextmanager
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
 from pathlib import Path
+from typing import Literal
+from urllib.parse import quote
 
-from fastapi import Depends, FastAPI, Request
-from fastapi.responses import HTMLResponse
+from fastapi import Depends, FastAPI, HTTPException, Query, Request
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from sqlalchemy import func, select
-from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
-from sqlalchemy.orm import joinedload
+from sqlalchemy import Select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
+from rejubot import api, search
 from rejubot.logging import setup_logging
+from rejubot.metrics import CONTENT_TYPE, REGISTRY, RENDERS, instrument_engine
+from rejubot.monitoring import LoopLagMonitor
+from rejubot.pagination import Cursor, group_by_day, keyset_page, page_query
 from rejubot.settings import load_settings
-from rejubot.storage import UrlEntry
+from rejubot.storage import create_engine
+from rejubot.webcache import (
+    FragmentCache,
+    http_headers,
+    is_not_modified,
+    links_version,
+    make_etag,
+    page_last_modified,
+)
 
 logger = logging.getLogger(__name__)
 base = Path(__file__).parent
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 500
+SEARCH_PAGE_SIZE = 20
+MAX_SEARCH_PAGE = 50
 
 
 @asynccontextmanager
@@ -25,11 +42,20 @@ async def lifespan(app: FastAPI) -> None:  # pylint: disable=W0612
     setup_logging()
 
     settings = load_settings()
-    engine = create_async_engine(settings.db_url)
+    # The web only reads, the bot is the writer
+    engine = create_engine(settings.db_url, settings.database, read_only=True)
+    instrument_engine(engine)
     session_factory = async_sessionmaker(engine, expire_on_commit=False)
     app.state.session_factory = session_factory
     app.state.channels = settings.telegram_channels
+    app.state.fragments = FragmentCache(settings.web.fragment_cache_entries)
+    loop_lag = LoopLagMonitor(
+        settings.monitoring.loop_lag_interval, settings.monitoring.loop_lag_warning
+    )
+    await loop_lag.start()
     yield
+    await loop_lag.stop()
+    await engine.dispose()
 
 
 async def get_session(request: Request):
@@ -37,7 +63,7 @@ async def get_session(request: Request):
         yield session
 
 
-def get_channels(request: Request) -> dict[str, id]:
+def get_channels(request: Request) -> dict[str, int]:
     return request.app.state.channels
 
 
@@ -47,59 +73,234 @@ app.mount("/static", StaticFiles(directory=base / "static"), name="static")
 templates = Jinja2Templates(directory=base / "templates")
 
 
+def decode_cursor(cursor: str) -> Cursor:
+    try:
+        return Cursor.decode(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def channel_id_of(channels: dict[str, int], channel: str) -> int:
+    if (channel_id := channels.get(channel)) is None:
+        raise HTTPException(status_code=404, detail="Channel not found")
+    return channel_id
+
+
 @app.get("/links", response_class=HTMLResponse)
 async def read_item(
     request: Request,
+    cursor: str = None,
     partial_after: date = None,
     from_date: date = None,
+    page_size: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
     db: AsyncSession = Depends(get_session),
 ):
-    # Find the last 7 days
-    query = select(func.date(UrlEntry.created_at))
-    if partial_after:
-        query = query.where(func.date(UrlEntry.created_at) < partial_after)
-    elif from_date:
-        query = query.where(func.date(UrlEntry.created_at) <= from_date)
-    query = query.distinct().order_by(func.date(UrlEntry.created_at).desc()).limit(7)
-    result = (await db.scalars(query)).all()
+    """
+    Newest links of all the channels, grouped by day.
+
+    partial_after is the cursor of older versions of the page, kept so they
+    keep scrolling.
+    """
+    return await render_links(
+        request, db, None, "/links", cursor, partial_after, from_date, page_size
+    )
 
-    entries_by_day = []
-    if len(result) != 0:
-        entries_by_day = await get_url_entries(db, result[0], result[-1])
+
+@app.get("/links/{channel}", response_class=HTMLResponse)
+async def read_channel(
+    request: Request,
+    channel: str,
+    cursor: str = None,
+    from_date: date = None,
+    page_size: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_session),
+    channels: dict[str, int] = Depends(get_channels),
+):
+    """
+    Newest links of a channel, grouped by day
+    """
+    channel_id = channel_id_of(channels, channel)
+    return await render_links(
+        request,
+        db,
+        channel_id,
+        f"/links/{quote(channel)}",
+        cursor,
+        None,
+        from_date,
+        page_size,
+        channel=channel,
+    )
+
+
+async def render_links(
+    request: Request,
+    db: AsyncSession,
+    channel_id: int | None,
+    links_url: str,
+    cursor: str | None,
+    partial_after: date | None,
+    from_date: date | None,
+    page_size: int,
+    channel: str | None = None,
+) -> Response:
+    """
+    A page of links. The last day of the page loads the next page
+    (links_days.html) when it is revealed.
+
+    Rendered pages are cached by ETag until the entries of their days change.
+    """
+    started = time.perf_counter()
+    start = None
+    if cursor:
+        start = decode_cursor(cursor)
+    elif partial_after:
+        start = Cursor.before_day(partial_after)
+    elif from_date:
+        start = Cursor.before_day(from_date + timedelta(days=1))
 
     template = "links.html"
-    if partial_after:
+    if cursor or partial_after:
         template = "links_days.html"
     # Format today's date as year-month-day
-    today = datetime.now().strftime("%Y-%m-%d")
+    now = datetime.now()
+    today = now.strftime("%Y-%m-%d")
+
+    # Checked before loading the entries, a write meanwhile changes it again
+    version = await links_version(
+        db, start.created_at.date() if start else None, channel_id
+    )
+    etag = make_etag((template, channel_id, start, page_size, today), version)
+    last_modified = page_last_modified(version, now.date())
+    headers = http_headers(etag, last_modified)
+    if is_not_modified(request, etag, last_modified):
+        RENDERS.observe(time.perf_counter() - started, template, "not_modified")
+        return Response(status_code=304, headers=headers)
+
+    fragments: FragmentCache = request.app.state.fragments
+    page = fragments.get(etag)
+    outcome = "cached"
+    if page is None:
+        outcome = "rendered"
+        query = page_query(start, page_size, channel_id)
+        entries = (await db.scalars(query)).all()
+        next_cursor = None
+        if len(entries) == page_size:
+            next_cursor = Cursor.after_entry(entries[-1]).encode()
+        page = templates.get_template(template).render(
+            channel=channel,
+            links_url=links_url,
+            days=group_by_day(entries),
+            # The previous page already has the header of this day
+            continued_day=start.created_at.date() if cursor else None,
+            next_cursor=next_cursor,
+            today=today,
+        )
+        fragments.put(etag, page)
+    RENDERS.observe(time.perf_counter() - started, template, outcome)
+    return HTMLResponse(page, headers=headers)
+
+
+def api_query(
+    channels: dict[str, int],
+    fields: str | None,
+    channel: str | None,
+    from_date: date | None,
+    to_date: date | None,
+) -> tuple[Select, list[str]]:
+    try:
+        field_names = api.parse_fields(fields)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    channel_id = channel_id_of(channels, channel) if channel else None
+    query = api.links_query(field_names, channel_id, from_date, to_date)
+    return query, field_names
+
+
+@app.get("/api/links")
+async def api_links(
+    cursor: str = None,
+    channel: str = None,
+    from_date: date = None,
+    to_date: date = None,
+    fields: str = None,
+    page_size: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    db: AsyncSession = Depends(get_session),
+    channels: dict[str, int] = Depends(get_channels),
+):
+    """
+    Links newest first, next_cursor continues with the next page.
+
+    fields is a comma separated list of fields, all of them by default.
+    """
+    query, field_names = api_query(channels, fields, channel, from_date, to_date)
+    start = decode_cursor(cursor) if cursor else None
+    rows = (await db.execute(keyset_page(query, start, page_size))).all()
+    next_cursor = None
+    if len(rows) == page_size:
+        next_cursor = api.row_cursor(rows[-1]).encode()
+    return dict(
+        links=[api.row_to_dict(row, field_names) for row in rows],
+        next_cursor=next_cursor,
+    )
+
+
+@app.get("/api/links/export")
+async def api_links_export(
+    request: Request,
+    channel: str = None,
+    from_date: date = None,
+    to_date: date = None,
+    fields: str = None,
+    channels: dict[str, int] = Depends(get_channels),
+):
+    """
+    All the links as NDJSON, oldest first, streamed from the database
+    """
+    query, field_names = api_query(channels, fields, channel, from_date, to_date)
+    lines = api.export_lines(request.app.state.session_factory, query, field_names)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
+
+@app.get("/search", response_class=HTMLResponse)
+async def search_links(
+    request: Request,
+    q: str = "",
+    channel: str = None,
+    sort: Literal["rank", "recent"] = "rank",
+    page: int = Query(0, ge=0, le=MAX_SEARCH_PAGE),
+    db: AsyncSession = Depends(get_session),
+    channels: dict[str, int] = Depends(get_channels),
+):
+    """
+    Full text search over titles, descriptions, sites, messages and authors
+    """
+    channel_id = channel_id_of(channels, channel) if channel else None
+    results, more = await search.search(db, q, channel_id, sort, page, SEARCH_PAGE_SIZE)
     return templates.TemplateResponse(
-        template, dict(request=request, days=entries_by_day, today=today)
+        request,
+        "search.html",
+        dict(
+            q=q,
+            channel=channel,
+            channels=channels,
+            sort=sort,
+            page=page,
+            more=more and page < MAX_SEARCH_PAGE,
+            results=results,
+        ),
     )
 
 
-async def get_url_entries(db, first_day, last_day):
-    query = (
-        select(UrlEntry)
-        .where(func.date(UrlEntry.created_at).between(last_day, first_day))
-        .order_by(UrlEntry.created_at.desc())
-    ).options(joinedload(UrlEntry.video))
-    result = await db.scalars(query)
-
-    # Group entries by day
-    entries_by_day = []
-    current_day = None
-    entries = None
-    for entry in result.all():
-        day = entry.created_at.date()
-        if day != current_day:
-            current_day = day
-            entries = []
-            entries_by_day.append([current_day, entries, False])
-        entries.append(entry)
-    entries_by_day[-1][2] = True
-    return entries_by_day
+@app.get("/metrics")
+async def metrics():
+    """
+    Metrics of the web process in the Prometheus text format. Rendered in the
+    event loop, the only thread updating them, not in the threadpool.
+    """
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
 
 
 @app.get("/")
-def root(request: Request):
-    return templates.TemplateResponse("root.html", dict(request=request))
+def root(request: Request, channels: dict[str, int] = Depends(get_channels)):
+    return templates.TemplateResponse(request, "root.html", dict(channels=channels))
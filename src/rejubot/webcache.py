@@ -0,0 +1,125 @@
+"""
+Cache of the rendered link pages, and conditional GET.
+
+A page only changes when the entries of its days change. The version of the
+days comes from link_days, kept by triggers on every write to url_entries,
+and is checked before anything else: a page whose days didn't change is
+served from memory or answered with a 304, without loading any entry.
+"""
+
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import date, datetime, time, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+
+from fastapi import Request
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from rejubot.storage import LinkDay
+
+
+@dataclass(frozen=True)
+class LinksVersion:
+    days: int
+    version: int
+    updated_at: datetime | None
+
+    @property
+    def last_modified(self) -> datetime | None:
+        if self.updated_at is None:
+            return None
+        # SQLite CURRENT_TIMESTAMP is UTC
+        return self.updated_at.replace(tzinfo=timezone.utc)
+
+
+async def links_version(
+    db: AsyncSession, until: date | None = None, channel_id: int | None = None
+) -> LinksVersion:
+    """
+    Version of the days up to until, included, of all the channels or one.
+    Versions only grow, so their sum changes with any write.
+    """
+    query = select(
+        func.count(),
+        func.coalesce(func.sum(LinkDay.version), 0),
+        func.max(LinkDay.updated_at),
+    )
+    if until is not None:
+        query = query.where(LinkDay.day <= until)
+    if channel_id is not None:
+        query = query.where(LinkDay.channel_id == channel_id)
+    days, version, updated_at = (await db.execute(query)).one()
+    return LinksVersion(days, version, updated_at)
+
+
+def make_etag(key: tuple, version: LinksVersion) -> str:
+    digest = hashlib.blake2b(repr((key, version)).encode(), digest_size=16)
+    return f'"{digest.hexdigest()}"'
+
+
+def page_last_modified(version: LinksVersion, today: date) -> datetime:
+    """
+    When the page last changed, from what its ETag is made of: the writes to
+    its days, and today's date that the page shows too. In whole seconds,
+    like the header.
+    """
+    # Midnight where the page is rendered, the date is local
+    modified = datetime.combine(today, time.min).astimezone(timezone.utc)
+    if version.last_modified is not None:
+        modified = max(modified, version.last_modified)
+    return modified.replace(microsecond=0)
+
+
+def http_headers(etag: str, last_modified: datetime) -> dict[str, str]:
+    # Cached by the browser, but always checked with the server
+    return {
+        "ETag": etag,
+        "Cache-Control": "no-cache",
+        "Last-Modified": format_datetime(last_modified, usegmt=True),
+    }
+
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime) -> bool:
+    """
+    If-None-Match wins over If-Modified-Since, as in RFC 9110: the date is
+    only checked when the request has no ETags.
+    """
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        # Modified when it changed after the copy of the client
+        return not since < last_modified
+    return False
+
+
+class FragmentCache:
+    """
+    LRU of rendered pages by ETag
+    """
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.pages: OrderedDict[str, str] = OrderedDict()
+
+    def get(self, etag: str) -> str | None:
+        page = self.pages.get(etag)
+        if page is not None:
+            self.pages.move_to_end(etag)
+        return page
+
+    def put(self, etag: str, page: str):
+        self.pages[etag] = page
+        self.pages.move_to_end(etag)
+        while len(self.pages) > self.max_entries:
+            self.pages.popitem(last=False)
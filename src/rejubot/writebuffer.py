@@ -0,0 +1,169 @@
+"""
+Write-behind of the url entries of the bot.
+
+Each message with links used to be its own transaction, and each commit
+waits for the disk. With the buffer the entries of many messages are
+inserted in a single transaction, when there are max_entries of them or
+the oldest has waited max_delay seconds, and on shutdown.
+
+Entries are already accepted as new when they reach the buffer: the recent
+urls remember them, so the duplicate checks of the next messages see them
+before they are in the database. An entry that fails to insert is logged
+and dropped, and forgotten by the recent urls and the ledger of the urls
+of each message, without losing the rest.
+"""
+
+import asyncio
+import logging
+
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+from rejubot.dedup import RecentUrls
+from rejubot.enrichment import EnrichmentWorkers, enqueue
+from rejubot.metrics import BUFFERED, DB_COMMITS
+from rejubot.settings import WriteBufferSettings
+from rejubot.storage import UrlEntry, release_message_urls, url_hash
+
+logger = logging.getLogger(__name__)
+
+
+class EntryBuffer:
+    """
+    Entries waiting to be inserted together, flushed by size, time and stop
+    """
+
+    def __init__(
+        self,
+        settings: WriteBufferSettings,
+        session_factory: async_sessionmaker,
+        recent: RecentUrls | None = None,
+        enrichment: EnrichmentWorkers | None = None,
+    ):
+        self.settings = settings
+        self.session_factory = session_factory
+        self.recent = recent
+        # Entries are stored pending and queued for the workers
+        self.enrichment = enrichment
+        self.entries: list[UrlEntry] = []
+        self.lock = asyncio.Lock()
+        self.added = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.stopping = False
+
+    async def start(self):
+        self.stopping = False
+        self.task = asyncio.create_task(self.run(), name="entry-buffer")
+
+    async def stop(self):
+        # Like the enrichment workers, in case the pool swallows the cancel
+        self.stopping = True
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        try:
+            await self.flush()
+        except Exception:
+            # Nothing retries them after this, the shutdown goes on anyway
+            logger.exception(
+                "Error flushing the entry buffer, %d entries lost", len(self.entries)
+            )
+            BUFFERED.inc("failed", amount=len(self.entries))
+            entries, self.entries = self.entries, []
+            await self.release(entries)
+
+    async def add(self, entries: list[UrlEntry]):
+        """
+        Buffer the entries, flushing them if the buffer is full
+        """
+        if not entries:
+            return
+        self.entries.extend(entries)
+        self.added.set()
+        if len(self.entries) >= self.settings.max_entries:
+            await self.flush()
+
+    async def run(self):
+        while not self.stopping:
+            await self.added.wait()
+            await asyncio.sleep(self.settings.max_delay)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Error flushing the entry buffer")
+
+    async def flush(self) -> int:
+        """
+        Insert the buffered entries, returns how many were stored
+        """
+        async with self.lock:
+            entries, self.entries = self.entries, []
+            self.added.clear()
+            if not entries:
+                return 0
+            async with self.session_factory() as session:
+                try:
+                    self.store(session, entries)
+                    with DB_COMMITS.time():
+                        await session.commit()
+                    stored = len(entries)
+                except Exception:
+                    logger.exception("Error storing %d entries together", len(entries))
+                    await session.rollback()
+                    try:
+                        stored = await self.store_each(session, entries)
+                    except Exception:
+                        # Not the entries but the database, try them again later
+                        self.entries[:0] = entries
+                        self.added.set()
+                        raise
+        BUFFERED.inc("stored", amount=stored)
+        logger.info("Stored %d buffered entries", stored)
+        if stored and self.enrichment is not None:
+            self.enrichment.notify()
+        return stored
+
+    def store(self, session: AsyncSession, entries: list[UrlEntry]):
+        session.add_all(entries)
+        if self.enrichment is not None:
+            enqueue(session, entries)
+
+    async def store_each(self, session: AsyncSession, entries: list[UrlEntry]) -> int:
+        """
+        Insert the entries one by one, still in a single transaction
+        """
+        stored = 0
+        for entry in entries:
+            try:
+                async with session.begin_nested():
+                    self.store(session, [entry])
+                stored += 1
+            except Exception:
+                logger.exception("Error storing the entry of %s", entry.url)
+                BUFFERED.inc("failed")
+                if self.recent is not None:
+                    self.recent.discard(entry.channel_id, url_hash(entry.url))
+                await release_message_urls(
+                    session, entry.channel_id, entry.message_id, [entry.url]
+                )
+        with DB_COMMITS.time():
+            await session.commit()
+        return stored
+
+    async def release(self, entries: list[UrlEntry]):
+        """
+        Give back the urls of the entries lost on stop, so an edit of their
+        messages processes them again. The database just failed, it may not
+        work either.
+        """
+        try:
+            async with self.session_factory() as session:
+                for entry in entries:
+                    await release_message_urls(
+                        session, entry.channel_id, entry.message_id, [entry.url]
+                    )
+                await session.commit()
+        except Exception:
+            logger.exception("Error releasing the urls of %d entries", len(entries))
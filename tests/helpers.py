@@ -0,0 +1,59 @@
+"""
+Shared helpers for the tests: a local site to scrape and a scratch database.
+"""
+
+import asyncio
+from datetime import datetime, timezone
+from pathlib import Path
+
+from aiohttp import web
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from telegram import Chat, Message, User
+
+from rejubot.storage import Base
+
+PAGE = """<html><head>
+<meta property="og:title" content="Title {path}">
+</head></html>"""
+
+
+def create_site() -> web.Application:
+    """
+    Answers any path with an Open Graph title, after an optional ?delay=
+    """
+
+    async def page(request):
+        await asyncio.sleep(float(request.query.get("delay", 0)))
+        return web.Response(
+            text=PAGE.format(path=request.path), content_type="text/html"
+        )
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", page)
+    return app
+
+
+def create_message(
+    text: str,
+    message_id: int = 1,
+    chat_id: int = 1,
+    date: datetime = datetime(2024, 1, 1, 12, tzinfo=timezone.utc),
+) -> Message:
+    return Message(
+        message_id=message_id,
+        date=date,
+        chat=Chat(id=chat_id, type="group"),
+        text=text,
+        from_user=User(id=1, first_name="Test", is_bot=False),
+    )
+
+
+async def create_session_factory(directory: Path) -> async_sessionmaker:
+    """
+    Database in a file, so concurrent sessions behave like in production
+    instead of sharing the single in memory connection.
+    """
+    engine = create_async_engine(f"sqlite+aiosqlite:///{directory / 'rejubot.db'}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    return async_sessionmaker(engine, expire_on_commit=False)
@@ -0,0 +1,164 @@
+import asyncio
+from pathlib import Path
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from helpers import create_session_factory
+
+from rejubot.cache import MetadataCache, Validators
+from rejubot.opengraph import UrlMetadata
+from rejubot.scraper import Scraper, fetch_og_metadata
+from rejubot.settings import CacheSettings, ScraperSettings
+
+METADATA = UrlMetadata(
+    site="Site",
+    title="Title",
+    description=None,
+    image=None,
+    video_url=None,
+    video_type=None,
+    video_width=None,
+    video_height=None,
+)
+
+
+def test_cache_tiers(tmp_path: Path):
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        cache = MetadataCache(CacheSettings(), session_factory)
+        assert await cache.get("https://example.com/a") == (False, None)
+        await cache.put("https://example.com/a", METADATA, "text/html")
+        await cache.put("https://example.com/empty", None, "text/html")
+        assert await cache.get("http://www.example.com/a/?utm_source=x") == (
+            True,
+            METADATA,
+        )
+        assert await cache.get("https://example.com/empty") == (True, None)
+
+        # A new process only has the database
+        other = MetadataCache(CacheSettings(), session_factory)
+        assert await other.get("https://example.com/a") == (True, METADATA)
+        return cache.stats(), other.stats()
+
+    stats, other_stats = asyncio.run(run())
+    assert stats == dict(
+        hits=2,
+        memory_hits=2,
+        db_hits=0,
+        negative_hits=1,
+        misses=1,
+        memory_entries=2,
+    )
+    assert other_stats["db_hits"] == 1
+
+
+def test_cache_expiration_and_eviction(tmp_path: Path):
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        settings = CacheSettings(memory_entries=1, ttl_negative=-1)
+        cache = MetadataCache(settings, session_factory)
+        await cache.put("https://example.com/empty", None, None)
+        assert await cache.get("https://example.com/empty") == (False, None)
+        assert await cache.purge() == 1
+
+        await cache.put("https://example.com/a", METADATA, "text/html")
+        await cache.put("https://example.com/b", METADATA, "text/html")
+        assert list(cache.memory) == ["https://example.com/b"]
+        # Evicted from memory, still in the database
+        assert await cache.get("https://example.com/a") == (True, METADATA)
+
+    asyncio.run(run())
+
+
+def test_fetch_og_metadata_uses_cache(tmp_path: Path):
+    requests = []
+
+    async def page(request):
+        requests.append(request.path)
+        return web.Response(
+            text='<meta property="og:title" content="Title">',
+            content_type="text/html",
+        )
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/{tail:.*}", page)
+        session_factory = await create_session_factory(tmp_path)
+        cache = MetadataCache(CacheSettings(), session_factory)
+        async with TestServer(app) as server:
+            async with Scraper(ScraperSettings(), cache=cache) as scraper:
+                url = str(server.make_url("/page"))
+                first = await fetch_og_metadata(url, scraper)
+                second = await fetch_og_metadata(url, scraper)
+        return first, second
+
+    first, second = asyncio.run(run())
+    assert first == second
+    assert first.title == "Title"
+    assert requests == ["/page"]
+
+
+def test_fetch_og_metadata_revalidates(tmp_path: Path):
+    requests = []
+    version = "1"
+
+    async def page(request):
+        requests.append((request.path, request.headers.get("If-None-Match")))
+        if request.path == "/old":
+            raise web.HTTPFound("/page")
+        etag = f'"v{version}"'
+        if request.headers.get("If-None-Match") == etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(
+            text=f'<meta property="og:title" content="Title {version}">',
+            content_type="text/html",
+            headers={"ETag": etag},
+        )
+
+    async def run():
+        nonlocal version
+        app = web.Application()
+        app.router.add_get("/{tail:.*}", page)
+        session_factory = await create_session_factory(tmp_path)
+        cache = MetadataCache(CacheSettings(), session_factory)
+        async with TestServer(app) as server:
+            async with Scraper(ScraperSettings(), cache=cache) as scraper:
+                url = str(server.make_url("/old"))
+                titles = [(await fetch_og_metadata(url, scraper)).title]
+                titles.append((await fetch_og_metadata(url, scraper, True)).title)
+                version = "2"
+                titles.append((await fetch_og_metadata(url, scraper, True)).title)
+                stale = await cache.stale(url)
+        return titles, stale
+
+    titles, stale = asyncio.run(run())
+    assert titles == ["Title 1", "Title 1", "Title 2"]
+    # Refreshed from the url it redirected to, unchanged the first time
+    assert requests == [
+        ("/old", None),
+        ("/page", None),
+        ("/page", '"v1"'),
+        ("/page", '"v1"'),
+    ]
+    assert stale.validators.etag == '"v2"'
+    assert stale.validators.final_url.endswith("/page")
+
+
+def test_purge_keeps_validated_entries(tmp_path: Path):
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        settings = CacheSettings(ttl_html=-1)
+        cache = MetadataCache(settings, session_factory)
+        await cache.put("https://example.com/a", METADATA, "text/html")
+        await cache.put(
+            "https://example.com/b", METADATA, "text/html", Validators(etag='"b"')
+        )
+        assert await cache.purge() == 1
+        assert await cache.get("https://example.com/b") == (False, None)
+        stale = await cache.stale("https://example.com/b")
+        assert stale.metadata == METADATA
+
+        settings.keep_validated = -1
+        assert await cache.purge() == 1
+
+    asyncio.run(run())
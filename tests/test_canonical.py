@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+
+from rejubot.canonical import canonical_url, fetch_url, hit_rates
+
+
+def test_canonical_url_generic():
+    assert canonical_url("HTTPS://Example.COM:443/Path/?utm_source=a&q=1#top") == (
+        "https://example.com/Path?q=1"
+    )
+    assert canonical_url("example.com") == "https://example.com/"
+    assert canonical_url("http://www.example.com:8080/") == "https://example.com:8080/"
+    assert canonical_url("https://example.com/?b=2&a=1&fbclid=x") == (
+        "https://example.com/?a=1&b=2"
+    )
+
+
+def test_canonical_url_aliases():
+    youtube = "https://www.youtube.com/watch?t=10&v=abc"
+    assert canonical_url("https://youtu.be/abc?si=share&t=10") == youtube
+    assert canonical_url("https://m.youtube.com/watch?v=abc&feature=share&t=10") == (
+        youtube
+    )
+    for url in (
+        "https://x.com/user/status/1?s=20",
+        "https://mobile.twitter.com/user/status/1",
+        "https://vxtwitter.com/user/status/1/",
+    ):
+        assert canonical_url(url) == "https://twitter.com/user/status/1"
+    assert canonical_url("https://www.ddinstagram.com/reel/xyz/?igsh=aa") == (
+        "https://www.instagram.com/reel/xyz"
+    )
+
+
+def test_fetch_url():
+    assert fetch_url("https://x.com/user/status/1?s=20") == (
+        "https://vxtwitter.com/user/status/1"
+    )
+    assert fetch_url("https://instagram.com/reel/xyz/?igsh=aa") == (
+        "https://www.ddinstagram.com/reel/xyz/"
+    )
+    # Path and scheme as they were, the server might care
+    assert fetch_url("http://www.example.com/a/?utm_medium=x&q=1#top") == (
+        "http://www.example.com/a/?q=1"
+    )
+    # The query as it was written, only the tracking parameters dropped
+    assert fetch_url("https://example.com/search?q=a+b&flag&path=a/b;c") == (
+        "https://example.com/search?q=a+b&flag&path=a/b;c"
+    )
+    assert fetch_url("https://example.com/?q=%7E1&utm_source=x&b=a%20b") == (
+        "https://example.com/?q=%7E1&b=a%20b"
+    )
+
+
+def test_hit_rates():
+    start = datetime(2024, 1, 1)
+    links = [
+        (start, "https://youtu.be/abc"),
+        (start + timedelta(hours=1), "https://www.youtube.com/watch?v=abc"),
+        (start + timedelta(days=2), "https://m.youtube.com/watch?v=abc"),
+        (start + timedelta(days=2), "https://example.com/"),
+    ]
+    stats = hit_rates(links, timedelta(days=1))
+    assert stats == dict(
+        links=4,
+        raw_fetches=4,
+        raw_distinct=4,
+        canonical_fetches=2,
+        canonical_duplicates=1,
+        canonical_cache_hits=1,
+        canonical_distinct=2,
+    )
@@ -0,0 +1,67 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from helpers import create_message, create_session_factory
+
+from rejubot.dedup import RecentUrls
+from rejubot.storage import url_hash
+from rejubot.telegrambot import create_entry, is_recent_duplicate
+
+NOW = datetime(2024, 1, 1, 12, tzinfo=timezone.utc)
+
+
+def test_recent_urls():
+    recent = RecentUrls()
+    recent.add(1, 10, NOW)
+    assert recent.is_duplicate(1, 10, NOW + timedelta(hours=23)) is True
+    # Unknown until warmed up
+    assert recent.is_duplicate(1, 10, NOW + timedelta(hours=25)) is None
+    assert recent.is_duplicate(2, 10, NOW) is None
+
+    recent.complete = True
+    assert recent.is_duplicate(1, 10, NOW + timedelta(hours=25)) is False
+    assert recent.is_duplicate(2, 10, NOW) is False
+
+
+def test_recent_urls_expire():
+    recent = RecentUrls()
+    recent.add(1, 10, NOW)
+    recent.add(1, 11, NOW + timedelta(hours=12))
+    recent.add(1, 12, NOW + timedelta(hours=25))
+    assert list(recent.posted) == [(1, 11), (1, 12)]
+
+
+def test_is_recent_duplicate_by_channel(tmp_path: Path):
+    url = "https://example.com/a"
+
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        async with session_factory() as session:
+            session.add(create_entry(create_message(url, chat_id=1), url, None))
+            await session.commit()
+
+            later = create_message(url, chat_id=1, date=NOW + timedelta(hours=1))
+            return [
+                await is_recent_duplicate(later, url, session),
+                await is_recent_duplicate(create_message(url, chat_id=2), url, session),
+            ]
+
+    assert asyncio.run(run()) == [True, False]
+
+
+def test_recent_urls_warm_up(tmp_path: Path):
+    url = "https://example.com/a"
+
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        recent = RecentUrls()
+        async with session_factory() as session:
+            session.add(create_entry(create_message(url), url, None))
+            await session.commit()
+            await recent.warm_up(session, NOW + timedelta(hours=1))
+        return recent
+
+    recent = asyncio.run(run())
+    assert recent.complete
+    assert recent.is_duplicate(1, url_hash(url), NOW + timedelta(hours=2))
@@ -0,0 +1,132 @@
+import asyncio
+from datetime import datetime
+
+from aiohttp.test_utils import TestServer
+from helpers import create_message, create_session_factory, create_site
+from sqlalchemy import select
+
+from rejubot.enrichment import EnrichmentWorkers
+from rejubot.scraper import Scraper
+from rejubot.settings import EnrichmentSettings, ScraperSettings
+from rejubot.storage import MetadataStatus, ScrapeJob, UrlEntry
+from rejubot.telegrambot import queue_urls
+
+
+async def queue(session_factory, urls: list[str]) -> list[UrlEntry]:
+    async with session_factory() as session:
+        entries = await queue_urls(create_message(" ".join(urls)), urls, session)
+        await session.commit()
+    return entries
+
+
+async def wait_for_jobs(session_factory):
+    for _ in range(100):
+        async with session_factory() as session:
+            if not (await session.scalars(select(ScrapeJob))).all():
+                return
+        await asyncio.sleep(0.05)
+    raise AssertionError("Jobs not processed")
+
+
+def test_workers_fill_pending_entries(tmp_path):
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        async with TestServer(create_site()) as server:
+            async with Scraper(ScraperSettings()) as scraper:
+                urls = [str(server.make_url(path)) for path in ["/a", "/b"]]
+                entries = await queue(session_factory, urls)
+                assert {entry.metadata_status for entry in entries} == {
+                    MetadataStatus.PENDING
+                }
+
+                workers = EnrichmentWorkers(
+                    EnrichmentSettings(workers=2), session_factory, scraper
+                )
+                await workers.start()
+                workers.notify()
+                await wait_for_jobs(session_factory)
+                await workers.stop()
+
+        async with session_factory() as session:
+            return (await session.scalars(select(UrlEntry))).all()
+
+    entries = asyncio.run(run())
+    assert sorted(entry.og_title for entry in entries) == ["Title /a", "Title /b"]
+    assert {entry.metadata_status for entry in entries} == {MetadataStatus.DONE}
+
+
+def test_workers_retry_with_backoff(tmp_path):
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        settings = EnrichmentSettings(retry_backoff=60, max_attempts=2)
+        async with Scraper(ScraperSettings(timeout=1)) as scraper:
+            await queue(session_factory, ["http://127.0.0.1:1/down"])
+            workers = EnrichmentWorkers(settings, session_factory, scraper)
+
+            await workers.process(await workers.claim())
+            async with session_factory() as session:
+                job = await session.scalar(select(ScrapeJob))
+            assert job.attempts == 1
+            assert job.claimed_at is None
+            assert job.last_error is not None
+            # Not available until the backoff is over
+            assert await workers.claim() is None
+
+            # Last attempt
+            job.available_at = datetime(2000, 1, 1)
+            async with session_factory() as session:
+                await session.merge(job)
+                await session.commit()
+            await workers.process(await workers.claim())
+
+        async with session_factory() as session:
+            assert (await session.scalars(select(ScrapeJob))).all() == []
+            return await session.scalar(select(UrlEntry))
+
+    entry = asyncio.run(run())
+    assert entry.metadata_status == MetadataStatus.FAILED
+
+
+def test_workers_recover_claimed_jobs(tmp_path):
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        settings = EnrichmentSettings(visibility_timeout=600)
+        workers = EnrichmentWorkers(settings, session_factory, None)
+        await queue(session_factory, ["http://example.com"])
+
+        # Claimed by a process that died before finishing it
+        assert await workers.claim() is not None
+        assert await workers.claim() is None
+
+        await workers.recover()
+        return await workers.claim()
+
+    job = asyncio.run(run())
+    assert job.attempts == 2
+
+
+def test_workers_give_up_on_other_errors(tmp_path, monkeypatch):
+    async def broken_parser(url, scraper):
+        raise ValueError("Can't parse")
+
+    monkeypatch.setattr("rejubot.enrichment.fetch_og_metadata", broken_parser)
+
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        settings = EnrichmentSettings(retry_backoff=0, max_attempts=2)
+        workers = EnrichmentWorkers(settings, session_factory, None)
+        await queue(session_factory, ["http://example.com"])
+
+        job = await workers.claim()
+        await workers.process(job)
+        async with session_factory() as session:
+            job = await session.scalar(select(ScrapeJob))
+        assert job.last_error == 'ValueError("Can\'t parse")'
+        await workers.process(await workers.claim())
+
+        async with session_factory() as session:
+            assert (await session.scalars(select(ScrapeJob))).all() == []
+            return await session.scalar(select(UrlEntry))
+
+    entry = asyncio.run(run())
+    assert entry.metadata_status == MetadataStatus.FAILED
@@ -0,0 +1,172 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from helpers import PAGE, create_session_factory
+from sqlalchemy import select
+
+from rejubot.hosts import (
+    CircuitBreaker,
+    CircuitState,
+    HostScheduler,
+    HostUnavailable,
+    TokenBucket,
+)
+from rejubot.scraper import Scraper, fetch_og_metadata, scrape_og_metadata
+from rejubot.settings import HostSettings, ScraperSettings
+from rejubot.storage import HostStatus
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_token_bucket():
+    clock = Clock()
+    bucket = TokenBucket(rate=2, burst=3, clock=clock)
+    assert [bucket.try_take() for _ in range(3)] == [0, 0, 0]
+    assert bucket.try_take() == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.try_take() == 0
+    # Never more than the burst
+    clock.now += 100
+    assert [bucket.try_take() for _ in range(4)][-1] > 0
+
+
+def test_circuit_breaker():
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=2, cooldown=10, clock=clock)
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == CircuitState.OPEN
+    assert not breaker.allow()
+
+    clock.now += 10
+    # A single request tries the host again
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.failure()
+    assert breaker.state == CircuitState.OPEN
+
+    clock.now += 10
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.allow() and breaker.allow()
+
+
+def test_circuit_breaker_retry_after():
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=5, cooldown=10, clock=clock)
+    breaker.failure(retry_after=30)
+    clock.now += 20
+    assert not breaker.allow()
+    clock.now += 10
+    assert breaker.allow()
+
+
+def create_status_site() -> web.Application:
+    """
+    Answers with the ?status= of the url
+    """
+
+    async def page(request):
+        status = int(request.query.get("status", 200))
+        return web.Response(
+            text=PAGE.format(path=request.path), content_type="text/html", status=status
+        )
+
+    app = web.Application()
+    app.router.add_get("/{tail:.*}", page)
+    return app
+
+
+def test_scraper_fails_fast_on_open_circuit(tmp_path):
+    settings = HostSettings(rate=1000, failure_threshold=2, cooldown=60)
+
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        hosts = HostScheduler(settings, session_factory)
+        async with TestServer(create_status_site()) as server:
+            async with Scraper(ScraperSettings(), hosts=hosts) as scraper:
+                ok = await scrape_og_metadata(str(server.make_url("/a")), scraper)
+                assert ok.title == "Title /a"
+                for _ in range(2):
+                    with pytest.raises(aiohttp.ClientResponseError):
+                        await fetch_og_metadata(
+                            str(server.make_url("/b?status=503")), scraper
+                        )
+                # Even the urls that work are skipped now
+                with pytest.raises(HostUnavailable):
+                    await fetch_og_metadata(str(server.make_url("/a")), scraper)
+                assert (
+                    await scrape_og_metadata(str(server.make_url("/a")), scraper)
+                    is None
+                )
+        # Saved when the scraper is closed
+        async with session_factory() as session:
+            return (await session.scalars(select(HostStatus))).all()
+
+    (status,) = asyncio.run(run())
+    assert status.state == "open"
+    assert (status.requests, status.failures, status.rejected) == (3, 2, 2)
+    assert status.open_until is not None
+    assert "503" in status.last_error
+
+
+def test_scraper_host_concurrency():
+    settings = HostSettings(rate=1000, max_concurrency=2)
+    running, most = 0, 0
+
+    async def page(request):
+        nonlocal running, most
+        running += 1
+        most = max(most, running)
+        await asyncio.sleep(0.05)
+        running -= 1
+        return web.Response(text=PAGE.format(path="/"), content_type="text/html")
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/{tail:.*}", page)
+        async with TestServer(app) as server:
+            async with Scraper(
+                ScraperSettings(), hosts=HostScheduler(settings)
+            ) as scraper:
+                await asyncio.gather(
+                    *(
+                        scrape_og_metadata(str(server.make_url(f"/{idx}")), scraper)
+                        for idx in range(6)
+                    )
+                )
+
+    asyncio.run(run())
+    assert most == 2
+
+
+def test_idle_hosts_are_forgotten():
+    clock = Clock()
+    settings = HostSettings(rate=1000, failure_threshold=1, idle_after=60)
+    hosts = HostScheduler(settings, clock=clock)
+
+    async def run():
+        async with hosts.slot("https://a.com/1"):
+            pass
+        with pytest.raises(aiohttp.ServerDisconnectedError):
+            async with hosts.slot("https://b.com/1"):
+                raise aiohttp.ServerDisconnectedError()
+        clock.now += 30
+        await hosts.save()
+        kept = sorted(hosts.hosts)
+        clock.now += 60
+        await hosts.save()
+        return kept, sorted(hosts.hosts)
+
+    # The open circuit of b.com is kept
+    assert asyncio.run(run()) == (["a.com", "b.com"], ["b.com"])
@@ -0,0 +1,162 @@
+import asyncio
+import io
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+
+import pytest
+from aiohttp.test_utils import TestServer
+from helpers import create_session_factory, create_site
+from sqlalchemy import func, select
+
+from rejubot.admin import canonical_report
+from rejubot.importer import import_export, iter_export_links, iter_json_array
+from rejubot.scraper import Scraper
+from rejubot.settings import ScraperSettings
+from rejubot.storage import MetadataStatus, ScrapeJob, UrlEntry
+
+START = int(datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp())
+
+
+def export_message(idx: int, urls: list[str]) -> dict:
+    return {
+        "id": idx,
+        "type": "message",
+        "date": "2024-01-01T01:00:00",
+        "date_unixtime": str(START + idx * 60),
+        "from": "Test",
+        "from_id": "user42",
+        "text": ["look ", *({"type": "link", "text": url} for url in urls)],
+        "text_entities": [
+            {"type": "plain", "text": "look "},
+            *({"type": "link", "text": url} for url in urls),
+        ],
+    }
+
+
+def write_export(path: Path, messages: list[dict]) -> Path:
+    path.write_text(
+        json.dumps(dict(name="test", type="public_channel", messages=messages))
+    )
+    return path
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_iter_json_array(chunk_size):
+    messages = [export_message(idx, [f"https://a.com/{idx}"]) for idx in range(5)]
+    full = json.dumps(dict(name="test", id=1, messages=messages), indent=1)
+    filtered = json.dumps(messages)
+    for text, expected in ((full, messages), (filtered, messages), (" [ ]", [])):
+        assert list(iter_json_array(io.StringIO(text), chunk_size)) == expected
+
+
+def test_iter_json_array_truncated():
+    text = json.dumps([export_message(1, ["https://a.com"])] * 2)
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO(text[:-10]), 16))
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.StringIO('{"name": "test"}'), 16))
+
+
+def run_import(tmp_path: Path, export: Path, scrape: bool, **kwargs):
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        async with TestServer(create_site()) as server:
+            export.write_text(
+                export.read_text().replace("http://site", str(server.make_url("")))
+            )
+            if scrape:
+                async with Scraper(ScraperSettings()) as scraper:
+                    await import_export(
+                        export, 1, "test", session_factory, scraper, **kwargs
+                    )
+            else:
+                await import_export(export, 1, "test", session_factory, None, **kwargs)
+        async with session_factory() as session:
+            entries = (
+                await session.scalars(select(UrlEntry).order_by(UrlEntry.id))
+            ).all()
+            jobs = await session.scalar(select(func.count(ScrapeJob.id)))
+        return entries, jobs
+
+    return asyncio.run(run())
+
+
+def test_import_scrapes_in_file_order(tmp_path):
+    export = write_export(
+        tmp_path / "result.json",
+        [
+            export_message(1, ["http://site/a", "http://site/b"]),
+            {"id": 2, "type": "service", "date_unixtime": str(START)},
+            export_message(3, ["http://site/a?utm_source=x"]),
+            export_message(4, ["http://site/c"]),
+        ],
+    )
+    entries, jobs = run_import(tmp_path, export, True, batch_size=1)
+    assert [entry.og_title for entry in entries] == ["Title /a", "Title /b", "Title /c"]
+    assert [entry.message_id for entry in entries] == [1, 1, 4]
+    assert entries[0].who_id == 42
+    assert entries[2].created_at == datetime(2024, 1, 1, 0, 4)
+    assert jobs == 0
+    # Finished imports don't leave a checkpoint behind
+    assert not (tmp_path / "result.json.checkpoint").exists()
+
+
+def test_import_without_scraping_queues_jobs(tmp_path):
+    export = write_export(
+        tmp_path / "result.json",
+        [export_message(idx, [f"http://site/{idx}"]) for idx in range(3)],
+    )
+    entries, jobs = run_import(tmp_path, export, False)
+    assert [entry.og_title for entry in entries] == [None, None, None]
+    assert {entry.metadata_status for entry in entries} == {MetadataStatus.PENDING}
+    assert jobs == 3
+
+
+def test_import_resumes_from_checkpoint(tmp_path):
+    export = write_export(
+        tmp_path / "result.json",
+        [export_message(idx, [f"http://site/{idx}"]) for idx in range(5)],
+    )
+    checkpoint = tmp_path / "import.checkpoint"
+    checkpoint.write_text(json.dumps(dict(position=3, entries=3)))
+    entries, _ = run_import(tmp_path, export, False, checkpoint=checkpoint)
+    assert [entry.message_id for entry in entries] == [3, 4]
+    assert not checkpoint.exists()
+
+
+def test_import_refuses_newest_first(tmp_path):
+    export = write_export(
+        tmp_path / "result.json",
+        [export_message(idx, [f"http://site/{idx}"]) for idx in reversed(range(5))],
+    )
+    with pytest.raises(ValueError, match="oldest first"):
+        run_import(tmp_path, export, False)
+
+
+def test_import_allows_close_dates_out_of_order(tmp_path):
+    messages = [export_message(idx, [f"http://site/{idx}"]) for idx in range(3)]
+    messages[1]["date_unixtime"] = str(START - 30)
+    export = write_export(tmp_path / "result.json", messages)
+    entries, _ = run_import(tmp_path, export, False)
+    assert len(entries) == 3
+
+
+def test_iter_export_links(tmp_path):
+    messages = [export_message(idx, [f"http://site/{idx}"]) for idx in range(3)]
+    links = list(iter_export_links(write_export(tmp_path / "result.json", messages)))
+    assert [url for _, url in links] == [f"http://site/{idx}" for idx in range(3)]
+    reversed_export = write_export(tmp_path / "reversed.json", messages[::-1])
+    with pytest.raises(ValueError, match="oldest first"):
+        list(iter_export_links(reversed_export))
+
+
+def test_canonical_report_of_full_export(tmp_path, capsys):
+    urls = ["https://a.com/?utm_source=x", "https://a.com/"]
+    messages = [export_message(idx, [url]) for idx, url in enumerate(urls)]
+    canonical_report(str(write_export(tmp_path / "result.json", messages)))
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "2 links"
+    # raw: 2 distinct, 2 fetches. canonical: 1 distinct, 1 fetch, 1 duplicate
+    assert lines[-2].split() == ["raw", "2", "2", "0", "0", "0.0%"]
+    assert lines[-1].split() == ["canonical", "1", "1", "1", "0", "50.0%"]
@@ -0,0 +1,164 @@
+import asyncio
+
+import aiohttp
+import pytest
+from aiohttp.test_utils import TestServer
+from fastapi.testclient import TestClient
+from helpers import create_message, create_session_factory, create_site
+from sqlalchemy import select, text
+from sqlalchemy.exc import OperationalError
+
+from rejubot.metrics import (
+    DB_QUERIES,
+    REGISTRY,
+    SCRAPES,
+    URLS,
+    Counter,
+    Histogram,
+    MetricsServer,
+    Registry,
+    instrument_engine,
+    statement_kind,
+)
+from rejubot.scraper import Scraper, scrape_og_metadata
+from rejubot.settings import ScraperSettings
+from rejubot.storage import UrlEntry
+from rejubot.telegrambot import filter_new_urls
+from rejubot.web import app
+
+
+def test_render_counter_and_histogram():
+    registry = Registry()
+    counter = registry.register(Counter("test_events", "Events", ["kind"]))
+    histogram = registry.register(
+        Histogram("test_seconds", 'Some "seconds"', buckets=(0.1, 1))
+    )
+    counter.inc("a")
+    counter.inc("a", amount=2)
+    counter.inc('quo"te')
+    for value in (0.05, 0.1, 0.5, 7):
+        histogram.observe(value)
+
+    assert registry.render().splitlines() == [
+        "# HELP test_events_total Events",
+        "# TYPE test_events_total counter",
+        'test_events_total{kind="a"} 3',
+        'test_events_total{kind="quo\\"te"} 1',
+        '# HELP test_seconds Some \\"seconds\\"',
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{le="0.1"} 2',
+        'test_seconds_bucket{le="1"} 3',
+        'test_seconds_bucket{le="+Inf"} 4',
+        "test_seconds_sum 7.65",
+        "test_seconds_count 4",
+    ]
+
+
+def test_samples_are_named_like_their_type():
+    REGISTRY.metrics["rejubot_updates"].inc("message")
+    REGISTRY.metrics["rejubot_scrape_seconds"].observe(0.1, "ok", "a.com")
+    declared = None
+    for line in REGISTRY.render().splitlines():
+        if line.startswith("# TYPE "):
+            _, _, declared, kind = line.split()
+        elif not line.startswith("#"):
+            name = line.split("{")[0].split()[0]
+            suffixes = ("_bucket", "_sum", "_count") if kind == "histogram" else ()
+            assert name == declared or name in (
+                declared + suffix for suffix in suffixes
+            )
+
+
+def test_series_are_capped():
+    counter = Counter("test_hosts", "Hosts", ["host"], max_series=2)
+    for host in ("a", "b", "c", "d", "a"):
+        counter.inc(host)
+    assert (counter.value("a"), counter.value("b"), counter.value("other")) == (
+        2,
+        1,
+        2,
+    )
+
+
+def test_statement_kind():
+    assert statement_kind("SELECT 1") == "select"
+    assert statement_kind("\n  insert into x") == "insert"
+    assert statement_kind("WITH t AS (SELECT 1) SELECT * FROM t") == "with"
+    assert statement_kind("PRAGMA foreign_keys") == "other"
+
+
+def test_instrument_engine(tmp_path):
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        instrument_engine(session_factory.kw["bind"])
+        async with session_factory() as session:
+            await session.scalars(select(UrlEntry))
+            with pytest.raises(OperationalError, match="no such table"):
+                await session.execute(text("SELECT * FROM missing"))
+            await session.execute(text("SELECT 1"))
+
+    before = DB_QUERIES.count("select")
+    asyncio.run(run())
+    # The failed statement isn't counted
+    assert DB_QUERIES.count("select") == before + 2
+
+
+def test_scrape_outcomes():
+    async def run():
+        async with TestServer(create_site()) as server:
+            async with Scraper(ScraperSettings(timeout=0.5)) as scraper:
+                await scrape_og_metadata(str(server.make_url("/a")), scraper)
+                await scrape_og_metadata(str(server.make_url("/b?delay=2")), scraper)
+
+    before = SCRAPES.count("scraped", "127.0.0.1"), SCRAPES.count("error", "127.0.0.1")
+    asyncio.run(run())
+    after = SCRAPES.count("scraped", "127.0.0.1"), SCRAPES.count("error", "127.0.0.1")
+    assert (after[0] - before[0], after[1] - before[1]) == (1, 1)
+
+
+def test_filter_urls_counts_outcomes(tmp_path):
+    urls = [
+        "https://example.com/a",
+        "https://example.com/a?utm_source=x",
+        "https://rejugan.do/b",
+        "https://example.com/c",
+    ]
+
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        async with session_factory() as session:
+            await filter_new_urls(create_message("links"), urls, session)
+
+    outcomes = ("new", "repeated", "skipped")
+    before = [URLS.value(outcome) for outcome in outcomes]
+    asyncio.run(run())
+    after = [URLS.value(outcome) for outcome in outcomes]
+    assert [a - b for a, b in zip(after, before)] == [2, 1, 1]
+
+
+def test_web_metrics():
+    REGISTRY.metrics["rejubot_updates"].inc("message")
+    response = TestClient(app).get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'rejubot_updates_total{kind="message"}' in response.text
+    assert "# TYPE rejubot_scrape_seconds histogram" in response.text
+
+
+def test_metrics_server():
+    async def run():
+        server = MetricsServer("127.0.0.1", 0)
+        await server.start()
+        try:
+            (port,) = [
+                site._server.sockets[0].getsockname()[1] for site in server.runner.sites
+            ]
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                    return response.status, await response.text()
+        finally:
+            await server.stop()
+
+    status, body = asyncio.run(run())
+    assert status == 200
+    assert "# TYPE rejubot_urls_total counter" in body
@@ -0,0 +1,76 @@
+from pathlib import Path
+
+import pytest
+from bs4 import BeautifulSoup
+
+from rejubot.opengraph import UrlMetadata, parse_og_metadata
+
+HTML_FIXTURES = Path(__file__).parent / "fixtures" / "html"
+URLS = ["https://example.com/page", "https://vxtwitter.com/someone/status/1"]
+
+
+def reference_og_metadata(html: str, url: str) -> UrlMetadata | None:
+    """
+    The BeautifulSoup implementation parse_og_metadata replaced
+    """
+    soup = BeautifulSoup(html, "html.parser")
+
+    def gets(property):
+        meta = soup.find("meta", property=property)
+        return meta.get("content") if meta else None
+
+    def gets_name(name):
+        meta = soup.find("meta", attrs=dict(name=name))
+        return meta.get("content") if meta else None
+
+    if url.startswith("https://vxtwitter.com"):
+        og_site = "Twitter / X"
+        og_title = gets_name("twitter:title")
+        og_image = gets_name("twitter:image")
+    else:
+        og_site = gets("og:site_name")
+        og_title = gets("og:title")
+        og_image = gets("og:image")
+    if og_image == "0" or og_image == "null":
+        og_image = None
+    video_url = gets("og:video")
+    video_type = gets("og:video:type")
+    if not video_type:
+        video_url = None
+    og_description = gets("og:description")
+    if og_title is None and og_description is None:
+        return None
+    return UrlMetadata(
+        site=og_site,
+        title=og_title,
+        description=og_description,
+        image=og_image,
+        video_url=video_url,
+        video_type=video_type,
+        video_width=gets("og:video:width"),
+        video_height=gets("og:video:height"),
+    )
+
+
+@pytest.mark.parametrize("url", URLS)
+@pytest.mark.parametrize(
+    "fixture", sorted(HTML_FIXTURES.glob("*.html")), ids=lambda path: path.stem
+)
+def test_parity_with_beautifulsoup(fixture: Path, url: str):
+    html = fixture.read_text()
+    assert parse_og_metadata(html, url) == reference_og_metadata(html, url)
+
+
+def test_parse_og_metadata_video():
+    html = (HTML_FIXTURES / "video.html").read_text()
+    metadata = parse_og_metadata(html, URLS[0])
+    assert metadata.video_url == "https://video.example/clip.mp4"
+    assert metadata.video_type == "video/mp4"
+    assert metadata.image is None
+
+
+def test_parse_og_metadata_unescapes():
+    html = (HTML_FIXTURES / "malformed.html").read_text()
+    metadata = parse_og_metadata(html, URLS[0])
+    assert metadata.title == "Unquoted"
+    assert metadata.site == "Broken & site"
@@ -0,0 +1,159 @@
+import asyncio
+import json
+from dataclasses import replace
+from pathlib import Path
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from helpers import PAGE
+
+from rejubot.canonical import fetch_url
+from rejubot.opengraph import parse_og_metadata
+from rejubot.providers import (
+    PROVIDERS,
+    YOUTUBE,
+    parse_oembed,
+    parse_vxtwitter,
+    provider_endpoint,
+)
+from rejubot.scraper import Scraper, fetch_og_metadata
+from rejubot.settings import ScraperSettings
+
+FIXTURES = Path(__file__).parent / "fixtures" / "providers"
+
+
+def fixture(name: str) -> dict:
+    return json.loads((FIXTURES / name).read_text())
+
+
+@pytest.mark.parametrize(
+    "url,endpoint",
+    [
+        (
+            "https://youtu.be/dQw4w9WgXcQ?si=x",
+            "https://www.youtube.com/oembed?format=json&url=https%3A%2F%2Fwww.youtube.com"
+            "%2Fwatch%3Fv%3DdQw4w9WgXcQ",
+        ),
+        (
+            "https://x.com/someone/status/1?s=20",
+            "https://api.vxtwitter.com/someone/status/1",
+        ),
+        (
+            "https://www.tiktok.com/@somecat/video/1",
+            "https://www.tiktok.com/oembed?format=json&url=https%3A%2F%2Fwww.tiktok.com"
+            "%2F%40somecat%2Fvideo%2F1",
+        ),
+        ("https://www.youtube.com/@RickAstleyYT", None),
+        ("https://x.com/someone", None),
+        ("https://example.com/watch", None),
+    ],
+)
+def test_provider_endpoint(url, endpoint):
+    found = provider_endpoint(fetch_url(url), PROVIDERS)
+    assert (found[1] if found else None) == endpoint
+
+
+def test_parse_oembed():
+    metadata = parse_oembed(fixture("youtube_oembed.json"), "")
+    assert metadata.site == "YouTube"
+    assert metadata.title == "Never Gonna Give You Up"
+    assert metadata.description == "Rick Astley"
+    assert metadata.image == "https://i.ytimg.com/vi/dQw4w9WgXcQ/hqdefault.jpg"
+    assert metadata.video_url is None
+
+    metadata = parse_oembed(fixture("tiktok_oembed.json"), "")
+    assert (metadata.site, metadata.description) == ("TikTok", "Some Cat")
+    assert parse_oembed({"type": "video"}, "") is None
+
+
+def test_parse_vxtwitter():
+    metadata = parse_vxtwitter(fixture("vxtwitter_video.json"), "")
+    assert metadata.site == "Twitter / X"
+    assert metadata.title == "Some One (@someone)"
+    assert metadata.description == "Look at this https://t.co/abc"
+    assert metadata.image.endswith("/thumb.jpg")
+    assert metadata.video_url.endswith("/clip.mp4")
+    assert (metadata.video_type, metadata.video_width, metadata.video_height) == (
+        "video/mp4",
+        1280,
+        720,
+    )
+
+    metadata = parse_vxtwitter(fixture("vxtwitter_text.json"), "")
+    assert (metadata.image, metadata.video_url) == (None, None)
+
+
+def test_parse_og_metadata_relative_video():
+    html = (FIXTURES / "ddinstagram.html").read_text()
+    metadata = parse_og_metadata(html, "https://www.ddinstagram.com/reel/C4abc/")
+    assert metadata.video_url == "https://www.ddinstagram.com/videos/C4abc/1"
+    assert metadata.image == "https://www.ddinstagram.com/images/C4abc/1"
+
+
+def run_provider_scrape(path: str, oembed_status: int = 200, chunks: int = 1):
+    requests = []
+
+    async def oembed(request):
+        requests.append(request.path)
+        if oembed_status != 200:
+            return web.Response(status=oembed_status)
+        if chunks == 1:
+            return web.json_response(fixture("youtube_oembed.json"))
+        # A slow API, the body arrives in several pieces
+        body = json.dumps(fixture("youtube_oembed.json")).encode()
+        response = web.StreamResponse(headers={"Content-Type": "application/json"})
+        await response.prepare(request)
+        size = len(body) // chunks + 1
+        for start in range(0, len(body), size):
+            await response.write(body[start : start + size])
+            await asyncio.sleep(0.02)
+        await response.write_eof()
+        return response
+
+    async def page(request):
+        requests.append(request.path)
+        return web.Response(
+            text=PAGE.format(path=request.path), content_type="text/html"
+        )
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/oembed", oembed)
+        app.router.add_get("/{tail:.*}", page)
+        async with TestServer(app) as server:
+            # The youtube provider, asking the local server
+            local = replace(
+                YOUTUBE,
+                endpoint=lambda parts: (
+                    str(server.make_url("/oembed")) if parts.path == "/watch" else None
+                ),
+            )
+            providers = {"127.0.0.1": local}
+            async with Scraper(ScraperSettings(), providers=providers) as scraper:
+                return await fetch_og_metadata(str(server.make_url(path)), scraper)
+
+    return asyncio.run(run()), requests
+
+
+def test_scrape_from_provider():
+    metadata, requests = run_provider_scrape("/watch?v=1")
+    assert metadata.title == "Never Gonna Give You Up"
+    # The page isn't downloaded
+    assert requests == ["/oembed"]
+
+
+def test_scrape_from_provider_in_chunks():
+    metadata, requests = run_provider_scrape("/watch?v=1", chunks=4)
+    assert metadata.title == "Never Gonna Give You Up"
+    assert requests == ["/oembed"]
+
+
+def test_scrape_falls_back_to_html():
+    metadata, requests = run_provider_scrape("/watch?v=1", oembed_status=404)
+    assert metadata.title == "Title /watch"
+    assert requests == ["/oembed", "/watch"]
+
+    metadata, requests = run_provider_scrape("/channel")
+    assert metadata.title == "Title /channel"
+    assert requests == ["/channel"]
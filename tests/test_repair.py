@@ -0,0 +1,88 @@
+import asyncio
+from datetime import datetime, timezone
+from pathlib import Path
+
+from aiohttp.test_utils import TestServer
+from helpers import create_session_factory, create_site
+from sqlalchemy import select
+
+from rejubot.repair import repair_entries, repair_query
+from rejubot.scraper import Scraper
+from rejubot.settings import ScraperSettings
+from rejubot.storage import UrlEntry
+
+NOW = datetime(2024, 6, 1, tzinfo=timezone.utc)
+
+
+def run_repair(
+    tmp_path: Path, titles: list[str | None], query_args: dict | None = None, **kwargs
+):
+    """
+    One entry per title, a day older each, for /0, /1... of the test site
+    """
+
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        async with TestServer(create_site()) as server:
+            async with session_factory() as session:
+                session.add_all(
+                    UrlEntry(
+                        channel_id=1,
+                        message_id=idx,
+                        who="Test",
+                        who_id=1,
+                        message="",
+                        url=str(server.make_url(f"/{idx}")),
+                        og_title=title,
+                        created_at=datetime(2024, 5, 31 - idx, 12),
+                    )
+                    for idx, title in enumerate(titles)
+                )
+                await session.commit()
+            query = repair_query(**(query_args or {}), now=NOW)
+            async with Scraper(ScraperSettings()) as scraper:
+                stats = await repair_entries(
+                    session_factory, scraper, query, batch_size=2, **kwargs
+                )
+        async with session_factory() as session:
+            entries = (
+                await session.scalars(select(UrlEntry).order_by(UrlEntry.id))
+            ).all()
+        return stats, [entry.og_title for entry in entries]
+
+    return asyncio.run(run())
+
+
+def test_repair_all(tmp_path):
+    stats, titles = run_repair(tmp_path, [None, "Title /1", "Old", None, "Old"])
+    assert titles == ["Title /0", "Title /1", "Title /2", "Title /3", "Title /4"]
+    assert (stats.checked, stats.changed, stats.failed) == (5, 4, 0)
+    assert stats.last_id == 1
+
+
+def test_repair_missing_title(tmp_path):
+    stats, titles = run_repair(
+        tmp_path, [None, "Old", ""], query_args=dict(missing_title=True)
+    )
+    assert titles == ["Title /0", "Old", "Title /2"]
+    assert stats.checked == 2
+
+
+def test_repair_older_than_days(tmp_path):
+    _, titles = run_repair(
+        tmp_path, ["Old", "Old", "Old"], query_args=dict(older_than_days=1)
+    )
+    assert titles == ["Old", "Title /1", "Title /2"]
+
+
+def test_repair_resume_from(tmp_path):
+    # Ids are 1 based, newest first
+    stats, titles = run_repair(tmp_path, ["Old"] * 4, resume_from=3)
+    assert titles == ["Title /0", "Title /1", "Old", "Old"]
+    assert stats.checked == 2
+
+
+def test_repair_dry_run(tmp_path):
+    stats, titles = run_repair(tmp_path, ["Old", None], dry_run=True)
+    assert titles == ["Old", None]
+    assert stats.changed == 2
@@ -0,0 +1,89 @@
+import asyncio
+import json
+
+import pytest
+
+from rejubot.replay import link_message, recorded_messages, replay, stand_in_url
+from rejubot.settings import EnrichmentSettings, Settings, WriteBufferSettings
+from rejubot.telegrambot import get_telegram_urls
+
+
+def replay_settings(workers: int, buffer: bool = False) -> Settings:
+    return Settings(
+        telegram_token="0:replay",
+        db_url="sqlite+aiosqlite://",
+        telegram_channels={"replay": -100},
+        error_chat_id=1,
+        enrichment=EnrichmentSettings(workers=workers, poll_interval=0.1),
+        # Flushed by the end of the replay, not by the delay
+        write_buffer=WriteBufferSettings(enabled=buffer, max_delay=60),
+    )
+
+
+def test_stand_in_url():
+    assert (
+        stand_in_url("https://www.youtube.com/watch?v=1#t=1", 8080)
+        == "http://www.youtube.com.replay.test:8080/watch?v=1"
+    )
+
+
+def test_link_message_entities():
+    pieces = [
+        ("😀 ñandú ", False),
+        ("http://a.replay.test:1/x", True),
+        (" and ", False),
+        ("http://b.replay.test:1/y", True),
+    ]
+    message = link_message(pieces, 1, -100)
+    assert get_telegram_urls(message) == {
+        "http://a.replay.test:1/x",
+        "http://b.replay.test:1/y",
+    }
+
+
+def test_recorded_messages(tmp_path):
+    export = tmp_path / "result.json"
+    export.write_text(
+        json.dumps(
+            dict(
+                messages=[
+                    dict(
+                        id=1,
+                        type="message",
+                        date_unixtime="1704067200",
+                        text_entities=[
+                            dict(type="plain", text="look "),
+                            dict(type="link", text="https://example.com/a?b=1"),
+                        ],
+                    ),
+                    dict(id=2, type="message", text_entities=[]),
+                ]
+            )
+        )
+    )
+    assert list(recorded_messages(export, 1)) == [
+        [("look ", False), ("http://example.com.replay.test:1/a?b=1", True)]
+    ]
+
+
+@pytest.mark.parametrize("workers,buffer", [(0, False), (2, False), (2, True)])
+def test_replay(workers, buffer):
+    stats = asyncio.run(
+        replay(
+            replay_settings(workers, buffer),
+            count=20,
+            rate=0,
+            links=2,
+            hosts=5,
+            repeated=0.2,
+            delay=0,
+        )
+    )
+    assert stats.messages == 20
+    assert stats.errors == 0
+    assert len(stats.latencies) == len(stats.handling) == 20
+    # Repeated urls aren't stored again
+    assert 0 < stats.entries < 40
+    assert stats.unscraped == 0
+    assert stats.db_bytes > 0
+    assert ("messages", "20") in stats.summary()
@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from rejubot.scraper import Scraper, UrlMetadata, read_html_head, scrape_og_metadata
+from rejubot.settings import ScraperSettings
+
+PAGE = """<html><head>
+<meta property="og:site_name" content="Site">
+<meta property="og:title" content="Title">
+<meta property="og:description" content="Description">
+<meta property="og:image" content="http://example.com/image.png">
+</head><body></body></html>"""
+
+
+BIG_BODY = "<body>" + "<p>Lorem ipsum</p>" * 200_000 + "</body></html>"
+
+
+def create_app() -> web.Application:
+    async def page(request):
+        return web.Response(text=PAGE, content_type="text/html")
+
+    async def big_page(request):
+        return web.Response(
+            text=PAGE.split("<body>")[0] + BIG_BODY, content_type="text/html"
+        )
+
+    async def no_head(request):
+        # Nothing marks the end of the head
+        text = "<html>" + "<p>Lorem ipsum</p>" * 200_000
+        return web.Response(text=text, content_type="text/html")
+
+    async def image(request):
+        return web.Response(body=b"\x89PNG" * 1_000_000, content_type="image/png")
+
+    async def moved(request):
+        raise web.HTTPFound("/posts/relative")
+
+    async def relative(request):
+        text = PAGE.replace("http://example.com/image.png", "image.png")
+        return web.Response(text=text, content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get("/page", page)
+    app.router.add_get("/big", big_page)
+    app.router.add_get("/no-head", no_head)
+    app.router.add_get("/image.png", image)
+    app.router.add_get("/moved", moved)
+    app.router.add_get("/posts/relative", relative)
+    return app
+
+
+def scrape_all(paths: list[str]) -> list[UrlMetadata | None]:
+    async def run():
+        async with TestServer(create_app()) as server:
+            async with Scraper(ScraperSettings()) as scraper:
+                return [
+                    await scrape_og_metadata(str(server.make_url(path)), scraper)
+                    for path in paths
+                ]
+
+    return asyncio.run(run())
+
+
+def test_scrape_og_metadata_html():
+    [metadata] = scrape_all(["/page"])
+    assert metadata.site == "Site"
+    assert metadata.title == "Title"
+    assert metadata.description == "Description"
+    assert metadata.image == "http://example.com/image.png"
+    assert metadata.video_url is None
+
+
+def test_scrape_og_metadata_image():
+    [metadata] = scrape_all(["/image.png"])
+    assert metadata.image.endswith("/image.png")
+    assert metadata.title is None
+
+
+def test_scrape_og_metadata_relative_after_redirect():
+    [metadata] = scrape_all(["/moved"])
+    # Relative to the page it redirected to, not the url of the message
+    assert metadata.image.endswith("/posts/image.png")
+
+
+def read_head(path: str, **settings) -> str:
+    async def run():
+        async with TestServer(create_app()) as server:
+            async with Scraper(ScraperSettings(**settings)) as scraper:
+                async with scraper.session.get(server.make_url(path)) as response:
+                    return await read_html_head(response, scraper.settings)
+
+    return asyncio.run(run())
+
+
+def test_read_html_head_stops_after_head():
+    html = read_head("/big", chunk_size=1024)
+    assert "og:title" in html
+    assert len(html) < 2048
+
+
+def test_read_html_head_max_bytes():
+    html = read_head("/no-head", max_html_bytes=10_000, chunk_size=1024)
+    assert len(html) == 10_000
+
+
+def test_scrape_og_metadata_big_page():
+    [metadata] = scrape_all(["/big"])
+    assert metadata.title == "Title"
+
+
+def test_scrape_og_metadata_error():
+    async def run():
+        async with Scraper(ScraperSettings(timeout=1)) as scraper:
+            return await scrape_og_metadata("http://127.0.0.1:1/nothing", scraper)
+
+    assert asyncio.run(run()) is None
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_scrape_og_metadata_parse_pool(executor):
+    async def run():
+        settings = ScraperSettings(parse_workers=1, parse_executor=executor)
+        async with TestServer(create_app()) as server, Scraper(settings) as scraper:
+            return await scrape_og_metadata(str(server.make_url("/page")), scraper)
+
+    assert asyncio.run(run()).title == "Title"
@@ -11,3 +11,11 @@ def test_load_settings_ok():
     assert settings.db_url == "b"
     assert settings.telegram_channels == {"rejugando": 1, "development": 2}
     assert settings.telegram_channels_by_id == {1: "rejugando", 2: "development"}
+
+
+def test_load_settings_scraper():
+    settings = load_settings(FIXTURES_BASE / "test_settings.toml")
+    assert settings.scraper.timeout == 5
+    assert settings.scraper.pool_size_per_host == 2
+    # Defaults for what is not in the file
+    assert settings.scraper.connect_timeout == 10
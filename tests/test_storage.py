@@ -0,0 +1,101 @@
+import asyncio
+
+import pytest
+from helpers import create_message, create_session_factory
+from sqlalchemy import select, text
+from sqlalchemy.exc import OperationalError, TimeoutError
+
+from rejubot.settings import DatabaseSettings
+from rejubot.enrichment import enqueue
+from rejubot.storage import (
+    Base,
+    MessageUrl,
+    ScrapeJob,
+    UrlEntry,
+    checkpoint_wal,
+    create_engine,
+    delete_entries,
+    url_hash,
+)
+from rejubot.telegrambot import create_entry
+
+
+def test_create_engine_pragmas(tmp_path):
+    url = f"sqlite+aiosqlite:///{tmp_path / 'rejubot.db'}"
+    settings = DatabaseSettings(busy_timeout=1234)
+
+    async def run():
+        writer = create_engine(url, settings, writer=True)
+        reader = create_engine(url, settings, read_only=True)
+        async with writer.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            pragmas = [
+                (await conn.exec_driver_sql(f"PRAGMA {name}")).scalar()
+                for name in ("journal_mode", "busy_timeout", "synchronous")
+            ]
+        async with reader.connect() as conn:
+            assert (
+                await conn.exec_driver_sql("SELECT count(*) FROM url_entries")
+            ).scalar() == 0
+            with pytest.raises(OperationalError, match="readonly"):
+                await conn.execute(text("DELETE FROM url_entries"))
+        busy, _, _ = await checkpoint_wal(writer, "truncate")
+        assert busy == 0
+        await writer.dispose()
+        await reader.dispose()
+        return pragmas
+
+    # synchronous NORMAL is 1
+    assert asyncio.run(run()) == ["wal", 1234, 1]
+
+
+def test_writer_is_a_single_connection(tmp_path):
+    url = f"sqlite+aiosqlite:///{tmp_path / 'rejubot.db'}"
+    settings = DatabaseSettings(writer_timeout=0.2)
+
+    async def run():
+        writer = create_engine(url, settings, writer=True)
+        async with writer.connect():
+            with pytest.raises(TimeoutError):
+                async with writer.connect():
+                    pass
+        await writer.dispose()
+
+    asyncio.run(run())
+
+
+def test_delete_entries_with_jobs_and_ledger(tmp_path):
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        async with session_factory() as session:
+            entries = [
+                create_entry(
+                    create_message("", idx, chat_id), f"https://a.com/{idx}", None
+                )
+                for idx, chat_id in [(1, 1), (2, 1), (3, 2)]
+            ]
+            session.add_all(entries)
+            enqueue(session, entries)
+            session.add_all(
+                MessageUrl(
+                    channel_id=entry.channel_id,
+                    message_id=entry.message_id,
+                    url_hash=url_hash(entry.url),
+                )
+                for entry in entries
+            )
+            await session.commit()
+
+            deleted = await delete_entries(session, UrlEntry.channel_id == 1)
+            await session.commit()
+            jobs = (await session.scalars(select(ScrapeJob.url_entry_id))).all()
+            ledger = (await session.scalars(select(MessageUrl.message_id))).all()
+            return deleted, jobs, ledger, entries[2].id
+
+    deleted, jobs, ledger, kept_id = asyncio.run(run())
+    assert sorted(deleted) == sorted(
+        [(1, url_hash("https://a.com/1")), (1, url_hash("https://a.com/2"))]
+    )
+    # No orphan job left for a new entry reusing the ids
+    assert jobs == [kept_id]
+    assert ledger == [3]
@@ -0,0 +1,212 @@
+import asyncio
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from aiohttp.test_utils import TestServer
+from helpers import create_message, create_session_factory, create_site
+from sqlalchemy import select, update
+from telegram import Update
+
+from rejubot.admin import rehash_entries
+from rejubot.dedup import RecentUrls
+from rejubot.enrichment import EnrichmentWorkers
+from rejubot.replay import link_message
+from rejubot.scraper import Scraper
+from rejubot.settings import EditSettings, EnrichmentSettings, ScraperSettings
+from rejubot.storage import MessageUrl, UrlEntry, url_hash
+from rejubot.telegrambot import handle_message, process_urls
+
+
+def run_process_urls(
+    tmp_path: Path, paths_by_message: list[list[str]], timeout: float = 5
+):
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        settings = ScraperSettings(timeout=timeout)
+        async with TestServer(create_site()) as server, Scraper(settings) as scraper:
+            for idx, paths in enumerate(paths_by_message):
+                urls = [str(server.make_url(path)) for path in paths]
+                async with session_factory() as session:
+                    message = create_message(" ".join(urls), idx)
+                    await process_urls(message, urls, session, scraper)
+                    await session.commit()
+            async with session_factory() as session:
+                return (await session.scalars(select(UrlEntry))).all()
+
+    return asyncio.run(run())
+
+
+def test_process_urls_deduplicates(tmp_path):
+    entries = run_process_urls(tmp_path, [["/a", "/b", "/a"], ["/b"]])
+    assert sorted(entry.og_title for entry in entries) == ["Title /a", "Title /b"]
+
+
+def test_process_urls_timeout_does_not_delay_others(tmp_path):
+    start = time.monotonic()
+    entries = run_process_urls(
+        tmp_path, [["/slow?delay=10", "/a?delay=0.5", "/b?delay=0.5"]], timeout=1
+    )
+    # All the urls are scraped at the same time
+    assert time.monotonic() - start < 2.5
+    titles = {entry.url.split("/")[-1]: entry.og_title for entry in entries}
+    assert titles == {
+        "slow?delay=10": None,
+        "a?delay=0.5": "Title /a",
+        "b?delay=0.5": "Title /b",
+    }
+
+
+def test_process_urls_deduplicates_canonical_urls(tmp_path):
+    entries = run_process_urls(
+        tmp_path, [["/a", "/a/?utm_source=telegram", "/a#top"], ["/a?fbclid=1"]]
+    )
+    # The first spelling is the one stored
+    assert [entry.url.split("/")[-1] for entry in entries] == ["a"]
+
+
+def run_edits(
+    tmp_path: Path,
+    versions: list[tuple[str, list[str]]],
+    edits=EditSettings(),
+    after_message=None,
+):
+    """
+    Handles the message and then its edits, each a text and its urls, with
+    the urls queued for the enrichment workers. after_message(context) runs
+    before the edits.
+    """
+
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        context = SimpleNamespace(
+            bot_data=dict(
+                async_session=session_factory,
+                enrichment=EnrichmentWorkers(
+                    EnrichmentSettings(), session_factory, scraper=None
+                ),
+                recent_urls=RecentUrls(),
+                buffer=None,
+                edits=edits,
+            )
+        )
+        for idx, (text, urls) in enumerate(versions):
+            pieces = [(text, False)]
+            for url in urls:
+                pieces += [(" ", False), (f"https://example.com/{url}", True)]
+            message = link_message(pieces, 1, -100)
+            if idx == 0:
+                await handle_message(Update(idx, message=message), context)
+                if after_message is not None:
+                    await after_message(context)
+            else:
+                await handle_message(Update(idx, edited_message=message), context)
+        async with session_factory() as session:
+            entries = (await session.scalars(select(UrlEntry))).all()
+            ledger = (await session.scalars(select(MessageUrl))).all()
+        return sorted(entries, key=lambda entry: entry.url), ledger
+
+    return asyncio.run(run())
+
+
+def test_edit_processes_only_added_urls(tmp_path):
+    entries, ledger = run_edits(
+        tmp_path, [("Look", ["a", "b"]), ("Look again", ["a", "b", "c"])]
+    )
+    assert [(entry.url, entry.id) for entry in entries] == [
+        ("https://example.com/a", entries[0].id),
+        ("https://example.com/b", entries[1].id),
+        ("https://example.com/c", 3),
+    ]
+    assert {entry.message_text for entry in entries} == {
+        "Look again https://example.com/a https://example.com/b https://example.com/c"
+    }
+    assert len(ledger) == 3
+
+
+def test_update_delivered_twice(tmp_path):
+    entries, ledger = run_edits(tmp_path, [("Look", ["a"]), ("Look", ["a"])])
+    assert len(entries) == len(ledger) == 1
+
+
+def test_edit_keeps_removed_urls(tmp_path):
+    entries, _ = run_edits(tmp_path, [("Look", ["a", "b"]), ("Only", ["a"])])
+    assert [entry.url for entry in entries] == [
+        "https://example.com/a",
+        "https://example.com/b",
+    ]
+    assert entries[1].message == "Only https://example.com/a"
+
+
+def test_edit_deletes_removed_urls(tmp_path):
+    versions = [("Look", ["a", "b"]), ("Only", ["a"]), ("No links", [])]
+    entries, ledger = run_edits(tmp_path, versions, EditSettings(delete_removed=True))
+    assert entries == ledger == []
+
+    # Added back, it's stored again
+    versions += [("Back", ["b"])]
+    (tmp_path / "again").mkdir()
+    entries, ledger = run_edits(
+        tmp_path / "again", versions, EditSettings(delete_removed=True)
+    )
+    assert [entry.url for entry in entries] == ["https://example.com/b"]
+    assert len(ledger) == 1
+
+
+def test_edit_after_rehash(tmp_path):
+    async def rehash(context):
+        session_factory = context.bot_data["async_session"]
+        # Hashed by other canonicalization rules
+        async with session_factory() as session:
+            for model in (UrlEntry, MessageUrl):
+                await session.execute(update(model).values(url_hash=model.url_hash + 1))
+            await session.commit()
+        assert await rehash_entries(session_factory) == 2
+        # Restarted, nothing recent in memory
+        context.bot_data["recent_urls"] = RecentUrls()
+
+    entries, ledger = run_edits(
+        tmp_path,
+        [("Look", ["a", "b"]), ("Only", ["a"])],
+        EditSettings(delete_removed=True),
+        after_message=rehash,
+    )
+    assert [entry.url for entry in entries] == ["https://example.com/a"]
+    assert [row.url_hash for row in ledger] == [url_hash("https://example.com/a")]
+
+
+def test_cancelled_message_releases_its_urls(tmp_path):
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        async with (
+            TestServer(create_site()) as server,
+            Scraper(ScraperSettings()) as scraper,
+        ):
+            context = SimpleNamespace(
+                bot_data=dict(
+                    async_session=session_factory,
+                    enrichment=None,
+                    scraper=scraper,
+                    recent_urls=RecentUrls(),
+                    buffer=None,
+                )
+            )
+            url = str(server.make_url("/a?delay=0.5"))
+            message = link_message([("Look ", False), (url, True)], 1, -100)
+            task = asyncio.create_task(
+                handle_message(Update(1, message=message), context)
+            )
+            await asyncio.sleep(0.1)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            async with session_factory() as session:
+                released = (await session.scalars(select(MessageUrl))).all()
+            # Delivered again, it isn't a processed url nor a duplicate
+            await handle_message(Update(2, message=message), context)
+            async with session_factory() as session:
+                entries = (await session.scalars(select(UrlEntry))).all()
+        return released, entries
+
+    released, entries = asyncio.run(run())
+    assert released == []
+    assert [entry.og_title for entry in entries] == ["Title /a"]
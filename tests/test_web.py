@@ -0,0 +1,295 @@
+import json
+import re
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from pathlib import Path
+from urllib.parse import unquote
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session
+
+from rejubot.pagination import Cursor
+from rejubot.search import fts_query
+from rejubot.storage import Base, LinkDay, UrlEntry
+from rejubot.web import app
+from rejubot.webcache import FragmentCache
+
+START = datetime(2024, 1, 1, 10)
+
+
+def add_entry(path: Path, idx: int, created_at: datetime, channel_id: int = 1):
+    engine = create_engine(f"sqlite:///{path}")
+    with Session(engine) as session:
+        session.add(
+            UrlEntry(
+                channel_id=channel_id,
+                message_id=idx,
+                created_at=created_at,
+                who="Test",
+                who_id=1,
+                url=f"https://example.com/{idx}",
+                message=f"Message {idx}",
+                og_title=f"Title {idx}",
+            )
+        )
+        session.commit()
+    engine.dispose()
+
+
+@pytest.fixture
+def client(tmp_path: Path):
+    """
+    Three entries a day for five days, without running the app lifespan
+    """
+    path = tmp_path / "rejubot.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(engine)
+    engine.dispose()
+    for idx in range(15):
+        add_entry(path, idx, START + timedelta(days=idx // 3, hours=idx % 3))
+
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    app.state.session_factory = async_sessionmaker(async_engine)
+    app.state.channels = {"test": 1, "other channel": 2}
+    app.state.fragments = FragmentCache(100)
+    return TestClient(app)
+
+
+def titles(html: str) -> list[int]:
+    return [
+        int(line.split("Title ")[1].split("<")[0])
+        for line in html.splitlines()
+        if "<h3>Title" in line
+    ]
+
+
+def next_cursor(html: str) -> str:
+    return unquote(html.split('hx-get="/links?cursor=')[1].split('"')[0])
+
+
+def test_cursor_roundtrip():
+    cursor = Cursor(datetime(2024, 1, 1, 10, 30, 0, 5), 42)
+    assert Cursor.decode(cursor.encode()) == cursor
+    with pytest.raises(ValueError):
+        Cursor.decode("nope")
+
+
+def test_links_keyset_pages(client: TestClient):
+    response = client.get("/links", params=dict(page_size=4))
+    assert response.status_code == 200
+    assert titles(response.text) == [14, 13, 12, 11]
+    cursor = next_cursor(response.text)
+    # Ids start at 1
+    assert Cursor.decode(cursor) == Cursor(START + timedelta(days=3, hours=2), 12)
+
+    seen = titles(response.text)
+    while "The End" not in response.text:
+        response = client.get(
+            "/links", params=dict(cursor=next_cursor(response.text), page_size=4)
+        )
+        seen += titles(response.text)
+    assert seen == list(range(14, -1, -1))
+
+
+def test_links_continued_day_header(client: TestClient):
+    # Day 2024-01-04 has entries 9, 10 and 11, the page ends in the middle
+    cursor = Cursor(START + timedelta(days=3, hours=2), 12).encode()
+    response = client.get("/links", params=dict(cursor=cursor, page_size=2))
+    assert titles(response.text) == [10, 9]
+    assert '"header-title">2024-01-04' not in response.text
+
+
+def test_links_by_day(client: TestClient):
+    response = client.get("/links", params=dict(from_date="2024-01-02"))
+    assert titles(response.text) == [5, 4, 3, 2, 1, 0]
+    assert "The End" in response.text
+
+    # Links of the old pages keep working
+    response = client.get("/links", params=dict(partial_after="2024-01-02"))
+    assert titles(response.text) == [2, 1, 0]
+
+    response = client.get("/links", params=dict(cursor="nope"))
+    assert response.status_code == 400
+
+
+def test_links_conditional_get(client: TestClient, tmp_path: Path):
+    params = dict(cursor=Cursor.before_day(START.date() + timedelta(days=2)).encode())
+    response = client.get("/links", params=params)
+    etag = response.headers["etag"]
+    assert response.headers["last-modified"]
+    assert titles(response.text) == [5, 4, 3, 2, 1, 0]
+
+    response = client.get("/links", params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.text == ""
+
+    # A new entry today doesn't change the older pages
+    add_entry(tmp_path / "rejubot.db", 15, START + timedelta(days=5))
+    response = client.get("/links", params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert client.get("/links").headers["etag"] != etag
+
+    # One in the days of the page does
+    add_entry(tmp_path / "rejubot.db", 16, START + timedelta(days=1, hours=5))
+    response = client.get("/links", params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+    assert titles(response.text) == [16, 5, 4, 3, 2, 1, 0]
+
+
+def test_links_if_modified_since(client: TestClient, tmp_path: Path):
+    # The entries of the page were written days ago
+    engine = create_engine(f"sqlite:///{tmp_path / 'rejubot.db'}")
+    with engine.begin() as connection:
+        connection.execute(
+            update(LinkDay).values(updated_at=datetime.now() - timedelta(days=3))
+        )
+    engine.dispose()
+    params = dict(cursor=Cursor.before_day(START.date() + timedelta(days=2)).encode())
+    response = client.get("/links", params=params)
+    etag, last_modified = response.headers["etag"], response.headers["last-modified"]
+
+    since = {"If-Modified-Since": last_modified}
+    assert client.get("/links", params=params, headers=since).status_code == 304
+    # The ETags decide when there are any
+    response = client.get(
+        "/links", params=params, headers={**since, "If-None-Match": '"other"'}
+    )
+    assert response.status_code == 200
+    assert response.headers["etag"] == etag
+
+    # The page shows today's date, a copy from yesterday is out of date
+    yesterday = format_datetime(datetime.now(timezone.utc) - timedelta(days=1), True)
+    response = client.get(
+        "/links", params=params, headers={"If-Modified-Since": yesterday}
+    )
+    assert response.status_code == 200
+
+    add_entry(tmp_path / "rejubot.db", 16, START + timedelta(days=1, hours=5))
+    response = client.get("/links", params=params, headers=since)
+    assert response.status_code == 200
+    assert titles(response.text) == [16, 5, 4, 3, 2, 1, 0]
+
+
+def test_links_fragment_cache(client: TestClient):
+    client.get("/links", params=dict(page_size=4))
+    pages = list(app.state.fragments.pages.values())
+    assert len(pages) == 1
+    response = client.get("/links", params=dict(page_size=4))
+    assert response.text == pages[0]
+    assert len(app.state.fragments.pages) == 1
+
+
+def test_channel_links(client: TestClient, tmp_path: Path):
+    add_entry(tmp_path / "rejubot.db", 15, START + timedelta(days=4, hours=5), 2)
+    add_entry(tmp_path / "rejubot.db", 16, START, 2)
+
+    response = client.get("/links/other channel")
+    assert titles(response.text) == [15, 16]
+    assert "Enlaces de other channel" in response.text
+    response = client.get("/links/test", params=dict(page_size=2))
+    assert titles(response.text) == [14, 13]
+    assert 'hx-get="/links/test?cursor=' in response.text
+    assert titles(client.get("/links").text)[:2] == [15, 14]
+
+    # Each channel has its own version
+    etag = client.get("/links/test").headers["etag"]
+    add_entry(tmp_path / "rejubot.db", 17, START + timedelta(days=4, hours=6), 2)
+    response = client.get("/links/test", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+
+    assert client.get("/links/unknown").status_code == 404
+
+
+def test_api_links(client: TestClient, tmp_path: Path):
+    add_entry(tmp_path / "rejubot.db", 15, START, 2)
+    response = client.get(
+        "/api/links", params=dict(page_size=2, fields="id,og_title,created_at")
+    )
+    data = response.json()
+    assert data["links"] == [
+        dict(id=15, og_title="Title 14", created_at="2024-01-05T12:00:00"),
+        dict(id=14, og_title="Title 13", created_at="2024-01-05T11:00:00"),
+    ]
+
+    seen = []
+    params = dict(channel="test", from_date="2024-01-02", to_date="2024-01-03")
+    cursor = None
+    while True:
+        params.update(cursor=cursor, page_size=4, fields="og_title")
+        data = client.get("/api/links", params=params).json()
+        seen += [link["og_title"] for link in data["links"]]
+        if (cursor := data["next_cursor"]) is None:
+            break
+    assert seen == [f"Title {idx}" for idx in range(8, 2, -1)]
+
+    assert client.get("/api/links", params=dict(fields="nope")).status_code == 400
+    assert client.get("/api/links", params=dict(channel="nope")).status_code == 404
+
+
+def test_api_links_export(client: TestClient):
+    response = client.get(
+        "/api/links/export", params=dict(channel="test", fields="id,video_url")
+    )
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines == [dict(id=idx, video_url=None) for idx in range(1, 16)]
+
+
+def test_fts_query():
+    assert fts_query('Canción "bonita" OR -x') == '"Canción" "bonita" "OR" "x"*'
+    assert fts_query("  ¿? ") is None
+
+
+def test_search(client: TestClient, tmp_path: Path):
+    path = tmp_path / "rejubot.db"
+    engine = create_engine(f"sqlite:///{path}")
+    with Session(engine) as session:
+        session.add(
+            UrlEntry(
+                channel_id=2,
+                message_id=100,
+                created_at=START,
+                who="Pepe",
+                who_id=2,
+                url="https://example.com/song",
+                message="Mira <b>esto</b> &amp; lo otro",
+                og_title="Canción <bonita>",
+            )
+        )
+        session.commit()
+
+        response = client.get("/search", params=dict(q="cancion"))
+        assert "<mark>Canción</mark> &lt;bonita&gt;" in response.text
+        response = client.get("/search", params=dict(q="mira lo"))
+        assert "<mark>Mira</mark> esto &amp; <mark>lo</mark> otro" in response.text
+        response = client.get("/search", params=dict(q="cancion", channel="test"))
+        assert "Sin resultados" in response.text
+
+        # Kept in sync with the entries
+        entry = session.scalar(select(UrlEntry).where(UrlEntry.message_id == 100))
+        entry.og_title = "Otro título"
+        session.commit()
+        assert "Sin resultados" in client.get("/search", params=dict(q="cancion")).text
+        assert "<mark>título</mark>" in client.get("/search?q=titulo").text
+        session.delete(entry)
+        session.commit()
+        assert "Sin resultados" in client.get("/search?q=titulo").text
+    engine.dispose()
+
+
+def linked(html: str) -> list[int]:
+    return [int(idx) for idx in re.findall(r'href="https://example.com/(\d+)"', html)]
+
+
+def test_search_pages(client: TestClient):
+    response = client.get("/search", params=dict(q="title", sort="recent"))
+    assert linked(response.text) == list(range(14, -1, -1))
+    assert "Siguientes" not in response.text
+
+    response = client.get("/search", params=dict(q="message 1"))
+    # The last word is a prefix
+    assert sorted(linked(response.text)) == [1, 10, 11, 12, 13, 14]
@@ -0,0 +1,138 @@
+import asyncio
+
+from helpers import create_message, create_session_factory
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+
+from rejubot.dedup import RecentUrls
+from rejubot.metrics import BUFFERED
+from rejubot.settings import WriteBufferSettings
+from rejubot.storage import MessageUrl, UrlEntry, url_hash
+from rejubot.telegrambot import buffer_urls, claim_message_urls, create_entry
+from rejubot.writebuffer import EntryBuffer
+
+
+def entries_for(urls: list[str], message_id: int = 1) -> list[UrlEntry]:
+    message = create_message(" ".join(urls), message_id)
+    return [create_entry(message, url, None) for url in urls]
+
+
+async def stored_urls(session_factory) -> list[str]:
+    async with session_factory() as session:
+        return sorted((await session.scalars(select(UrlEntry.url))).all())
+
+
+def test_flush_when_full_and_on_stop(tmp_path):
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        buffer = EntryBuffer(
+            WriteBufferSettings(max_entries=3, max_delay=60), session_factory
+        )
+        await buffer.start()
+        await buffer.add(entries_for(["https://a.com/1", "https://a.com/2"]))
+        assert await stored_urls(session_factory) == []
+
+        await buffer.add(entries_for(["https://a.com/3", "https://a.com/4"], 2))
+        assert len(await stored_urls(session_factory)) == 4
+
+        await buffer.add(entries_for(["https://a.com/5"], 3))
+        await buffer.stop()
+        return await stored_urls(session_factory)
+
+    assert len(asyncio.run(run())) == 5
+
+
+def test_flush_after_max_delay(tmp_path):
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        buffer = EntryBuffer(WriteBufferSettings(max_delay=0.05), session_factory)
+        await buffer.start()
+        await buffer.add(entries_for(["https://a.com/1"]))
+        await asyncio.sleep(0.3)
+        urls = await stored_urls(session_factory)
+        await buffer.stop()
+        return urls
+
+    assert asyncio.run(run()) == ["https://a.com/1"]
+
+
+def test_failed_entry_is_dropped_alone(tmp_path):
+    recent = RecentUrls()
+
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        buffer = EntryBuffer(WriteBufferSettings(), session_factory, recent)
+        urls = ["https://a.com/1", "https://a.com/2", "https://a.com/3"]
+        entries = entries_for(urls)
+        async with session_factory() as session:
+            await claim_message_urls(create_message(" ".join(urls)), urls, session)
+            await session.commit()
+        for entry in entries:
+            recent.add(entry.channel_id, url_hash(entry.url), entry.created_at)
+        # NOT NULL column
+        entries[1].who = None
+        await buffer.add(entries)
+        assert await buffer.flush() == 2
+        async with session_factory() as session:
+            ledger = set(await session.scalars(select(MessageUrl.url_hash)))
+        return await stored_urls(session_factory), ledger
+
+    stored, ledger = asyncio.run(run())
+    assert stored == ["https://a.com/1", "https://a.com/3"]
+    # An edit adding it again processes it
+    assert ledger == {url_hash("https://a.com/1"), url_hash("https://a.com/3")}
+    assert (1, url_hash("https://a.com/2")) not in recent.posted
+    assert (1, url_hash("https://a.com/1")) in recent.posted
+
+
+def test_buffered_urls_are_duplicates(tmp_path):
+    recent = RecentUrls()
+    recent.complete = True
+
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        buffer = EntryBuffer(WriteBufferSettings(), session_factory, recent)
+        for message_id in (1, 2):
+            url = "https://a.com/1"
+            async with session_factory() as session:
+                await buffer_urls(
+                    create_message(url, message_id),
+                    [url],
+                    session,
+                    buffer,
+                    None,
+                    recent,
+                )
+        await buffer.flush()
+        return await stored_urls(session_factory)
+
+    # The second message sees the first while it's still in the buffer
+    assert asyncio.run(run()) == ["https://a.com/1"]
+
+
+def test_stop_drops_entries_when_the_database_fails(tmp_path):
+    def fail(*args):
+        raise OperationalError("INSERT", {}, Exception("disk I/O error"))
+
+    async def fail_each(*args):
+        fail()
+
+    async def run():
+        session_factory = await create_session_factory(tmp_path)
+        buffer = EntryBuffer(WriteBufferSettings(max_delay=60), session_factory)
+        buffer.store, buffer.store_each = fail, fail_each
+        await buffer.start()
+        urls = ["https://a.com/1", "https://a.com/2"]
+        async with session_factory() as session:
+            await claim_message_urls(create_message(" ".join(urls)), urls, session)
+            await session.commit()
+        await buffer.add(entries_for(urls))
+        # Doesn't raise, the rest of the shutdown goes on
+        await buffer.stop()
+        async with session_factory() as session:
+            ledger = (await session.scalars(select(MessageUrl))).all()
+        return buffer.entries, ledger
+
+    before = BUFFERED.value("failed")
+    assert asyncio.run(run()) == ([], [])
+    assert BUFFERED.value("failed") == before + 2